@@ -0,0 +1,129 @@
+"""Benchmarks of the framework overhead of Blocks.
+
+Every module of this package benchmarks one part of Blocks on the CPU,
+without any data sets, and can be run as a script, e.g.::
+
+    $ python -m benchmarks.main_loop --output main_loop.json
+
+The results are written as JSON: the name of the benchmark, a description
+of the environment and a list of results, each of which is a dictionary
+with the ``parameters`` of the run and the measured ``metrics``. Metrics
+whose name ends in ``_time`` are durations in seconds, the ones whose
+name ends in ``_per_second`` are rates. The results of two commits can be
+compared with :mod:`benchmarks.compare`.
+
+"""
+import json
+import platform
+import sys
+import time
+import timeit
+from contextlib import contextmanager
+
+import numpy
+import theano
+
+import blocks
+from blocks.config import config
+
+
+def environment():
+    """Describe the environment the benchmarks are run in.
+
+    Returns
+    -------
+    dict
+        The versions of Python, NumPy, Theano and Blocks, the platform
+        and the relevant Theano configuration.
+
+    """
+    return {'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': numpy.__version__,
+            'theano': theano.__version__,
+            'blocks': blocks.__version__,
+            'floatX': theano.config.floatX,
+            'device': theano.config.device}
+
+
+def best_time(function, repeat=3):
+    """Time a function, keeping the best of several runs.
+
+    Parameters
+    ----------
+    function : callable
+        The function to call without arguments.
+    repeat : int, optional
+        The number of runs, 3 by default.
+
+    Returns
+    -------
+    float
+        The shortest time in seconds.
+
+    """
+    if repeat < 1:
+        raise ValueError("repeat must be positive")
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+@contextmanager
+def configured(**settings):
+    r"""Temporarily change the Blocks configuration.
+
+    Parameters
+    ----------
+    \*\*settings
+        The configuration values to use inside the context.
+
+    """
+    previous = {}
+    for key, value in settings.items():
+        previous[key] = config.config[key].get('value', None)
+        setattr(config, key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                del config.config[key]['value']
+            else:
+                config.config[key]['value'] = value
+
+
+def write_results(name, results, path=None):
+    """Write the results of a benchmark as JSON.
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark.
+    results : list of dicts
+        The results, each with the ``parameters`` and the ``metrics`` of
+        a run.
+    path : str, optional
+        The destination. If not given, the results are written to the
+        standard output.
+
+    Returns
+    -------
+    dict
+        The document written.
+
+    """
+    document = {'benchmark': name,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'environment': environment(),
+                'results': results}
+    if path is None:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as destination:
+            json.dump(document, destination, indent=2, sort_keys=True)
+    return document
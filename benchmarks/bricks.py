@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""Benchmark building, compiling and running graphs of bricks.
+
+For each of a few representative models built from the bricks of Blocks
+the benchmark measures the time it takes to build the graph of the cost
+and of its gradients, the time Theano takes to compile the forward
+(fprop) and the training (bprop) functions, and the steady-state
+throughput of both. The training function makes a gradient descent step,
+so that it includes the backward pass and the updates.
+
+"""
+import logging
+import timeit
+from argparse import ArgumentParser
+from collections import OrderedDict
+from itertools import product
+
+import numpy
+import theano
+from theano import tensor
+
+from benchmarks import best_time, write_results
+from blocks.bricks import MLP, Rectifier, Tanh
+from blocks.bricks.attention import SequenceContentAttention
+from blocks.bricks.conv import ConvolutionalLayer, ConvolutionalSequence
+from blocks.bricks.recurrent import (Bidirectional, GatedRecurrent, LSTM,
+                                     SimpleRecurrent)
+from blocks.bricks.sequence_generators import (
+    LookupFeedback, Readout, SequenceGenerator, SoftmaxEmitter)
+from blocks.graph import ComputationGraph
+from blocks.initialization import Constant, IsotropicGaussian, Orthogonal
+
+logger = logging.getLogger(__name__)
+
+SIZES = OrderedDict([('small', 32), ('large', 256)])
+
+
+def _floatX(value):
+    return numpy.asarray(value, dtype=theano.config.floatX)
+
+
+def _sequences(dim, batch_size, length, rng):
+    """The inputs and the values of a model of sequences."""
+    inputs = tensor.tensor3('inputs')
+    mask = tensor.matrix('mask')
+    values = [_floatX(rng.uniform(size=(length, batch_size, dim))),
+              _floatX(numpy.ones((length, batch_size)))]
+    return [inputs, mask], values
+
+
+def build_mlp(dim, batch_size, length, rng):
+    x = tensor.matrix('features')
+    mlp = MLP([Tanh(), Tanh(), Tanh()], [dim, dim, dim, dim],
+              weights_init=IsotropicGaussian(0.01),
+              biases_init=Constant(0))
+    mlp.initialize()
+    return ([x], mlp.apply(x),
+            [_floatX(rng.uniform(size=(batch_size, dim)))])
+
+
+def build_convolutional_sequence(dim, batch_size, length, rng):
+    x = tensor.tensor4('features')
+    layers = [ConvolutionalLayer(Rectifier().apply, (3, 3), dim, (2, 2),
+                                 num_channels=1, name='layer_0'),
+              ConvolutionalLayer(Rectifier().apply, (3, 3), dim, (2, 2),
+                                 num_channels=dim, name='layer_1')]
+    sequence = ConvolutionalSequence(layers, num_channels=1,
+                                     batch_size=batch_size,
+                                     image_size=(28, 28),
+                                     weights_init=IsotropicGaussian(0.01),
+                                     biases_init=Constant(0))
+    sequence.initialize()
+    return ([x], sequence.apply(x),
+            [_floatX(rng.uniform(size=(batch_size, 1, 28, 28)))])
+
+
+def build_lstm(dim, batch_size, length, rng):
+    (inputs, mask), values = _sequences(4 * dim, batch_size, length, rng)
+    lstm = LSTM(dim, weights_init=IsotropicGaussian(0.01),
+                biases_init=Constant(0))
+    lstm.initialize()
+    states, cells = lstm.apply(inputs, mask=mask)
+    return [inputs, mask], states, values
+
+
+def build_gated_recurrent(dim, batch_size, length, rng):
+    (inputs, mask), values = _sequences(dim, batch_size, length, rng)
+    gate_inputs = tensor.tensor3('gate_inputs')
+    gated = GatedRecurrent(dim, activation=Tanh(), weights_init=Orthogonal())
+    gated.initialize()
+    states = gated.apply(inputs, gate_inputs, mask=mask)
+    values.append(_floatX(rng.uniform(size=(length, batch_size, 2 * dim))))
+    return [inputs, mask, gate_inputs], states, values
+
+
+def build_bidirectional(dim, batch_size, length, rng):
+    (inputs, mask), values = _sequences(dim, batch_size, length, rng)
+    bidirectional = Bidirectional(
+        SimpleRecurrent(dim=dim, activation=Tanh()),
+        weights_init=Orthogonal())
+    bidirectional.initialize()
+    return ([inputs, mask], bidirectional.apply(inputs, mask=mask),
+            values)
+
+
+def build_sequence_generator(dim, batch_size, length, rng):
+    alphabet_size = 50
+    (attended, attended_mask), values = _sequences(dim, batch_size, length,
+                                                   rng)
+    outputs = tensor.lmatrix('outputs')
+    mask = tensor.matrix('outputs_mask')
+    transition = GatedRecurrent(dim, activation=Tanh(), name='transition')
+    attention = SequenceContentAttention(
+        state_names=transition.apply.states, attended_dim=dim,
+        match_dim=dim, name='attention')
+    readout = Readout(
+        readout_dim=alphabet_size,
+        source_names=[transition.apply.states[0],
+                      attention.take_glimpses.outputs[0]],
+        emitter=SoftmaxEmitter(name='emitter'),
+        feedback_brick=LookupFeedback(alphabet_size, dim),
+        name='readout')
+    generator = SequenceGenerator(
+        readout=readout, transition=transition, attention=attention,
+        weights_init=IsotropicGaussian(0.01), biases_init=Constant(0),
+        name='generator')
+    generator.initialize()
+    costs = generator.cost_matrix(outputs, mask, attended=attended,
+                                  attended_mask=attended_mask)
+    values.extend([rng.randint(alphabet_size, size=(length, batch_size)),
+                   _floatX(numpy.ones((length, batch_size)))])
+    return [attended, attended_mask, outputs, mask], costs, values
+
+
+MODELS = OrderedDict([
+    ('mlp', build_mlp),
+    ('convolutional_sequence', build_convolutional_sequence),
+    ('lstm', build_lstm),
+    ('gated_recurrent', build_gated_recurrent),
+    ('bidirectional', build_bidirectional),
+    ('sequence_generator', build_sequence_generator)])
+
+
+def time_model(model, dim, batch_size=16, length=20, calls=10, repeat=3):
+    """Time building, compiling and running a model.
+
+    Parameters
+    ----------
+    model : str
+        One of the keys of :data:`MODELS`.
+    dim : int
+        The dimension of the hidden layers, or the number of filters.
+    batch_size : int, optional
+        The number of examples per batch, 16 by default.
+    length : int, optional
+        The length of the sequences of the recurrent models, 20 by
+        default.
+    calls : int, optional
+        The number of calls of the compiled functions per run.
+    repeat : int, optional
+        The number of runs, the best of which is kept.
+
+    Returns
+    -------
+    dict
+        The metrics: the ``build_time``, the ``fprop_compile_time`` and
+        the ``bprop_compile_time``, and the time and the number of
+        examples per second of both functions.
+
+    """
+    rng = numpy.random.RandomState(1)
+    start = timeit.default_timer()
+    inputs, output, values = MODELS[model](dim, batch_size, length, rng)
+    cost = tensor.sqr(output).mean()
+    parameters = ComputationGraph(cost).parameters
+    gradients = tensor.grad(cost, parameters)
+    metrics = {'build_time': timeit.default_timer() - start}
+
+    step = _floatX(0.01)
+    for name, outputs, updates in [
+            ('fprop', output, None),
+            ('bprop', cost, [(parameter, parameter - step * gradient)
+                             for parameter, gradient
+                             in zip(parameters, gradients)])]:
+        start = timeit.default_timer()
+        function = theano.function(inputs, outputs, updates=updates)
+        metrics['{}_compile_time'.format(name)] = (timeit.default_timer() -
+                                                   start)
+        function(*values)
+
+        def run():
+            for _ in range(calls):
+                function(*values)
+        run_time = best_time(run, repeat) / calls
+        metrics['{}_time'.format(name)] = run_time
+        metrics['{}_examples_per_second'.format(name)] = batch_size / run_time
+    return metrics
+
+
+def main(output=None, models=None, sizes=None, batch_size=16, length=20,
+         calls=10, repeat=3):
+    """Run the bricks benchmark for every model and size.
+
+    Parameters
+    ----------
+    output : str, optional
+        The destination of the results. If not given, they are written to
+        the standard output.
+    models : list of str, optional
+        The models to benchmark, all of :data:`MODELS` by default.
+    sizes : list of str, optional
+        The keys of :data:`SIZES` to try, all of them by default.
+    batch_size : int, optional
+        The number of examples per batch.
+    length : int, optional
+        The length of the sequences of the recurrent models.
+    calls : int, optional
+        The number of calls of the compiled functions per run.
+    repeat : int, optional
+        The number of runs, the best of which is kept.
+
+    """
+    if models is None:
+        models = list(MODELS)
+    if sizes is None:
+        sizes = list(SIZES)
+    for model in models:
+        if model not in MODELS:
+            raise ValueError("unknown model: {}".format(model))
+    results = []
+    for model, size in product(models, sizes):
+        parameters = {'model': model, 'size': size, 'dim': SIZES[size],
+                      'batch_size': batch_size, 'length': length}
+        metrics = time_model(model, SIZES[size], batch_size, length, calls,
+                             repeat)
+        logger.info("{} ({}): built in {:.2f} s, compiled in {:.2f} s and "
+                    "{:.2f} s, {:.0f} and {:.0f} examples per second".format(
+                        model, size, metrics['build_time'],
+                        metrics['fprop_compile_time'],
+                        metrics['bprop_compile_time'],
+                        metrics['fprop_examples_per_second'],
+                        metrics['bprop_examples_per_second']))
+        results.append({'parameters': parameters, 'metrics': metrics})
+    return write_results('bricks', results, output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    parser = ArgumentParser(
+        "Benchmarks building, compiling and running graphs of bricks.")
+    parser.add_argument("--output", help="Where to write the results")
+    parser.add_argument("--models", nargs="+", choices=list(MODELS),
+                        help="The models to benchmark, all by default")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES),
+                        help="The sizes to try, all by default")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="The number of examples per batch")
+    parser.add_argument("--length", type=int, default=20,
+                        help="The length of the sequences")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="The number of runs per model")
+    args = parser.parse_args()
+    main(args.output, args.models, args.sizes, args.batch_size, args.length,
+         repeat=args.repeat)
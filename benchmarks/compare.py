@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare the results of a benchmark between two commits.
+
+The runs are matched by their parameters. A run is reported as a
+regression when one of its ``_time`` metrics grows, or one of its
+``_per_second`` metrics drops, by more than the given tolerance. The
+script exits with a non-zero status if any regression is found.
+
+"""
+from __future__ import print_function
+
+import json
+import sys
+from argparse import ArgumentParser
+
+
+def _key(parameters):
+    return json.dumps(parameters, sort_keys=True)
+
+
+def compare(baseline, results, tolerance=0.1):
+    """Compare two result documents of the same benchmark.
+
+    Parameters
+    ----------
+    baseline : dict
+        The results of the reference commit, as written by
+        :func:`~benchmarks.write_results`.
+    results : dict
+        The results of the commit being tested.
+    tolerance : float, optional
+        The relative slowdown tolerated, 0.1 (10%) by default.
+
+    Returns
+    -------
+    list of tuples
+        A ``(parameters, metric, baseline value, value, slowdown)`` tuple
+        for every metric measured in both documents, where the slowdown
+        is relative to the baseline.
+    list of tuples
+        The subset of these tuples which exceed the tolerance.
+
+    """
+    if baseline['benchmark'] != results['benchmark']:
+        raise ValueError("cannot compare the results of {} and {}".format(
+            baseline['benchmark'], results['benchmark']))
+    reference = dict((_key(result['parameters']), result['metrics'])
+                     for result in baseline['results'])
+    comparisons = []
+    for result in results['results']:
+        metrics = reference.get(_key(result['parameters']))
+        if metrics is None:
+            continue
+        for metric, value in sorted(result['metrics'].items()):
+            baseline_value = metrics.get(metric)
+            if not baseline_value or not value:
+                continue
+            if metric.endswith('_time'):
+                slowdown = value / baseline_value - 1
+            elif metric.endswith('_per_second'):
+                slowdown = baseline_value / value - 1
+            else:
+                continue
+            comparisons.append((result['parameters'], metric,
+                                baseline_value, value, slowdown))
+    regressions = [comparison for comparison in comparisons
+                   if comparison[-1] > tolerance]
+    return comparisons, regressions
+
+
+def main(baseline_path, results_path, tolerance=0.1):
+    with open(baseline_path) as source:
+        baseline = json.load(source)
+    with open(results_path) as source:
+        results = json.load(source)
+    comparisons, regressions = compare(baseline, results, tolerance)
+    for parameters, metric, baseline_value, value, slowdown in comparisons:
+        print("{:<60} {:<24} {:>12.6g} {:>12.6g} {:>+8.1%}{}".format(
+            _key(parameters), metric, baseline_value, value, slowdown,
+            " REGRESSION" if slowdown > tolerance else ""))
+    return not regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        "Compares the results of a benchmark with a baseline.")
+    parser.add_argument("baseline", help="The results of the baseline")
+    parser.add_argument("results", help="The results to compare")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="The relative slowdown tolerated")
+    args = parser.parse_args()
+    sys.exit(0 if main(args.baseline, args.results, args.tolerance) else 1)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""Benchmark the per-iteration overhead of the main loop.
+
+The main loop is run with an algorithm which does nothing on a stream of
+batches held in memory, so that all the time measured is spent by Blocks
+itself: in the main loop, the log, the profiler and the extensions. The
+benchmark varies the number of extensions, the number of log records
+each of them makes per batch, whether every iteration is profiled and how
+often a checkpoint is made.
+
+"""
+import logging
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from itertools import product
+
+import numpy
+from picklable_itertools import iter_
+
+from benchmarks import best_time, configured, write_results
+from blocks.algorithms import TrainingAlgorithm
+from blocks.extensions import FinishAfter, SimpleExtension
+from blocks.extensions.saveload import Checkpoint
+from blocks.main_loop import MainLoop
+
+logger = logging.getLogger(__name__)
+
+
+class NullAlgorithm(TrainingAlgorithm):
+    """A training algorithm which does nothing."""
+    def initialize(self):
+        pass
+
+    def process_batch(self, batch):
+        pass
+
+
+class InMemoryStream(object):
+    """A data stream which yields the same batches every epoch.
+
+    Parameters
+    ----------
+    batches : list of dicts
+        The batches of an epoch.
+
+    """
+    def __init__(self, batches):
+        self.batches = batches
+
+    def get_epoch_iterator(self, as_dict=False):
+        return iter_(self.batches)
+
+
+class WriteRecords(SimpleExtension):
+    """Makes a number of log records after every batch.
+
+    Parameters
+    ----------
+    records : int
+        The number of records to make.
+
+    """
+    def __init__(self, records, **kwargs):
+        kwargs.setdefault('after_batch', True)
+        super(WriteRecords, self).__init__(**kwargs)
+        self.names = ['{}_record_{}'.format(self.name, i)
+                      for i in range(records)]
+
+    def do(self, which_callback, *args):
+        current_row = self.main_loop.log.current_row
+        for i, name in enumerate(self.names):
+            current_row[name] = i
+
+
+def time_main_loop(batches, extensions, records, profile, checkpoint_every,
+                   repeat=3):
+    """Time the iterations of the main loop.
+
+    Parameters
+    ----------
+    batches : int
+        The number of batches of the single epoch run.
+    extensions : int
+        The number of extensions which make log records, in addition to
+        the :class:`.FinishAfter` extension.
+    records : int
+        The number of records every extension makes per batch.
+    profile : bool
+        If ``True``, every iteration is profiled, otherwise only the
+        first one is.
+    checkpoint_every : int
+        If not ``None``, the main loop is pickled every
+        `checkpoint_every` batches.
+    repeat : int, optional
+        The number of runs, the best of which is kept.
+
+    Returns
+    -------
+    dict
+        The ``iteration_time`` in seconds and the number of
+        ``iterations_per_second``.
+
+    """
+    batch = {'features': numpy.zeros((1,))}
+    folder = tempfile.mkdtemp()
+    try:
+        def run():
+            main_loop_extensions = [WriteRecords(records, name='records_{}'
+                                                 .format(i))
+                                    for i in range(extensions)]
+            if checkpoint_every:
+                main_loop_extensions.append(Checkpoint(
+                    os.path.join(folder, 'checkpoint.pkl'),
+                    every_n_batches=checkpoint_every, after_training=False))
+            main_loop_extensions.append(FinishAfter(after_n_epochs=1))
+            main_loop = MainLoop(NullAlgorithm(),
+                                 InMemoryStream([batch] * batches),
+                                 extensions=main_loop_extensions)
+            main_loop.run()
+        with configured(profile_every=1 if profile else batches + 1):
+            iteration_time = best_time(run, repeat) / batches
+    finally:
+        shutil.rmtree(folder)
+    return {'iteration_time': iteration_time,
+            'iterations_per_second': 1 / iteration_time}
+
+
+def main(output=None, batches=1000, extensions=(0, 1, 10),
+         records=(0, 10, 100), profile=(False, True),
+         checkpoint_every=(None, 100), repeat=3):
+    """Run the main loop benchmark for every combination of parameters.
+
+    Parameters
+    ----------
+    output : str, optional
+        The destination of the results. If not given, they are written to
+        the standard output.
+    batches : int, optional
+        The number of batches per run.
+    extensions : tuple of ints, optional
+        The numbers of extensions to try.
+    records : tuple of ints, optional
+        The numbers of records per extension and batch to try.
+    profile : tuple of bools, optional
+        Whether to profile every iteration.
+    checkpoint_every : tuple, optional
+        The checkpoint frequencies to try, ``None`` for no checkpoints.
+    repeat : int, optional
+        The number of runs per combination, the best of which is kept.
+
+    """
+    results = []
+    for parameters in product(extensions, records, profile,
+                              checkpoint_every):
+        parameters = dict(zip(['extensions', 'records', 'profile',
+                               'checkpoint_every'], parameters))
+        if not parameters['extensions'] and parameters['records']:
+            continue
+        metrics = time_main_loop(batches, repeat=repeat, **parameters)
+        logger.info("{}: {:.1f} us per iteration".format(
+            parameters, 1e6 * metrics['iteration_time']))
+        results.append({'parameters': parameters, 'metrics': metrics})
+    return write_results('main_loop', results, output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    parser = ArgumentParser(
+        "Benchmarks the per-iteration overhead of the Blocks main loop.")
+    parser.add_argument("--output", help="Where to write the results")
+    parser.add_argument("--batches", type=int, default=1000,
+                        help="The number of batches per run")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="The number of runs per combination")
+    parser.add_argument("--quick", action="store_true",
+                        help="Only try a few combinations")
+    args = parser.parse_args()
+    if args.quick:
+        main(args.output, args.batches, extensions=(0, 10), records=(10,),
+             profile=(True,), checkpoint_every=(None,), repeat=args.repeat)
+    else:
+        main(args.output, args.batches, repeat=args.repeat)
@@ -7,12 +7,12 @@ from six.moves import reduce
 
 from picklable_itertools.extras import equizip
 
-import theano
 from six import add_metaclass
 from theano import tensor
 
 from blocks.graph import ComputationGraph
 from blocks.utils import dict_subset, named_copy, pack, shared_floatx
+from blocks.utils.theano_profile import theano_function
 from blocks.theano_expressions import l2_norm
 
 logger = logging.getLogger(__name__)
@@ -221,7 +221,8 @@ class GradientDescent(DifferentiableCostMinimizer):
         for param in self.params:
             all_updates.append((param, param - self.steps[param]))
         all_updates += self.step_rule_updates
-        self._function = theano.function(self.inputs, [], updates=all_updates)
+        self._function = theano_function(type(self).__name__, self.inputs, [],
+                                         updates=all_updates)
         logger.info("The training algorithm is initialized")
 
     def process_batch(self, batch):
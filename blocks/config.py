@@ -51,6 +51,44 @@ The following configurations are supported:
    A boolean value which determines whether to print profiling information
    at the end of a call to :meth:`.MainLoop.run`.
 
+.. option:: profile_every, BLOCKS_PROFILE_EVERY
+
+   An integer. If greater than 1, the sections of only every n-th iteration
+   are timed by :meth:`.MainLoop.run` and the profile totals are
+   extrapolated, which makes the overhead of profiling negligible, see
+   :class:`~blocks.utils.profile.Profile`. By default every iteration is
+   timed.
+
+.. option:: profile_theano, BLOCKS_PROFILE_THEANO
+
+   A boolean value. If ``True``, the Theano functions of the training
+   algorithm, the monitoring and the beam search are compiled with Theano's
+   profiler, and the time they spend in every brick application during a
+   call to :meth:`.MainLoop.run` is printed at the end of the run, see
+   :mod:`blocks.utils.theano_profile`. The functions compiled before the
+   configuration is set are not profiled. ``False`` by default.
+
+.. option:: profile_trace, BLOCKS_PROFILE_TRACE
+
+   A path. If set, the timeline of the sections profiled by
+   :meth:`.MainLoop.run` is recorded and written to this path in the Chrome
+   Trace Event format at the end of the run, see
+   :class:`~blocks.utils.profile.TraceRecorder`. Not set by default.
+
+.. option:: extension_budget, BLOCKS_EXTENSION_BUDGET
+
+   A float. If positive, :class:`.MainLoop` measures the time spent in the
+   callbacks of every extension and warns once about each extension which
+   takes more than this fraction of the training time, e.g. ``0.1`` for
+   10%. Disabled by default.
+
+.. option:: throttle_extensions, BLOCKS_THROTTLE_EXTENSIONS
+
+   A boolean value. If ``True``, the batch callbacks of the non-critical
+   extensions (see :attr:`.TrainingExtension.critical`) which exceed the
+   :option:`extension_budget` are skipped until their share of the
+   training time falls below it again. ``False`` by default.
+
 .. _YAML: http://yaml.org/
 .. _environment variables:
    https://en.wikipedia.org/wiki/Environment_variable
@@ -157,4 +195,14 @@ config.add_config('recursion_limit', type_=int, default=10000)
 config.add_config('bokeh_server', type_=str, default='http://localhost:5006/')
 config.add_config('profile', type_=bool_, default=False,
                   env_var='BLOCKS_PROFILE')
+config.add_config('profile_every', type_=int, default=1,
+                  env_var='BLOCKS_PROFILE_EVERY')
+config.add_config('profile_theano', type_=bool_, default=False,
+                  env_var='BLOCKS_PROFILE_THEANO')
+config.add_config('profile_trace', type_=str, default='',
+                  env_var='BLOCKS_PROFILE_TRACE')
+config.add_config('extension_budget', type_=float, default=0.,
+                  env_var='BLOCKS_EXTENSION_BUDGET')
+config.add_config('throttle_extensions', type_=bool_, default=False,
+                  env_var='BLOCKS_THROTTLE_EXTENSIONS')
 config.load_yaml()
@@ -16,18 +16,44 @@ While current dumping mechanism still uses serialization, this is subject
 to be gradually changed, aiming to use only stable and simple data formats
 for dumps, such as for instance .npz files.
 
+Parameter values can be saved either as a `.npz` archive (see
+:func:`save_parameter_values`) or in an uncompressed, aligned format that
+can be memory-mapped on loading (see :func:`save_aligned_parameter_values`).
+The latter makes loading of large models nearly instant: the arrays are
+read from the page cache only when they are copied into the shared
+variables. Big models can also be saved as several shards in the aligned
+format, written and read in parallel (see
+:func:`save_sharded_parameter_values`), which is what
+:class:`MainLoopDumpManager` does when `num_shards` is given.
+
 """
+import json
 import logging
 import os
 import os.path
+import shutil
+import struct
+import tempfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy
+import six
 from six.moves import cPickle
 
-from blocks.serialization import pickle_dump
+from blocks.select import Path
+from blocks.serialization import array_checksum, pickle_dump
+from blocks.utils import dict_subset, dict_union, pack
 
 logger = logging.getLogger(__name__)
 
+ALIGNED_FORMAT_MAGIC = b'\x93BLKPRM\x01'
+"""The first bytes of a file saved by :func:`save_aligned_parameter_values`."""
+ALIGNMENT = 64
+"""The alignment (in bytes) of arrays in the aligned parameter format."""
+MANIFEST_FILENAME = 'manifest.json'
+"""The name of the manifest file of parameters saved in shards."""
+
 
 def save_parameter_values(param_values, path):
     """Compactly save parameter values.
@@ -48,22 +74,30 @@ def save_parameter_values(param_values, path):
     numpy.savez(path, **param_values)
 
 
-def load_parameter_values(path):
+def load_parameter_values(path, mmap_mode='r'):
     """Load parameter values saved by :func:`save_parameters`.
 
     This is a thin wrapper over `numpy.load`. It deals with
-    `numpy`'s vulnerability to slashes in file names.
+    `numpy`'s vulnerability to slashes in file names. Files saved by
+    :func:`save_aligned_parameter_values` are recognized and loaded
+    with :func:`load_aligned_parameter_values`.
 
     Parameters
     ----------
     path : str or file
         The source for loading from.
+    mmap_mode : {'r', 'c', None}, optional
+        Passed to :func:`load_aligned_parameter_values` when `path` is a
+        file in the aligned format, ignored otherwise. ``'r'`` by
+        default, so that aligned files are memory-mapped.
 
     Returns
     -------
     A dictionary of (parameter name, numpy array) pairs.
 
     """
+    if is_aligned_parameter_file(path):
+        return load_aligned_parameter_values(path, mmap_mode=mmap_mode)
     source = numpy.load(path)
     param_values = {name.replace("-", "/"): value
                     for name, value in source.items()}
@@ -71,6 +105,325 @@ def load_parameter_values(path):
     return param_values
 
 
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_aligned_parameter_values(param_values, path):
+    """Save parameter values in a format suitable for memory mapping.
+
+    Unlike :func:`save_parameter_values`, the arrays are stored
+    uncompressed and in C order, each of them starting at an offset
+    that is a multiple of :const:`ALIGNMENT` bytes. A JSON header with
+    the names, dtypes, shapes and offsets of the arrays precedes the
+    data.
+
+    Parameters
+    ----------
+    param_values : dict of (parameter name, numpy array)
+        The parameter values.
+    path : str
+        The destination for saving.
+
+    """
+    arrays = [(name, numpy.require(value, requirements='C'))
+              for name, value in param_values.items()]
+    # Offsets are counted from the beginning of the data section, which
+    # starts at the first aligned position after the header.
+    entries = []
+    offset = 0
+    for name, value in arrays:
+        entries.append((name, value.dtype.str, value.shape, offset))
+        offset = _aligned(offset + value.nbytes)
+    header = json.dumps(entries).encode('utf-8')
+
+    with open(path, 'wb') as destination:
+        destination.write(ALIGNED_FORMAT_MAGIC)
+        destination.write(struct.pack('<Q', len(header)))
+        destination.write(header)
+        position = len(ALIGNED_FORMAT_MAGIC) + 8 + len(header)
+        destination.write(b'\x00' * (_aligned(position) - position))
+        for _, value in arrays:
+            destination.write(value.data)
+            destination.write(
+                b'\x00' * (_aligned(value.nbytes) - value.nbytes))
+
+
+def read_aligned_parameter_header(path):
+    """Read the header of a file in the aligned parameter format.
+
+    Parameters
+    ----------
+    path : str
+        The file to read the header from.
+
+    Returns
+    -------
+    A list of (name, dtype, shape, offset) tuples, where offsets are
+    counted from the beginning of the file.
+
+    """
+    with open(path, 'rb') as source:
+        if source.read(len(ALIGNED_FORMAT_MAGIC)) != ALIGNED_FORMAT_MAGIC:
+            raise ValueError("{} is not in the aligned parameter format"
+                             .format(path))
+        header_length, = struct.unpack('<Q', source.read(8))
+        entries = json.loads(source.read(header_length).decode('utf-8'))
+    data_start = _aligned(len(ALIGNED_FORMAT_MAGIC) + 8 + header_length)
+    return [(name, numpy.dtype(str(dtype)), tuple(shape),
+             data_start + offset)
+            for name, dtype, shape, offset in entries]
+
+
+def load_aligned_parameter_values(path, mmap_mode='r', names=None):
+    """Load parameter values saved by :func:`save_aligned_parameter_values`.
+
+    Parameters
+    ----------
+    path : str
+        The source for loading from.
+    mmap_mode : {'r', 'c', None}, optional
+        If not ``None``, the file is memory-mapped with this mode (see
+        :class:`numpy.memmap`) and the arrays returned are views of the
+        mapping, so that no data is read until it is actually accessed.
+        When ``None``, the arrays are read into memory. ``'r'`` by
+        default.
+    names : iterable of str, optional
+        If given, only the parameters with these names are loaded.
+
+    Returns
+    -------
+    A dictionary of (parameter name, numpy array) pairs.
+
+    Notes
+    -----
+    The memory-mapped arrays can be passed to
+    :meth:`.AbstractModel.set_param_values` directly. Their values are
+    then copied into the shared variables once, straight from the page
+    cache.
+
+    """
+    entries = read_aligned_parameter_header(path)
+    if names is not None:
+        names = set(names)
+        entries = [entry for entry in entries if entry[0] in names]
+    param_values = OrderedDict()
+    if mmap_mode is not None:
+        mapping = numpy.memmap(path, dtype='uint8', mode=mmap_mode)
+        for name, dtype, shape, offset in entries:
+            param_values[name] = numpy.ndarray(shape, dtype, buffer=mapping,
+                                               offset=offset)
+        return param_values
+    with open(path, 'rb') as source:
+        for name, dtype, shape, offset in entries:
+            source.seek(offset)
+            count = int(numpy.prod(shape))
+            param_values[name] = numpy.fromfile(
+                source, dtype, count).reshape(shape)
+    return param_values
+
+
+def is_aligned_parameter_file(path):
+    """Check if a file is in the aligned parameter format."""
+    if not isinstance(path, six.string_types) or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as source:
+        return source.read(len(ALIGNED_FORMAT_MAGIC)) == ALIGNED_FORMAT_MAGIC
+
+
+def match_parameter_names(names, paths):
+    """Select parameter names matching Selector-style paths.
+
+    A name matches a path if they are equal or if the path refers
+    to a brick that is an ancestor of the parameter, e.g. both
+    ``/mlp/linear_0`` and ``/mlp`` match ``/mlp/linear_0.W``.
+
+    Parameters
+    ----------
+    names : iterable of str
+        The parameter names, as returned by :meth:`.Model.get_params`.
+    paths : str or list of str
+        The paths to match.
+
+    Returns
+    -------
+    A list of the matching names, in the same order as in `names`.
+
+    """
+    paths = [str(path) for path in pack(paths)]
+    return [name for name in names
+            if any(name == path or
+                   name.startswith(path + Path.separator) or
+                   name.startswith(path + Path.param_separator)
+                   for path in paths)]
+
+
+def _save_shard(args):
+    path, param_values = args
+    save_aligned_parameter_values(param_values, path)
+    return {name: array_checksum(value)
+            for name, value in param_values.items()}
+
+
+def save_sharded_parameter_values(param_values, folder, num_shards,
+                                  num_workers=None):
+    """Save parameter values as several shards in parallel.
+
+    The parameters are distributed between `num_shards` files in the
+    aligned format (see :func:`save_aligned_parameter_values`) so that
+    the shards have approximately equal sizes. The shards are written
+    by a pool of threads. A JSON manifest with the names, shapes, dtypes,
+    checksums and shards of the parameters is written to
+    :const:`MANIFEST_FILENAME` in the same folder.
+
+    The shards and the manifest are written to a temporary folder next
+    to `folder`, which then replaces `folder` by renaming. An interrupted
+    save therefore never leaves a manifest that does not match its
+    shards, nor shards of a previous save.
+
+    Parameters
+    ----------
+    param_values : dict of (parameter name, numpy array)
+        The parameter values.
+    folder : str
+        The destination folder. Created if it does not exist.
+    num_shards : int
+        The number of shards.
+    num_workers : int, optional
+        The number of threads used for writing. By default one thread
+        per shard is used.
+
+    """
+    if num_shards < 1:
+        raise ValueError("at least one shard is required")
+    folder = os.path.abspath(folder)
+    parent, name = os.path.split(folder)
+    temporary = tempfile.mkdtemp(prefix=name + '.', suffix='.tmp',
+                                 dir=parent)
+    try:
+        _save_shards(param_values, temporary, num_shards, num_workers)
+        if os.path.exists(folder):
+            previous = tempfile.mkdtemp(prefix=name + '.', suffix='.old',
+                                        dir=parent)
+            os.rename(folder, os.path.join(previous, name))
+            os.rename(temporary, folder)
+            shutil.rmtree(previous)
+        else:
+            os.rename(temporary, folder)
+    finally:
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+
+
+def _save_shards(param_values, folder, num_shards, num_workers):
+    # Greedily put the largest parameters into the least loaded shards.
+    shards = [OrderedDict() for _ in range(num_shards)]
+    shard_sizes = [0] * num_shards
+    for name, value in sorted(param_values.items(),
+                              key=lambda item: -item[1].nbytes):
+        index = shard_sizes.index(min(shard_sizes))
+        shards[index][name] = value
+        shard_sizes[index] += value.nbytes
+    filenames = ['shard_{}.bin'.format(i) for i in range(num_shards)]
+
+    pool = ThreadPool(num_workers if num_workers else num_shards)
+    try:
+        checksums = pool.map(
+            _save_shard, [(os.path.join(folder, filename), shard)
+                          for filename, shard in zip(filenames, shards)])
+    finally:
+        pool.close()
+        pool.join()
+
+    manifest = OrderedDict()
+    for filename, shard, shard_checksums in zip(filenames, shards,
+                                                checksums):
+        for name, value in shard.items():
+            manifest[name] = OrderedDict([
+                ('shard', filename), ('shape', list(value.shape)),
+                ('dtype', value.dtype.str),
+                ('checksum', shard_checksums[name])])
+    # Keep the original order of the parameters in the manifest.
+    manifest = OrderedDict((name, manifest[name]) for name in param_values)
+    with open(os.path.join(folder, MANIFEST_FILENAME), 'w') as destination:
+        json.dump({'shards': filenames, 'parameters': manifest},
+                  destination, indent=1)
+
+
+def read_parameter_manifest(folder):
+    """Read the manifest of parameters saved in shards.
+
+    Returns
+    -------
+    An ordered dictionary of (name, dict) pairs, where the dictionaries
+    have `shard`, `shape`, `dtype` and `checksum` keys.
+
+    """
+    with open(os.path.join(folder, MANIFEST_FILENAME)) as source:
+        return json.load(source, object_pairs_hook=OrderedDict)['parameters']
+
+
+def load_sharded_parameter_values(folder, paths=None, mmap_mode='r',
+                                  verify=False, num_workers=None):
+    """Load parameter values saved by :func:`save_sharded_parameter_values`.
+
+    The shards are read by a pool of threads. Only the shards containing
+    the requested parameters are touched.
+
+    Parameters
+    ----------
+    folder : str
+        The folder with the shards and the manifest.
+    paths : str or list of str, optional
+        If given, only the parameters matching these Selector-style paths
+        are loaded, see :func:`match_parameter_names`.
+    mmap_mode : {'r', 'c', None}, optional
+        See :func:`load_aligned_parameter_values`. By default the shards
+        are memory-mapped.
+    verify : bool, optional
+        If ``True``, the checksums from the manifest are verified and
+        a ``ValueError`` is raised in the case of a mismatch.
+    num_workers : int, optional
+        The number of threads used for reading. By default one thread per
+        shard is used.
+
+    Returns
+    -------
+    An ordered dictionary of (parameter name, numpy array) pairs.
+
+    """
+    manifest = read_parameter_manifest(folder)
+    names = list(manifest.keys())
+    if paths is not None:
+        names = match_parameter_names(names, paths)
+    shards = OrderedDict()
+    for name in names:
+        shards.setdefault(manifest[name]['shard'], []).append(name)
+
+    def load_shard(args):
+        filename, shard_names = args
+        param_values = load_aligned_parameter_values(
+            os.path.join(folder, filename), mmap_mode=mmap_mode,
+            names=shard_names)
+        if verify:
+            for name, value in param_values.items():
+                if array_checksum(value) != manifest[name]['checksum']:
+                    raise ValueError("checksum mismatch for {} in {}"
+                                     .format(name, filename))
+        return param_values
+
+    if not shards:
+        return OrderedDict()
+    pool = ThreadPool(num_workers if num_workers else len(shards))
+    try:
+        loaded = pool.map(load_shard, list(shards.items()))
+    finally:
+        pool.close()
+        pool.join()
+    param_values = dict_union(*loaded)
+    return OrderedDict((name, param_values[name]) for name in names)
+
+
 class MainLoopDumpManager(object):
     """Main loop dumping implementation.
 
@@ -86,15 +439,33 @@ class MainLoopDumpManager(object):
     ----------
     folder : str
         The path to the dump root folder.
+    num_shards : int, optional
+        If given, the parameters are saved as this number of shards
+        written in parallel (see :func:`save_sharded_parameter_values`)
+        instead of a single `.npz` file.
+    num_workers : int, optional
+        The number of threads used to save and load the shards.
+    mmap_mode : {'r', 'c', None}, optional
+        The mode in which the shards are memory-mapped on loading, see
+        :func:`load_aligned_parameter_values`. ``'r'`` by default, use
+        ``None`` to read the parameters into memory.
 
     """
-    def __init__(self, folder):
+    def __init__(self, folder, num_shards=None, num_workers=None,
+                 mmap_mode='r'):
         self.folder = folder
+        self.num_shards = num_shards
+        self.num_workers = num_workers
+        self.mmap_mode = mmap_mode
 
     @property
     def path_to_parameters(self):
         return os.path.join(self.folder, 'params.npz')
 
+    @property
+    def path_to_parameter_shards(self):
+        return os.path.join(self.folder, 'params')
+
     @property
     def path_to_iteration_state(self):
         return os.path.join(self.folder, 'iterations_state.pkl')
@@ -108,17 +479,50 @@ class MainLoopDumpManager(object):
         # pickled though.
         return os.path.join(self.folder, 'log')
 
+    def save_parameters(self, param_values):
+        # Remove the parameters saved in the other format, if any, so that
+        # the stale values are never loaded.
+        if self.num_shards:
+            save_sharded_parameter_values(
+                param_values, self.path_to_parameter_shards, self.num_shards,
+                num_workers=self.num_workers)
+            if os.path.exists(self.path_to_parameters):
+                os.remove(self.path_to_parameters)
+        else:
+            if os.path.exists(self.path_to_parameter_shards):
+                shutil.rmtree(self.path_to_parameter_shards)
+            save_parameter_values(param_values, self.path_to_parameters)
+
+    def save_iteration_state(self, iteration_state):
+        with open(self.path_to_iteration_state, "wb") as destination:
+            pickle_dump(iteration_state, destination)
+
+    def save_log(self, log):
+        with open(self.path_to_log, "wb") as destination:
+            pickle_dump(log, destination)
+
+    def save(self, param_values, iteration_state, log):
+        """Save the parts of a dump to the root folder.
+
+        The counterpart of :meth:`load`, which allows to dump a main loop
+        whose parts were loaded separately, e.g. from an indexed
+        checkpoint.
+
+        """
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+        self.save_parameters(param_values)
+        self.save_iteration_state(iteration_state)
+        self.save_log(log)
+
     def dump_parameters(self, main_loop):
-        save_parameter_values(main_loop.model.get_param_values(),
-                              self.path_to_parameters)
+        self.save_parameters(main_loop.model.get_param_values())
 
     def dump_iteration_state(self, main_loop):
-        with open(self.path_to_iteration_state, "wb") as destination:
-            pickle_dump(main_loop.iteration_state, destination)
+        self.save_iteration_state(main_loop.iteration_state)
 
     def dump_log(self, main_loop):
-        with open(self.path_to_log, "wb") as destination:
-            pickle_dump(main_loop.log, destination)
+        self.save_log(main_loop.log)
 
     def dump(self, main_loop):
         """Dumps the main loop to the root folder.
@@ -128,14 +532,29 @@ class MainLoopDumpManager(object):
         Overwrites the old data if present.
 
         """
-        if not os.path.exists(self.folder):
-            os.mkdir(self.folder)
-        self.dump_parameters(main_loop)
-        self.dump_iteration_state(main_loop)
-        self.dump_log(main_loop)
+        self.save(main_loop.model.get_param_values(),
+                  main_loop.iteration_state, main_loop.log)
 
-    def load_parameters(self):
-        return load_parameter_values(self.path_to_parameters)
+    def load_parameters(self, paths=None):
+        """Load the parameter values.
+
+        Parameters
+        ----------
+        paths : str or list of str, optional
+            If given, only the parameters matching these Selector-style
+            paths are loaded, see :func:`match_parameter_names`.
+
+        """
+        if os.path.exists(os.path.join(self.path_to_parameter_shards,
+                                       MANIFEST_FILENAME)):
+            return load_sharded_parameter_values(
+                self.path_to_parameter_shards, paths=paths,
+                mmap_mode=self.mmap_mode, num_workers=self.num_workers)
+        param_values = load_parameter_values(self.path_to_parameters)
+        if paths is not None:
+            param_values = dict_subset(
+                param_values, match_parameter_names(param_values, paths))
+        return param_values
 
     def load_iteration_state(self):
         with open(self.path_to_iteration_state, "rb") as source:
@@ -1,6 +1,7 @@
-from __future__ import print_function
+from __future__ import division, print_function
 
 import logging
+import timeit
 from abc import ABCMeta, abstractmethod
 
 import progressbar
@@ -37,8 +38,15 @@ class TrainingExtension(object):
         The main loop to which the extension belongs.
     name : str
         The name of the extension.
+    critical : bool
+        ``False`` for the extensions, such as printing and plotting, whose
+        batch callbacks the main loop may skip when they take too much
+        time, see the ``throttle_extensions`` configuration. ``True`` by
+        default.
 
     """
+    critical = True
+
     def __init__(self, name=None):
         if not name:
             name = self.__class__.__name__
@@ -135,16 +143,41 @@ class CallbackName(str):
     TrainingExtension callback.
 
     """
+    names = frozenset(key for key, value
+                      in TrainingExtension.__dict__.items()
+                      if getattr(value, '_is_callback', False))
+
     def __eq__(self, other):
-        callback_names = [key for key, value
-                          in TrainingExtension.__dict__.items()
-                          if getattr(value, '_is_callback', False)]
-        if other not in callback_names:
+        if other not in self.names:
             raise TypeError("{} is not a valid callback.".format(other))
         return str(self) == other
 
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = str.__hash__
+
 
 class Predicate(object):
+    """A condition on the number of epochs or batches done.
+
+    Parameters
+    ----------
+    condition : str
+        One of the integer triggers of :class:`SimpleExtension`, e.g.
+        ``every_n_batches``.
+    num : int
+        The number of epochs or batches.
+
+    Notes
+    -----
+    For the ``every_n_*`` conditions the predicate remembers the range of
+    entries for which it is known not to hold, so that on most calls it
+    does a single comparison.
+
+    """
+    _skip = (0, 0)
+
     def __init__(self, condition, num):
         self.condition = condition
         self.num = num
@@ -155,6 +188,10 @@ class Predicate(object):
         else:
             entry = log.status['iterations_done']
         if self.condition.startswith('every'):
+            low, high = self._skip
+            if low <= entry < high:
+                return False
+            self._skip = (entry + 1, entry - entry % self.num + self.num)
             return entry % self.num == 0
         else:
             return entry == self.num
@@ -218,8 +255,13 @@ class SimpleExtension(TrainingExtension):
     INTEGER_TRIGGERS = frozenset(["after_n_epochs", "after_n_batches",
                                   "every_n_epochs", "every_n_batches"])
 
+    # Extensions pickled before the conditions were indexed have no
+    # table, it is rebuilt from the conditions when needed
+    _dispatch_table = None
+
     def __init__(self, **kwargs):
         self._conditions = []
+        self._dispatch_table = {}
         super_kwargs = {}
         trigger_keywords = self.BOOLEAN_TRIGGERS | self.INTEGER_TRIGGERS
         conditions = {}
@@ -241,6 +283,7 @@ class SimpleExtension(TrainingExtension):
 
         """
         self._conditions[:] = []
+        self._dispatch_table = {}
         predicates = {'before_first_epoch': has_done_epochs}
         conditions = {
             'before_first_epoch': 'before_epoch',
@@ -286,17 +329,33 @@ class SimpleExtension(TrainingExtension):
         -------
             The extension object (allow chaining calls)
 
+        Notes
+        -----
+        The conditions are indexed by the callback name, so that
+        :meth:`dispatch` only checks the predicates of the callback
+        invoked.
+
         """
+        if callback_name not in CallbackName.names:
+            raise TypeError("{} is not a valid callback.".format(
+                callback_name))
         if not arguments:
             arguments = []
         if not predicate:
-            self._conditions.append((callback_name, always_true,
-                                     arguments))
-        else:
-            self._conditions.append((callback_name, predicate,
-                                     arguments))
+            predicate = always_true
+        self._conditions.append((callback_name, predicate, arguments))
+        if self._dispatch_table is not None:
+            self._dispatch_table.setdefault(str(callback_name), []).append(
+                (predicate, tuple(arguments)))
         return self
 
+    def _index_conditions(self):
+        """Build the dispatch table from the conditions."""
+        self._dispatch_table = {}
+        for callback_name, predicate, arguments in self._conditions:
+            self._dispatch_table.setdefault(str(callback_name), []).append(
+                (predicate, tuple(arguments)))
+
     @abstractmethod
     def do(self, which_callback, *args):
         r"""Does the job of the training extension.
@@ -324,10 +383,15 @@ class SimpleExtension(TrainingExtension):
             at the same time and do something.
 
         """
-        for callback_name, predicate, arguments in self._conditions:
-            if (callback_name == callback_invoked and
-                    predicate(self.main_loop.log)):
-                self.do(callback_invoked, *(from_main_loop + tuple(arguments)))
+        if self._dispatch_table is None:
+            self._index_conditions()
+        conditions = self._dispatch_table.get(callback_invoked)
+        if not conditions:
+            return
+        log = self.main_loop.log
+        for predicate, arguments in conditions:
+            if predicate(log):
+                self.do(callback_invoked, *(from_main_loop + arguments))
 
     @staticmethod
     def parse_args(which_callback, args):
@@ -368,6 +432,8 @@ class FinishAfter(SimpleExtension):
 
 class Printing(SimpleExtension):
     """Prints log messages to the screen."""
+    critical = False
+
     def __init__(self, **kwargs):
         kwargs.setdefault("before_first_epoch", True)
         kwargs.setdefault("on_resumption", True)
@@ -426,6 +492,8 @@ class ProgressBar(TrainingExtension):
     terminal.
 
     """
+    critical = False
+
     def __init__(self, **kwargs):
         super(ProgressBar, self).__init__(**kwargs)
         self.bar = None
@@ -493,7 +561,11 @@ class ProgressBar(TrainingExtension):
             self.bar = self.create_bar()
             self.bar.start()
 
-        self.iter_count += 1
+        # Count from the log, as the main loop can skip the callbacks of
+        # non-critical extensions
+        epoch_ends = self.main_loop.status['_epoch_ends']
+        self.iter_count = (self.main_loop.status['iterations_done'] + 1 -
+                           (epoch_ends[-1] if epoch_ends else 0))
         self.bar.update(self.iter_count)
 
 
@@ -529,10 +601,11 @@ class Timing(SimpleExtension):
 
     def do(self, which_callback, *args):
         current_row = self.main_loop.log.current_row
-        profile = self.main_loop.profile.total
+        profile = self.main_loop.profile
 
         if which_callback == 'before_epoch':
-            current_row['time_initialization'] = profile[('initialization',)]
+            current_row['time_initialization'] = profile.get_total(
+                ('initialization',))
             return
         if which_callback == 'after_batch':
             level = 'batch'
@@ -540,8 +613,95 @@ class Timing(SimpleExtension):
             level = 'epoch'
         for action in ['train', 'read_data']:
             self.previous[level][action] = self.current[level][action]
-            self.current[level][action] = profile['training', 'epoch', action]
+            self.current[level][action] = profile.get_total(
+                ('training', 'epoch', action))
             current_row['time_{}_this_{}'.format(action, level)] = \
                 self.current[level][action] - self.previous[level][action]
             current_row['time_{}_total'.format(action)] = \
                 self.current[level][action]
+
+
+class ProfileLogging(SimpleExtension):
+    """Write the profile of the main loop to the log.
+
+    Every time it is triggered, adds the following records to the log,
+    all computed over the period since the previous time:
+
+    * ``profile_<section>`` for every section of the main loop's
+      :class:`~blocks.utils.profile.Profile`, where ``<section>`` is the
+      path of the section joined by slashes, e.g.
+      ``profile_training/epoch/train``, with the time spent in the
+      section;
+    * ``profile_batches_per_second`` and ``profile_examples_per_second``
+      with the training throughput, where the number of examples in a
+      batch is the length of its first source;
+    * ``profile_data_wait_fraction`` with the fraction of the wall time
+      spent waiting for data.
+
+    Being ordinary log records, they can be printed, plotted live and
+    by ``blocks-plot``. Triggered after every epoch by default, use e.g.
+    `every_n_batches` for finer grained records.
+
+    Parameters
+    ----------
+    sections : list of tuples, optional
+        If given, only the records for these sections (given as tuples
+        of names, e.g. ``('training', 'epoch', 'train')``) are added.
+
+    Notes
+    -----
+    The profile is only precise if ``profile_every`` is 1, see
+    :class:`~blocks.utils.profile.Profile`. The first trigger after the
+    start or the resumption of training only records the starting point.
+
+    """
+    def __init__(self, sections=None, **kwargs):
+        kwargs.setdefault('after_epoch', True)
+        kwargs.setdefault('before_training', True)
+        kwargs.setdefault('on_resumption', True)
+        super(ProfileLogging, self).__init__(**kwargs)
+        self.sections = sections
+        self.examples = 0
+        self.previous = None
+
+    def dispatch(self, callback_invoked, *from_main_loop):
+        if callback_invoked == 'after_batch':
+            data = first(from_main_loop[0].values())
+            try:
+                self.examples += len(data)
+            except TypeError:
+                self.examples += 1
+        super(ProfileLogging, self).dispatch(callback_invoked,
+                                             *from_main_loop)
+
+    def do(self, which_callback, *args):
+        now = timeit.default_timer()
+        totals = self.main_loop.profile.total
+        current = (now, self.main_loop.status['iterations_done'],
+                   self.examples, totals)
+        if which_callback in ('before_training', 'on_resumption'):
+            self.previous = current
+            return
+        if self.previous is None:
+            self.previous = current
+            return
+        previous_time, previous_iterations, previous_examples, \
+            previous_totals = self.previous
+        self.previous = current
+        elapsed = now - previous_time
+        if elapsed <= 0:
+            return
+
+        current_row = self.main_loop.log.current_row
+        for key, total in totals.items():
+            if self.sections is None or key in self.sections:
+                current_row['profile_' + '/'.join(key)] = (
+                    total - previous_totals.get(key, 0))
+        current_row['profile_batches_per_second'] = (
+            (current[1] - previous_iterations) / elapsed)
+        current_row['profile_examples_per_second'] = (
+            (current[2] - previous_examples) / elapsed)
+        read_data = ('training', 'epoch', 'read_data')
+        current_row['profile_data_wait_fraction'] = (
+            (totals.get(read_data, 0) -
+             previous_totals.get(read_data, 0)) / elapsed)
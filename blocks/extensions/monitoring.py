@@ -4,6 +4,7 @@ import logging
 from blocks.extensions import SimpleExtension, TrainingExtension
 from blocks.algorithms import DifferentiableCostMinimizer
 from blocks.monitoring.evaluators import AggregationBuffer, DatasetEvaluator
+from blocks.monitoring.memory import memory_footprint
 
 PREFIX_SEPARATOR = '_'
 logger = logging.getLogger()
@@ -141,3 +142,33 @@ class TrainingDataMonitoring(SimpleExtension, MonitoringExtension):
             self.add_records(self.main_loop.log,
                              self._buffer.get_aggregated_values().items())
             self._buffer.initialize_aggregators()
+
+
+class MemoryLogging(SimpleExtension):
+    """Writes the memory footprint of the main loop to the log.
+
+    Adds a ``memory_<key>`` record with the size in bytes for every item
+    returned by :func:`~blocks.monitoring.memory.memory_footprint`, as
+    well as a ``memory_total`` record of the sizes available. Triggered
+    after every epoch by default.
+
+    Parameters
+    ----------
+    pickled_sizes : bool, optional
+        Whether to measure the sizes of the log and of the iteration
+        state by pickling them, which takes time proportional to their
+        size. ``False`` by default.
+
+    """
+    def __init__(self, pickled_sizes=False, **kwargs):
+        kwargs.setdefault("after_epoch", True)
+        super(MemoryLogging, self).__init__(**kwargs)
+        self.pickled_sizes = pickled_sizes
+
+    def do(self, which_callback, *args):
+        footprint = memory_footprint(self.main_loop, self.pickled_sizes)
+        current_row = self.main_loop.log.current_row
+        for key, size in footprint.items():
+            current_row['memory_' + key] = size
+        current_row['memory_total'] = sum(size for size in footprint.values()
+                                          if size is not None)
@@ -68,6 +68,8 @@ class Plot(SimpleExtension):
         ``http://localhost:5006/``.
 
     """
+    critical = False
+
     # Tableau 10 colors
     colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
               '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
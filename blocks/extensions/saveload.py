@@ -1,11 +1,13 @@
 """Extensions for saving and loading the state of a training process."""
+import os
 import os.path
 import logging
+from collections import OrderedDict
 
 from blocks.extensions import SimpleExtension, TrainingExtension
 from blocks.dump import MainLoopDumpManager
 from blocks.utils import reraise_as
-from blocks.serialization import secure_pickle_dump
+from blocks.serialization import ArrayStore, secure_pickle_dump
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +37,37 @@ class Checkpoint(SimpleExtension):
         the attribute name preceded by an underscore before the
         `path` extension. The whole main loop will still be pickled
         as usual.
+    keep_last : int, optional
+        If given, only the `keep_last` most recent checkpoints are kept.
+    keep_best : str, optional
+        The name of a log record. If given, the checkpoint with the best
+        value of this record at the time of saving is kept.
+    choose_best : callable, optional
+        A function that picks the best of two record values. :func:`min`
+        by default.
+    keep_every : int, optional
+        If given, every `keep_every`-th checkpoint is kept.
+    deduplicate : bool, optional
+        If ``True``, the arrays of the main loop (e.g. the parameter
+        values) are saved to an :class:`~blocks.serialization.ArrayStore`
+        in a folder named by adding ``_arrays`` to the root of `path`,
+        so that the arrays that did not change between the checkpoints
+        are stored only once. Such checkpoints have to be loaded with
+        :func:`blocks.serialization.load`. ``False`` by default.
+    compression : str, optional
+        The compression of the checkpoints, see
+        :func:`~blocks.serialization.secure_pickle_dump`.
+    fsync : str, optional
+        The fsync policy, see
+        :func:`~blocks.serialization.secure_pickle_dump`.
+    indexed : bool, optional
+        If ``True``, the log, the iteration state and, if the model
+        provides them, the parameter values are saved as separate
+        sections of an indexed checkpoint, so that tools can load them
+        without unpickling the whole main loop, see
+        :func:`blocks.serialization.load`. The pickled main loop refers
+        to the sections instead of storing them again. ``False`` by
+        default.
 
     Notes
     -----
@@ -46,17 +79,48 @@ class Checkpoint(SimpleExtension):
       (and vice-versa). Therefore using this extension binds you to using
       only one kind of device.
 
+    If any of `keep_last`, `keep_best` and `keep_every` is given, every
+    checkpoint is saved to a new file, whose name is formed by adding
+    the number of iterations done before the `path` extension, and the
+    checkpoints that are retained by none of these criteria are deleted
+    after the next checkpoint has been successfully saved. The most
+    recent checkpoint is always kept. Paths given by the user as
+    condition arguments (see :meth:`do`) are not subject to rotation.
 
     """
-    def __init__(self, path, save_separately=None, **kwargs):
+    def __init__(self, path, save_separately=None, keep_last=None,
+                 keep_best=None, choose_best=min, keep_every=None,
+                 deduplicate=False, compression=None, fsync=None,
+                 indexed=False, **kwargs):
         kwargs.setdefault("after_training", True)
         super(Checkpoint, self).__init__(**kwargs)
 
         self.path = path
         self.save_separately = save_separately
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.choose_best = choose_best
+        self.keep_every = keep_every
+        self.deduplicate = deduplicate
+        self.compression = compression
+        self.fsync = fsync
+        self.indexed = indexed
 
         if not self.save_separately:
             self.save_separately = []
+        for name in ['keep_last', 'keep_every']:
+            value = getattr(self, name)
+            if value is not None and value < 1:
+                raise ValueError("{} must be positive".format(name))
+        # Tuples of checkpoint number, path and the value of the
+        # `keep_best` record for the retained rotated checkpoints
+        self.checkpoints = []
+        self.checkpoints_made = 0
+
+    @property
+    def rotate(self):
+        return (self.keep_last is not None or self.keep_best is not None or
+                self.keep_every is not None)
 
     def save_separately_filenames(self, path):
         """Compute paths for separately saved attributes.
@@ -86,21 +150,106 @@ class Checkpoint(SimpleExtension):
 
         """
         from_main_loop, from_user = self.parse_args(callback_name, args)
+        checkpoints = self.checkpoints
+        checkpoints_made = self.checkpoints_made
+        dropped = []
         try:
             path = self.path
             if from_user:
                 path, = from_user
+            elif self.rotate:
+                path, dropped = self._rotate()
             already_saved_to = self.main_loop.log.current_row.get(SAVED_TO, ())
             self.main_loop.log.current_row[SAVED_TO] = (
                 already_saved_to + (path,))
-            secure_pickle_dump(self.main_loop, path)
+            array_store = self._array_store(path)
+            secure_pickle_dump(self.main_loop, path, array_store,
+                               self.compression, fsync=self.fsync,
+                               sections=self._sections())
             filenames = self.save_separately_filenames(path)
             for attribute in self.save_separately:
                 secure_pickle_dump(getattr(self.main_loop, attribute),
-                                   filenames[attribute])
+                                   filenames[attribute], array_store,
+                                   self.compression, fsync=self.fsync)
         except Exception:
+            self.checkpoints = checkpoints
+            self.checkpoints_made = checkpoints_made
             self.main_loop.log.current_row[SAVED_TO] = None
             raise
+        for dropped_path in dropped:
+            self._remove(dropped_path)
+        if array_store is not None:
+            array_store.collect_garbage()
+
+    def _sections(self):
+        if not self.indexed:
+            return None
+        sections = OrderedDict([
+            ('log', self.main_loop.log),
+            ('iteration_state', self.main_loop.iteration_state)])
+        model = getattr(self.main_loop, 'model', None)
+        if hasattr(model, 'get_params'):
+            # The arrays held by the shared variables are borrowed, so
+            # that the main loop refers to them instead of pickling them
+            sections['parameters'] = OrderedDict(
+                (name, parameter.get_value(borrow=True))
+                for name, parameter in model.get_params().items())
+        return sections
+
+    def _rotate(self):
+        """Choose the path of a new checkpoint and the ones to delete."""
+        self.checkpoints_made += 1
+        root, ext = os.path.splitext(self.path)
+        path = "{}_{}{}".format(
+            root, self.main_loop.status['iterations_done'], ext)
+        value = None
+        if self.keep_best is not None:
+            value = self.main_loop.log.current_row.get(self.keep_best)
+        checkpoints = [checkpoint for checkpoint in self.checkpoints
+                       if checkpoint[1] != path]
+        checkpoints.append((self.checkpoints_made, path, value))
+
+        retained = set([checkpoints[-1][0]])
+        if self.keep_last is not None:
+            retained.update(number for number, _, _
+                            in checkpoints[-self.keep_last:])
+        if self.keep_every is not None:
+            retained.update(number for number, _, _ in checkpoints
+                            if number % self.keep_every == 0)
+        if self.keep_best is not None:
+            best = None
+            for number, _, value in checkpoints:
+                if value is None:
+                    continue
+                if best is None or (value != best[1] and
+                                    self.choose_best(value, best[1]) ==
+                                    value):
+                    best = (number, value)
+            if best is not None:
+                retained.add(best[0])
+
+        self.checkpoints = [checkpoint for checkpoint in checkpoints
+                            if checkpoint[0] in retained]
+        return path, [checkpoint_path for number, checkpoint_path, _
+                      in checkpoints if number not in retained]
+
+    def _array_store(self, path):
+        if not self.deduplicate:
+            return None
+        # Checkpoints in the same folder share the store
+        if (os.path.dirname(os.path.abspath(path)) ==
+                os.path.dirname(os.path.abspath(self.path))):
+            path = self.path
+        return ArrayStore(os.path.splitext(path)[0] + "_arrays")
+
+    def _remove(self, path):
+        array_store = self._array_store(path)
+        paths = [path] + list(self.save_separately_filenames(path).values())
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+            if array_store is not None:
+                array_store.remove_references(os.path.basename(path))
 
 
 class LoadFromDump(TrainingExtension):
@@ -1,17 +1,25 @@
 """The event-based main loop of Blocks."""
 import signal
 import logging
+import timeit
 import traceback
 
 from blocks.config import config
 from blocks.log import TrainingLog
 from blocks.utils import reraise_as, unpack, change_recursion_limit
-from blocks.utils.profile import Profile, Timer
+from blocks.utils.profile import Profile, Timer, TraceRecorder
+from blocks.utils.theano_profile import TheanoProfiles
 from blocks.algorithms import DifferentiableCostMinimizer
 from blocks.extensions import CallbackName
 
 logger = logging.getLogger(__name__)
 
+# The number of iterations of a run after which the costs of the
+# extensions are compared with the budget
+EXTENSION_BUDGET_WARMUP = 10
+
+BATCH_CALLBACKS = ('before_batch', 'after_batch')
+
 error_message = """
 
 Blocks will attempt to run `on_error` extensions, potentially saving data, \
@@ -85,6 +93,16 @@ class MainLoop(object):
         Keeps track of the times spent in differen segments of the training
         loop.
 
+    Notes
+    -----
+    When the :option:`extension_budget` configuration is set, the time
+    spent in the callbacks of every extension during a call to :meth:`run`
+    is measured, and a warning is issued for the extensions that take more
+    than the given share of the training time. With
+    :option:`throttle_extensions` the batch callbacks of the non-critical
+    extensions over the budget are skipped, see
+    :attr:`.TrainingExtension.critical`.
+
     """
     def __init__(self, algorithm, data_stream,
                  model=None, log=None, extensions=None):
@@ -142,6 +160,20 @@ class MainLoop(object):
         # If this is resumption from a checkpoint, it is crucial to
         # reset `profile.current`. Otherwise, it simply does not hurt.
         self.profile.current = []
+        self.profile.end_iteration()
+        if config.profile_every < 1:
+            raise ValueError("profile_every must be positive")
+        self.profile.sample_every = config.profile_every
+        if config.profile_trace and self.profile.trace is None:
+            self.profile.trace = TraceRecorder()
+
+        # The costs of the extensions are only compared within a run
+        self._extension_budget = config.extension_budget
+        self._throttle_extensions = config.throttle_extensions
+        self._extension_costs = [0.] * len(self.extensions)
+        self._extensions_warned = set()
+        self._run_started = timeit.default_timer()
+        self._run_iterations_started = self.status['iterations_done']
 
         if self._model and isinstance(self.algorithm,
                                       DifferentiableCostMinimizer):
@@ -158,6 +190,8 @@ class MainLoop(object):
                 signal.SIGINT, self._handle_epoch_interrupt)
             self.original_sigterm_handler = signal.signal(
                 signal.SIGTERM, self._handle_batch_interrupt)
+            # The profiles of the Theano functions during this run
+            theano_profiles = TheanoProfiles().start()
             try:
                 logger.info("Entered the main loop")
                 if not self.status['training_started']:
@@ -195,6 +229,11 @@ class MainLoop(object):
                     self._run_extensions('after_training')
                 if config.profile:
                     self.profile.report()
+                theano_profiles.stop()
+                if config.profile_theano:
+                    theano_profiles.report()
+                if config.profile_trace:
+                    self.profile.trace.write(config.profile_trace)
                 self._restore_signal_handlers()
 
     def find_extension(self, name):
@@ -234,10 +273,12 @@ class MainLoop(object):
         return True
 
     def _run_iteration(self):
+        self.profile.begin_iteration(self.status['iterations_done'])
         try:
             with Timer('read_data', self.profile):
                 batch = next(self.epoch_iterator)
         except StopIteration:
+            self.profile.end_iteration()
             if not self.log.status['received_first_batch']:
                 reraise_as(ValueError("epoch iterator yielded zero batches"))
             return False
@@ -247,14 +288,60 @@ class MainLoop(object):
             self.algorithm.process_batch(batch)
         self.status['iterations_done'] += 1
         self._run_extensions('after_batch', batch)
+        self.profile.end_iteration()
         self._check_finish_training('batch')
         return True
 
     def _run_extensions(self, method_name, *args):
+        budget = self._extension_budget
         with Timer(method_name, self.profile):
-            for extension in self.extensions:
+            for i, extension in enumerate(self.extensions):
+                if budget > 0 and self._over_budget(i, method_name):
+                    continue
                 with Timer(type(extension).__name__, self.profile):
+                    start = timeit.default_timer()
                     extension.dispatch(CallbackName(method_name), *args)
+                    if budget > 0:
+                        self._extension_costs[i] += (timeit.default_timer() -
+                                                     start)
+
+    def _over_budget(self, index, method_name):
+        """Check the share of the training time taken by an extension.
+
+        Parameters
+        ----------
+        index : int
+            The index of the extension in :attr:`extensions`.
+        method_name : str
+            The callback about to be dispatched.
+
+        Returns
+        -------
+        bool
+            ``True`` if the callback should be skipped, which only happens
+            for the batch callbacks of non-critical extensions when
+            throttling is enabled.
+
+        """
+        iterations = (self.status['iterations_done'] -
+                      self._run_iterations_started)
+        if iterations < EXTENSION_BUDGET_WARMUP:
+            return False
+        elapsed = timeit.default_timer() - self._run_started
+        share = self._extension_costs[index] / elapsed
+        if share <= self._extension_budget:
+            return False
+        extension = self.extensions[index]
+        if index not in self._extensions_warned:
+            self._extensions_warned.add(index)
+            logger.warning("extension {} takes {:.1%} of the training time, "
+                           "more than the budget of {:.1%}{}".format(
+                               extension.name, share, self._extension_budget,
+                               ", its batch callbacks will be throttled"
+                               if self._throttle_extensions and
+                               not extension.critical else ""))
+        return (self._throttle_extensions and not extension.critical and
+                method_name in BATCH_CALLBACKS)
 
     def _check_finish_training(self, level):
         """Checks whether the current training should be terminated.
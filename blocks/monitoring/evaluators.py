@@ -2,7 +2,6 @@ from collections import OrderedDict
 import logging
 
 from picklable_itertools.extras import equizip
-import theano
 from theano import tensor
 
 from blocks.utils import dict_subset
@@ -10,6 +9,7 @@ from blocks.monitoring.aggregation import (_DataIndependent, Mean,
                                            TakeLast, MonitoredQuantity)
 from blocks.graph import ComputationGraph
 from blocks.utils import reraise_as
+from blocks.utils.theano_profile import theano_function
 
 logger = logging.getLogger()
 
@@ -162,8 +162,9 @@ class AggregationBuffer(object):
         """
         logger.debug("Compiling initialization and readout functions")
         if self.initialization_updates:
-            self._initialize_fun = theano.function(
-                [], [], updates=self.initialization_updates)
+            self._initialize_fun = theano_function(
+                'AggregationBuffer.initialize', [], [],
+                updates=self.initialization_updates)
         else:
             self._initialize_fun = None
 
@@ -171,9 +172,10 @@ class AggregationBuffer(object):
         # to avoid returning `CudaNdarray`s to the user, which
         # happens otherwise under some circumstances (see
         # https://groups.google.com/forum/#!topic/theano-users/H3vkDN-Shok)
-        self._readout_fun = theano.function(
-            [], [tensor.as_tensor_variable(v)
-                 for v in self.readout_variables.values()])
+        self._readout_fun = theano_function(
+            'AggregationBuffer.readout', [],
+            [tensor.as_tensor_variable(v)
+             for v in self.readout_variables.values()])
         logger.debug("Initialization and readout functions compiled")
 
     def initialize_aggregators(self):
@@ -270,9 +272,9 @@ class DatasetEvaluator(object):
 
         if inputs != []:
             self.unique_inputs = list(set(inputs))
-            self._accumulate_fun = theano.function(self.unique_inputs,
-                                                   outputs,
-                                                   updates=updates)
+            self._accumulate_fun = theano_function(
+                'DatasetEvaluator.accumulate', self.unique_inputs, outputs,
+                updates=updates)
         else:
             self._accumulate_fun = None
 
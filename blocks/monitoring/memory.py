@@ -0,0 +1,118 @@
+"""Accounting of the memory held by a main loop."""
+import logging
+from collections import OrderedDict
+from pickle import HIGHEST_PROTOCOL
+
+import numpy
+from six.moves import cPickle
+
+from blocks.monitoring.evaluators import AggregationBuffer, DatasetEvaluator
+
+logger = logging.getLogger(__name__)
+
+
+class _SizeCounter(object):
+    """A file-like object that only counts the bytes written to it."""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def shared_variable_size(variable):
+    """Return the number of bytes held by a shared variable.
+
+    Works for the values stored on the GPU too, without transferring
+    them.
+
+    """
+    value = variable.get_value(borrow=True, return_internal_type=True)
+    return int(numpy.prod(value.shape)) * numpy.dtype(variable.dtype).itemsize
+
+
+def pickled_size(object_):
+    """Return the size of an object when pickled, in bytes.
+
+    The object is pickled to a counter, so no memory is allocated for
+    the pickle.
+
+    Returns
+    -------
+    The size in bytes, or ``None`` if the object can not be pickled.
+
+    """
+    counter = _SizeCounter()
+    try:
+        cPickle.dump(object_, counter, protocol=HIGHEST_PROTOCOL)
+    except Exception as e:
+        logger.debug("could not measure the pickled size of {}: {}"
+                     .format(type(object_).__name__, e))
+        return None
+    return counter.size
+
+
+def _aggregation_buffers(extension):
+    for value in vars(extension).values():
+        if isinstance(value, AggregationBuffer):
+            yield value
+        elif isinstance(value, DatasetEvaluator):
+            yield value.theano_buffer
+
+
+def memory_footprint(main_loop, pickled_sizes=False):
+    """Account for the memory held by a main loop.
+
+    Reports the bytes held by
+
+    * the parameters of the model, grouped by the path of their brick
+      (``parameters/<path>``), if the main loop has a model;
+    * the state of the step rule of the training algorithm
+      (``step_rule``), if it has one;
+    * the aggregation buffers of the monitoring extensions
+      (``aggregation_buffers/<extension name>``);
+    * if `pickled_sizes` is ``True``, the training log (``log``) and the
+      iteration state (``iteration_state``), measured by the size of
+      their pickles.
+
+    Parameters
+    ----------
+    main_loop : :class:`.MainLoop`
+        The main loop.
+    pickled_sizes : bool, optional
+        Whether to measure the log and the iteration state. Pickling them
+        takes time proportional to their size, so this is ``False`` by
+        default.
+
+    Returns
+    -------
+    footprint : :class:`~collections.OrderedDict`
+        A dictionary of sizes in bytes. The sizes of the objects which
+        could not be pickled, e.g. some data streams, are ``None``.
+
+    """
+    footprint = OrderedDict()
+    model = getattr(main_loop, 'model', None)
+    if hasattr(model, 'get_params'):
+        for name, param in model.get_params().items():
+            # Brick parameters are named <brick path>.<parameter name>
+            path = name.rsplit('.', 1)[0] if '/' in name else name
+            key = 'parameters/' + path.lstrip('/')
+            footprint[key] = (footprint.get(key, 0) +
+                              shared_variable_size(param))
+    step_rule_updates = getattr(main_loop.algorithm, 'step_rule_updates',
+                                None)
+    if step_rule_updates:
+        footprint['step_rule'] = sum(shared_variable_size(variable)
+                                     for variable, _ in step_rule_updates)
+    for extension in main_loop.extensions:
+        for buffer_ in _aggregation_buffers(extension):
+            key = 'aggregation_buffers/' + extension.name
+            footprint[key] = footprint.get(key, 0) + sum(
+                shared_variable_size(variable)
+                for variable, _ in buffer_.accumulation_updates)
+    if pickled_sizes:
+        footprint['log'] = pickled_size(main_loop.log)
+        footprint['iteration_state'] = pickled_size(
+            main_loop.iteration_state)
+    return footprint
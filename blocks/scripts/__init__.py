@@ -1,15 +1,14 @@
 import os.path
 
-from six.moves import cPickle
-
 from blocks.config import config
 from blocks.dump import MainLoopDumpManager
+from blocks.serialization import load, read_section_index
 from blocks.utils import change_recursion_limit
 
 
 def continue_training(path):
     with change_recursion_limit(config.recursion_limit):
-        main_loop = cPickle.load(open(path, "rb"))
+        main_loop = load(path)
     main_loop.run()
 
 
@@ -19,6 +18,15 @@ def dump(pickle_path, dump_path):
         if not ext:
             raise ValueError
         dump_path = root
+    manager = MainLoopDumpManager(dump_path)
+    index = read_section_index(pickle_path)
     with change_recursion_limit(config.recursion_limit):
-        main_loop = cPickle.load(open(pickle_path, "rb"))
-    MainLoopDumpManager(dump_path).dump(main_loop)
+        # Indexed checkpoints allow to skip unpickling the main loop
+        if index is not None and all(
+                section in index for section in
+                ['parameters', 'iteration_state', 'log']):
+            manager.save(load(pickle_path, 'parameters'),
+                         load(pickle_path, 'iteration_state'),
+                         load(pickle_path, 'log'))
+        else:
+            manager.dump(load(pickle_path))
@@ -4,7 +4,6 @@ from __future__ import division, print_function
 import fnmatch
 
 from six import iteritems
-from six.moves import cPickle
 from collections import OrderedDict
 from functools import reduce
 
@@ -12,6 +11,7 @@ from blocks.config import config
 from blocks.utils import change_recursion_limit
 from blocks.log import TrainingLog
 from blocks.main_loop import MainLoop
+from blocks.serialization import load, read_section_index
 
 try:
     from pandas import DataFrame
@@ -26,11 +26,15 @@ def load_log(fname):
     This function automatically handles various file formats that contain
     an instance of an :class:`TrainingLog`. This includes a pickled
     Log object, a pickled :class:`MainLoop` or an experiment dump (TODO).
+    From indexed checkpoints only the log is loaded.
 
     """
+    index = read_section_index(fname)
     with change_recursion_limit(config.recursion_limit):
-        with open(fname, 'rb') as f:
-            from_disk = cPickle.load(f)
+        if index is not None and 'log' in index:
+            from_disk = load(fname, 'log')
+        else:
+            from_disk = load(fname)
         # TODO: Load "dumped" experiments
 
     if isinstance(from_disk, TrainingLog):
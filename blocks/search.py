@@ -1,15 +1,33 @@
-"""The beam search module."""
+"""Searching and generating sequences with a sequence generator."""
+import hashlib
+import threading
 from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
 from six.moves import range
 
 import numpy
+import theano
 from picklable_itertools.extras import equizip
-from theano import config, function, tensor
+from theano import tensor
 
 from blocks.bricks.sequence_generators import BaseSequenceGenerator
+from blocks.config import config
 from blocks.filter import VariableFilter, get_application_call, get_brick
 from blocks.graph import ComputationGraph
 from blocks.roles import INPUT, OUTPUT
+from blocks.utils.theano_profile import theano_function
+
+# The compiled functions of the beam searches for every sampled outputs
+# variable. They do not depend on the beam size, so all the searches for
+# the same outputs can share them. A compiled Theano function keeps its
+# inputs and outputs in its own storage, so the calls are serialized with
+# a lock shared along with the functions.
+compiled_functions = WeakKeyDictionary()
+
+COMPILED_ATTRIBUTES = ['context_computer', 'initial_state_computer',
+                       'next_state_computer', 'logprobs_computer',
+                       'step_computer', 'function_lock']
 
 
 class BeamSearch(object):
@@ -26,7 +44,20 @@ class BeamSearch(object):
 
     The beam search compiles quite a few Theano functions under the hood.
     Normally those are compiled at the first :meth:`search` call, but
-    you can also explicitly call :meth:`compile`.
+    you can also explicitly call :meth:`compile`. The compiled functions
+    are cached in :data:`compiled_functions` and shared by all the beam
+    searches for the same `samples`, whatever their beam size, so creating
+    a new :class:`BeamSearch` or changing `beam_size` does not recompile
+    them. The state of a search is kept in the :class:`BeamSearch` object,
+    so different objects can search at the same time in different
+    threads, but a single object must not. Use :meth:`search_batch`
+    to search for the outputs of many inputs at once.
+
+    When `context_cache_size` is given, the contexts and the initial
+    states computed for the inputs of a search are kept in a
+    :class:`ContextCache`, so that searching again for the same inputs,
+    e.g. with another beam size or maximum length, does not run the
+    encoder again.
 
     Parameters
     ----------
@@ -36,6 +67,15 @@ class BeamSearch(object):
         An output of a sampling computation graph built by
         :meth:`~blocks.brick.SequenceGenerator.generate`, the one
         corresponding to sampled sequences.
+    context_cache_size : int, optional
+        The maximum size in bytes of the cached contexts and initial
+        states. By default nothing is cached.
+
+    Attributes
+    ----------
+    context_cache : :class:`ContextCache`
+        The cache of the contexts and the initial states, ``None`` if
+        `context_cache_size` was not given.
 
     See Also
     --------
@@ -51,8 +91,12 @@ class BeamSearch(object):
     to work).
 
     """
-    def __init__(self, beam_size, samples):
+    def __init__(self, beam_size, samples, context_cache_size=None):
         self.beam_size = beam_size
+        self.samples = samples
+        self.context_cache = None
+        if context_cache_size:
+            self.context_cache = ContextCache(context_cache_size)
 
         # Extracting information from the sampling computation graph
         cg = ComputationGraph(samples)
@@ -91,19 +135,23 @@ class BeamSearch(object):
         self.compiled = False
 
     def _compile_context_computer(self):
-        self.context_computer = function(
-            self.inputs, self.contexts, on_unused_input='ignore')
+        self.context_computer = theano_function(
+            'BeamSearch.context_computer', self.inputs, self.contexts,
+            on_unused_input='ignore')
 
     def _compile_initial_state_computer(self):
+        batch_size = tensor.lscalar('batch_size')
         initial_states = [
             self.generator.initial_state(
-                name, self.beam_size,
+                name, batch_size,
                 **dict(equizip(self.context_names, self.contexts)))
             for name in self.state_names]
-        self.initial_state_computer = function(
-            self.contexts, initial_states, on_unused_input='ignore')
+        self.initial_state_computer = theano_function(
+            'BeamSearch.initial_state_computer',
+            self.contexts + [batch_size], initial_states,
+            on_unused_input='ignore')
 
-    def _compile_next_state_computer(self):
+    def _next_states(self):
         next_states = [VariableFilter(bricks=[self.generator],
                                       name=name,
                                       roles=[OUTPUT])(self.inner_cg)[-1]
@@ -111,27 +159,68 @@ class BeamSearch(object):
         next_outputs = VariableFilter(
             applications=[self.generator.readout.emit], roles=[OUTPUT])(
                 self.inner_cg.variables)
-        self.next_state_computer = function(
-            self.contexts + self.input_states + next_outputs, next_states)
+        return next_states, next_outputs
 
-    def _compile_logprobs_computer(self):
+    def _logprobs(self):
         # This filtering should return identical variables
         # (in terms of computations) variables, and we do not care
         # which to use.
         probs = VariableFilter(
             applications=[self.generator.readout.emitter.probs],
             roles=[OUTPUT])(self.inner_cg)[0]
-        logprobs = -tensor.log(probs)
-        self.logprobs_computer = function(
-            self.contexts + self.input_states, logprobs,
+        return -tensor.log(probs)
+
+    def _compile_next_state_computer(self):
+        next_states, next_outputs = self._next_states()
+        self.next_state_computer = theano_function(
+            'BeamSearch.next_state_computer',
+            self.contexts + self.input_states + next_outputs, next_states)
+
+    def _compile_logprobs_computer(self):
+        self.logprobs_computer = theano_function(
+            'BeamSearch.logprobs_computer',
+            self.contexts + self.input_states, self._logprobs(),
             on_unused_input='ignore')
 
+    def _compile_step_computer(self):
+        next_states, next_outputs = self._next_states()
+        # Cloning copies the whole graph, so the inputs of the function are
+        # replaced with new variables
+        contexts = [context.type(context.name) for context in self.contexts]
+        inputs = [variable.type(variable.name) for variable
+                  in self.input_states + next_outputs]
+        replacements = list(equizip(self.contexts, contexts))
+        next_states = theano.clone(
+            next_states, replace=replacements + list(
+                equizip(self.input_states + next_outputs, inputs)))
+        next_input_states = [next_states[self.state_names.index(name)]
+                             for name in self.input_state_names]
+        next_logprobs = theano.clone(
+            self._logprobs(), replace=replacements + list(
+                equizip(self.input_states, next_input_states)))
+        self.step_computer = theano_function(
+            'BeamSearch.step_computer', contexts + inputs,
+            next_states + [next_logprobs], on_unused_input='ignore')
+
     def compile(self):
-        """Compile all Theano functions used."""
-        self._compile_context_computer()
-        self._compile_initial_state_computer()
-        self._compile_next_state_computer()
-        self._compile_logprobs_computer()
+        """Compile all Theano functions used.
+
+        If the functions for the same `samples` were already compiled,
+        they are taken from the cache.
+
+        """
+        if self.samples in compiled_functions:
+            for name, value in compiled_functions[self.samples].items():
+                setattr(self, name, value)
+        else:
+            self._compile_context_computer()
+            self._compile_initial_state_computer()
+            self._compile_next_state_computer()
+            self._compile_logprobs_computer()
+            self._compile_step_computer()
+            self.function_lock = threading.Lock()
+            compiled_functions[self.samples] = dict(
+                (name, getattr(self, name)) for name in COMPILED_ATTRIBUTES)
         self.compiled = True
 
     def compute_contexts(self, inputs):
@@ -148,17 +237,20 @@ class BeamSearch(object):
         like `self.context_names`.
 
         """
-        contexts = self.context_computer(*[inputs[var]
-                                           for var in self.inputs])
+        with self.function_lock:
+            contexts = self.context_computer(*[inputs[var]
+                                               for var in self.inputs])
         return OrderedDict(equizip(self.context_names, contexts))
 
-    def compute_initial_states(self, contexts):
+    def compute_initial_states(self, contexts, batch_size=None):
         """Computes initial states.
 
         Parameters
         ----------
         contexts : dict
             A {name: :class:`numpy.ndarray`} dictionary of contexts.
+        batch_size : int, optional
+            The number of hypotheses, `beam_size` by default.
 
         Returns
         -------
@@ -166,9 +258,86 @@ class BeamSearch(object):
         `self.state_names`.
 
         """
-        init_states = self.initial_state_computer(*list(contexts.values()))
+        if batch_size is None:
+            batch_size = self.beam_size
+        with self.function_lock:
+            init_states = self.initial_state_computer(
+                *(list(contexts.values()) + [batch_size]))
         return OrderedDict(equizip(self.state_names, init_states))
 
+    def _cached(self, key, compute):
+        """Look a dictionary of arrays up in the context cache.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the arrays, whose first element identifies the
+            inputs.
+        compute : callable
+            Computes the arrays when they are not cached.
+
+        Returns
+        -------
+        A new dictionary of the arrays, which the caller may change.
+
+        """
+        if self.context_cache is None:
+            return compute()
+        value = self.context_cache.get(key)
+        if value is None:
+            value = compute()
+            self.context_cache.put(key, value)
+        return OrderedDict(value)
+
+    def _prepare(self, input_values, repeats=1, batch_axis=1):
+        """Compute the contexts and the initial states of a search.
+
+        Parameters
+        ----------
+        input_values : dict
+            A {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionary of input values.
+        repeats : int, optional
+            The number of hypotheses of every input. If greater than 1,
+            the contexts are repeated along their batch axis, or computed
+            from inputs repeated along `batch_axis` when this axis is
+            ambiguous.
+        batch_axis : int, optional
+            The batch axis of the inputs.
+
+        Returns
+        -------
+        A (contexts, states) pair of dictionaries of arrays.
+
+        """
+        key = None
+        if self.context_cache is not None:
+            key = self.context_cache.key(
+                [input_values[variable] for variable in self.inputs])
+        contexts = self._cached(
+            (key, 'contexts'), lambda: self.compute_contexts(input_values))
+        num_hypotheses = self.beam_size
+        if repeats > 1:
+            num_inputs = input_values[self.inputs[0]].shape[batch_axis]
+            num_hypotheses = num_inputs * repeats
+            axes = self._context_batch_axes(contexts, num_inputs)
+            if axes is None:
+                contexts = self._cached(
+                    (key, 'contexts', repeats, batch_axis),
+                    lambda: self.compute_contexts(dict(
+                        (variable, numpy.repeat(value, repeats,
+                                                axis=batch_axis))
+                        for variable, value in input_values.items())))
+            else:
+                contexts = OrderedDict(
+                    (name, numpy.repeat(value, repeats, axis=axis))
+                    for (name, value), axis in equizip(contexts.items(),
+                                                       axes))
+        states = self._cached(
+            (key, 'states', num_hypotheses, repeats, batch_axis),
+            lambda: self.compute_initial_states(contexts, num_hypotheses))
+        return contexts, states
+
     def compute_logprobs(self, contexts, states):
         """Compute log probabilities of all possible outputs.
 
@@ -186,8 +355,9 @@ class BeamSearch(object):
 
         """
         input_states = [states[name] for name in self.input_state_names]
-        return self.logprobs_computer(*(list(contexts.values()) +
-                                      input_states))
+        with self.function_lock:
+            return self.logprobs_computer(*(list(contexts.values()) +
+                                          input_states))
 
     def compute_next_states(self, contexts, states, outputs):
         """Computes next states.
@@ -207,10 +377,50 @@ class BeamSearch(object):
 
         """
         input_states = [states[name] for name in self.input_state_names]
-        next_values = self.next_state_computer(*(list(contexts.values()) +
-                                                 input_states + [outputs]))
+        with self.function_lock:
+            next_values = self.next_state_computer(
+                *(list(contexts.values()) + input_states + [outputs]))
         return OrderedDict(equizip(self.state_names, next_values))
 
+    def set_contexts(self, contexts):
+        """Sets the contexts used by :meth:`compute_step`.
+
+        Parameters
+        ----------
+        contexts : dict
+            A {name: :class:`numpy.ndarray`} dictionary of contexts.
+
+        """
+        self.step_contexts = list(contexts.values())
+
+    def compute_step(self, states, outputs):
+        """Computes next states and their log probabilities of outputs.
+
+        Does the work of :meth:`compute_next_states` followed by
+        :meth:`compute_logprobs` in a single call of a compiled function,
+        using the contexts given to :meth:`set_contexts`.
+
+        Parameters
+        ----------
+        states : dict
+            A {name: :class:`numpy.ndarray`} dictionary of states.
+        outputs : :class:`numpy.ndarray`
+            A :class:`numpy.ndarray` of this step outputs.
+
+        Returns
+        -------
+        next_states : dict
+            A {name: :class:`numpy.ndarray`} dictionary of next states.
+        logprobs : :class:`numpy.ndarray`
+            The log probabilities of the outputs for the next states.
+
+        """
+        input_states = [states[name] for name in self.input_state_names]
+        with self.function_lock:
+            values = self.step_computer(
+                *(self.step_contexts + input_states + [outputs]))
+        return OrderedDict(equizip(self.state_names, values[:-1])), values[-1]
+
     @staticmethod
     def _smallest(matrix, k, only_first_row=False):
         """Find k smallest elements of a matrix.
@@ -237,8 +447,42 @@ class BeamSearch(object):
         args = args[numpy.argsort(flatten[args])]
         return numpy.unravel_index(args, matrix.shape), flatten[args]
 
+    @staticmethod
+    def _smallest_per_beam(costs, only_first_row=False):
+        """Find the best continuations of several beams.
+
+        Parameters
+        ----------
+        costs : :class:`numpy.ndarray`
+            A (number of beams, beam size, number of outputs) array of
+            the costs of all continuations.
+        only_first_row : bool, optional
+            Consider only the continuations of the first hypothesis of
+            every beam.
+
+        Returns
+        -------
+        Tuple of ((hypotheses, outputs), values), each of which is
+        a vector of (number of beams * beam size) elements. The
+        hypotheses are indices in the flattened beams, and the
+        continuations of every beam are sorted by increasing cost.
+
+        """
+        num_beams, beam_size, num_outputs = costs.shape
+        if only_first_row:
+            flatten = costs[:, 0, :]
+        else:
+            flatten = costs.reshape((num_beams, beam_size * num_outputs))
+        rows = numpy.arange(num_beams)[:, None]
+        args = numpy.argpartition(flatten, beam_size, axis=1)[:, :beam_size]
+        args = args[rows, numpy.argsort(flatten[rows, args], axis=1)]
+        hypotheses = rows * beam_size + args // num_outputs
+        return ((hypotheses.flatten(), (args % num_outputs).flatten()),
+                flatten[rows, args].flatten())
+
     def search(self, input_values, eol_symbol, max_length,
-               ignore_first_eol=False, as_arrays=False):
+               ignore_first_eol=False, as_arrays=False,
+               early_stopping=False, length_normalization=0.):
         """Performs beam search.
 
         If the beam search was not compiled, it also compiles it.
@@ -266,6 +510,18 @@ class BeamSearch(object):
             If ``True``, the internal representation of search results
             is returned, that is a (matrix of outputs, mask,
             costs of all generated outputs) tuple.
+        early_stopping : bool, optional
+            If ``True``, the finished hypotheses are kept even when they
+            fall out of the beam, and the search stops as soon as
+            `beam_size` of them are found and none of the unfinished ones
+            can get a lower cost than the worst of them. The best
+            `beam_size` finished hypotheses are returned, completed with
+            the best unfinished ones if `max_length` is reached before.
+        length_normalization : float, optional
+            If positive, the hypotheses are ordered by their cost divided
+            by their length to the power of this number, e.g. 1 for the
+            average cost per output. The costs returned are still the
+            total ones. 0 by default.
 
         Returns
         -------
@@ -280,61 +536,779 @@ class BeamSearch(object):
         if not self.compiled:
             self.compile()
 
-        contexts = self.compute_contexts(input_values)
-        states = self.compute_initial_states(contexts)
+        contexts, states = self._prepare(input_values)
+        result = self._search(contexts, states, 1, eol_symbol, max_length,
+                              ignore_first_eol, early_stopping,
+                              length_normalization)
+        if as_arrays:
+            return result
+        return self.result_to_lists(result)
+
+    def search_batch(self, input_values, eol_symbol, max_length,
+                     ignore_first_eol=False, as_arrays=False,
+                     early_stopping=False, length_normalization=0.,
+                     batch_axis=1):
+        """Performs beam search for several inputs at once.
+
+        The beams of all the inputs are searched together, as a single
+        batch of (number of inputs * `beam_size`) hypotheses.
+
+        Parameters
+        ----------
+        input_values : dict
+            A {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionary of input values. Unlike in :meth:`search`, the
+            inputs should *not* be duplicated, their shapes should be the
+            same as if you ran sampling with a batch of the inputs.
+        eol_symbol : int
+            End of sequence symbol.
+        max_length : int
+            Maximum sequence length.
+        ignore_first_eol : bool, optional
+            See :meth:`search`.
+        as_arrays : bool, optional
+            If ``True``, the outputs, the mask and the costs are returned
+            as arrays of the (length, number of inputs, `beam_size`)
+            shape.
+        early_stopping : bool, optional
+            See :meth:`search`, applies to the beam of every input.
+        length_normalization : float, optional
+            See :meth:`search`.
+        batch_axis : int, optional
+            The axis of the input arrays along which the inputs are
+            stacked, 1 by default as in the time-major sequences used by
+            Blocks.
+
+        Returns
+        -------
+        A list with the (outputs, costs) pair returned by :meth:`search`
+        for every input.
+
+        """
+        if not self.compiled:
+            self.compile()
+
+        num_inputs = None
+        for value in input_values.values():
+            if num_inputs is None:
+                num_inputs = value.shape[batch_axis]
+            elif value.shape[batch_axis] != num_inputs:
+                raise ValueError("inputs with different batch sizes")
+        contexts, states = self._prepare(input_values, self.beam_size,
+                                         batch_axis)
+        result = self._search(contexts, states, num_inputs, eol_symbol,
+                              max_length, ignore_first_eol, early_stopping,
+                              length_normalization)
+        result = [array.reshape((array.shape[0], num_inputs,
+                                 self.beam_size))
+                  for array in result]
+        if as_arrays:
+            return tuple(result)
+        return [self.result_to_lists([array[:, i] for array in result])
+                for i in range(num_inputs)]
 
-        # This array will store all generated outputs, including those from
-        # previous step and those from already finished sequences.
-        all_outputs = states['outputs'][None, :]
-        all_masks = numpy.ones_like(all_outputs, dtype=config.floatX)
-        all_costs = numpy.zeros_like(all_outputs, dtype=config.floatX)
+    def _search(self, contexts, states, num_beams, eol_symbol, max_length,
+                ignore_first_eol, early_stopping, length_normalization):
+        """Search the beams of consecutive hypotheses.
 
+        Returns
+        -------
+        A (outputs, mask, costs) tuple of (length, `num_beams` *
+        `beam_size`) arrays.
+
+        """
+        num_hypotheses = num_beams * self.beam_size
+
+        # These arrays store the outputs, the masks and the accumulated
+        # costs of every step, including those of already finished
+        # sequences, in the order of the beam at that step. The
+        # backpointers give the position in the previous step of the
+        # prefix every hypothesis continues. The histories are only
+        # rearranged once, at the end of the search.
+        all_outputs = numpy.zeros((max_length + 1, num_hypotheses),
+                                  dtype=states['outputs'].dtype)
+        all_masks = numpy.zeros((max_length + 1, num_hypotheses),
+                                dtype=theano.config.floatX)
+        all_costs = numpy.zeros((max_length + 1, num_hypotheses),
+                                dtype=theano.config.floatX)
+        backpointers = numpy.zeros((max_length + 1, num_hypotheses),
+                                   dtype='int64')
+        lengths = numpy.zeros(num_hypotheses, dtype='int64')
+        all_outputs[0] = states['outputs']
+        all_masks[0] = 1
+
+        # The next states and the log probabilities are only computed for
+        # the active hypotheses, which requires to select the contexts of
+        # these hypotheses
+        batch_axes = self._context_batch_axes(contexts, num_hypotheses)
+        active = numpy.arange(num_hypotheses)
+        self.set_contexts(contexts)
+        logprobs = self.compute_logprobs(contexts, states)
+        steps = 0
+        # The step and the position in the beam at which every hypothesis
+        # finished, for the early stopping
+        finished_steps = numpy.zeros(0, dtype='int64')
+        finished_positions = numpy.zeros(0, dtype='int64')
         for i in range(max_length):
-            if all_masks[-1].sum() == 0:
+            if early_stopping and i > 0:
+                finished_scores = self._scores(
+                    all_costs[finished_steps, finished_positions],
+                    finished_steps, length_normalization)
+                self._stop_early(all_masks[i], all_costs[i], finished_scores,
+                                 finished_positions // self.beam_size,
+                                 num_beams, max_length, length_normalization)
+            if all_masks[i].sum() == 0:
                 break
 
             # We carefully hack values of the `logprobs` array to ensure
             # that all finished sequences are continued with `eos_symbol`.
-            logprobs = self.compute_logprobs(contexts, states)
-            next_costs = (all_costs[-1, :, None] +
-                          logprobs * all_masks[-1, :, None])
-            (finished,) = numpy.where(all_masks[-1] == 0)
+            next_costs = (all_costs[i, :, None] +
+                          logprobs * all_masks[i, :, None])
+            (finished,) = numpy.where(all_masks[i] == 0)
             next_costs[finished, :eol_symbol] = numpy.inf
             next_costs[finished, eol_symbol + 1:] = numpy.inf
 
             # The `i == 0` is required because at the first step the beam
             # size is effectively only 1.
-            (indexes, outputs), chosen_costs = self._smallest(
-                next_costs, self.beam_size, only_first_row=i == 0)
+            (indexes, outputs), chosen_costs = self._smallest_per_beam(
+                next_costs.reshape((num_beams, self.beam_size, -1)),
+                only_first_row=i == 0)
 
-            # Rearrange everything
+            # Rearrange the states only, the histories are followed
+            # through the backpointers
             for name in states:
                 states[name] = states[name][indexes]
-            all_outputs = all_outputs[:, indexes]
-            all_masks = all_masks[:, indexes]
-            all_costs = all_costs[:, indexes]
-
-            # Record chosen output and compute new states
-            states.update(self.compute_next_states(contexts, states, outputs))
-            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
-            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
-            mask = outputs != eol_symbol
+            backpointers[i + 1] = indexes
+            all_outputs[i + 1] = outputs
+            all_costs[i + 1] = chosen_costs
+            all_masks[i + 1] = outputs != eol_symbol
             if ignore_first_eol and i == 0:
-                mask[:] = 1
-            all_masks = numpy.vstack([all_masks, mask[None, :]])
+                all_masks[i + 1] = 1
+            if early_stopping:
+                (new_finished,) = numpy.where(
+                    (all_masks[i + 1] == 0) & (all_masks[i][indexes] == 1))
+                finished_steps = numpy.append(
+                    finished_steps, numpy.repeat(i + 1, len(new_finished)))
+                finished_positions = numpy.append(finished_positions,
+                                                  new_finished)
+            lengths = lengths[indexes] + all_masks[i][indexes]
+            steps = i + 1
+            if steps == max_length:
+                break
 
+            # Compute the new states of the active hypotheses and the log
+            # probabilities of their continuations
+            previous_active = active
+            if batch_axes is not None:
+                (active,) = numpy.where(all_masks[i + 1])
+            if not len(active):
+                break
+            if not numpy.array_equal(active // self.beam_size,
+                                     previous_active // self.beam_size):
+                self.set_contexts(OrderedDict(
+                    (name, value.take(active, axis=axis))
+                    for (name, value), axis
+                    in equizip(contexts.items(), batch_axes)))
+            next_states, active_logprobs = self.compute_step(
+                OrderedDict((name, value[active])
+                            for name, value in states.items()),
+                outputs[active])
+            for name, value in next_states.items():
+                states[name][active] = value
+            logprobs = numpy.zeros((num_hypotheses,
+                                    active_logprobs.shape[1]),
+                                   dtype=active_logprobs.dtype)
+            logprobs[active] = active_logprobs
+
+        if early_stopping:
+            end_steps, end_positions = self._best_finished(
+                finished_steps, finished_positions, all_masks[steps],
+                all_costs, lengths, steps, num_beams, length_normalization)
+            steps = end_steps.max()
+            all_outputs, all_masks, all_costs = self._backtrack(
+                backpointers[:steps + 1], all_outputs[:steps + 1],
+                all_masks[:steps + 1], all_costs[:steps + 1],
+                ends=(end_steps, end_positions))
+        else:
+            all_outputs, all_masks, all_costs = self._backtrack(
+                backpointers[:steps + 1], all_outputs[:steps + 1],
+                all_masks[:steps + 1], all_costs[:steps + 1])
         all_outputs = all_outputs[1:]
         all_masks = all_masks[:-1]
         all_costs = all_costs[1:] - all_costs[:-1]
-        result = all_outputs, all_masks, all_costs
-        if as_arrays:
-            return result
-        return self.result_to_lists(result)
+        if length_normalization:
+            order = self._normalized_order(all_masks, all_costs, num_beams,
+                                           length_normalization)
+            all_outputs, all_masks, all_costs = [
+                array[:, order] for array in (all_outputs, all_masks,
+                                              all_costs)]
+        return all_outputs, all_masks, all_costs
+
+    @staticmethod
+    def _context_batch_axes(contexts, num_hypotheses):
+        """Guess the batch axis of every context.
+
+        Returns
+        -------
+        A list with the only axis of every context whose size is the
+        number of hypotheses, or ``None`` if some context has no such axis
+        or several of them.
+
+        """
+        axes = []
+        for value in contexts.values():
+            candidates = [axis for axis, size in enumerate(value.shape)
+                          if size == num_hypotheses]
+            if len(candidates) != 1:
+                return None
+            axes.append(candidates[0])
+        return axes
+
+    @staticmethod
+    def _scores(costs, lengths, length_normalization):
+        """The costs divided by the lengths to the given power."""
+        return costs / numpy.maximum(lengths, 1) ** length_normalization
+
+    def _stop_early(self, mask, costs, finished_scores, finished_beams,
+                    num_beams, max_length, length_normalization):
+        """Finish the beams whose best hypotheses are final.
+
+        The active hypotheses of a beam are finished when `beam_size`
+        hypotheses of the beam are finished and none of the active ones
+        can get a lower (normalized) cost than the worst of them, since
+        the costs only grow with the length.
+
+        """
+        worst_scores = numpy.empty(num_beams)
+        worst_scores.fill(numpy.inf)
+        for beam in range(num_beams):
+            scores = finished_scores[finished_beams == beam]
+            if len(scores) >= self.beam_size:
+                worst_scores[beam] = numpy.partition(
+                    scores, self.beam_size - 1)[self.beam_size - 1]
+        mask = mask.reshape((num_beams, self.beam_size))
+        costs = costs.reshape((num_beams, self.beam_size))
+        active_bounds = numpy.where(
+            mask == 1, costs / float(max_length) ** length_normalization,
+            numpy.inf).min(axis=1)
+        mask[worst_scores <= active_bounds] = 0
+
+    def _best_finished(self, finished_steps, finished_positions, mask,
+                       all_costs, lengths, steps, num_beams,
+                       length_normalization):
+        """Choose the hypotheses returned with early stopping.
+
+        Returns
+        -------
+        A (steps, positions) pair of arrays with the step at which every
+        chosen hypothesis ends and its position in the beam at that step,
+        the `beam_size` best ones of every beam in order.
+
+        """
+        # The unfinished hypotheses of the last step are only chosen when
+        # their beam has less than `beam_size` finished ones
+        (unfinished,) = numpy.where(mask == 1)
+        end_steps = numpy.append(finished_steps,
+                                 numpy.repeat(steps, len(unfinished)))
+        end_positions = numpy.append(finished_positions, unfinished)
+        scores = self._scores(all_costs[end_steps, end_positions],
+                              numpy.append(finished_steps,
+                                           lengths[unfinished]),
+                              length_normalization)
+        beams = end_positions // self.beam_size
+        order = numpy.lexsort((scores, beams))
+        chosen = numpy.concatenate([
+            order[beams[order] == beam][:self.beam_size]
+            for beam in range(num_beams)])
+        return end_steps[chosen], end_positions[chosen]
+
+    def _normalized_order(self, masks, costs, num_beams,
+                          length_normalization):
+        """Sort the hypotheses of every beam by their normalized costs."""
+        lengths = numpy.maximum(masks.sum(axis=0), 1)
+        scores = (costs.sum(axis=0) /
+                  lengths ** length_normalization).reshape(
+                      (num_beams, self.beam_size))
+        order = numpy.argsort(scores, axis=1, kind='mergesort')
+        return (order + self.beam_size *
+                numpy.arange(num_beams)[:, None]).flatten()
+
+    @staticmethod
+    def _backtrack(backpointers, *histories, **kwargs):
+        r"""Rearrange histories along the backpointers.
+
+        Parameters
+        ----------
+        backpointers : :class:`numpy.ndarray`
+            A (steps, beam size) matrix with the position in the previous
+            step of the prefix continued by every hypothesis. The first
+            row is ignored.
+        \*histories : :class:`numpy.ndarray`
+            Arrays of the same shape, whose rows are in the order of the
+            beam at the respective step.
+        ends : tuple, optional
+            A (steps, positions) pair of arrays with the step at which
+            every followed hypothesis ends and its position in the beam
+            at that step. After its end, the histories of a hypothesis
+            keep their values at the end. By default the hypotheses of
+            the last step are followed.
+
+        Returns
+        -------
+        A list of the histories, with the rows rearranged so that every
+        column follows a hypothesis of the last step, or of `ends`.
+
+        """
+        ends = kwargs.pop('ends', None)
+        if ends is None:
+            ends = (numpy.repeat(backpointers.shape[0] - 1,
+                                 backpointers.shape[1]),
+                    numpy.arange(backpointers.shape[1]))
+        end_steps, positions = ends
+        positions = positions.copy()
+        results = [numpy.repeat(history[end_steps, positions][None],
+                                backpointers.shape[0], axis=0)
+                   for history in histories]
+        for step in range(backpointers.shape[0] - 1, -1, -1):
+            (ended,) = numpy.where(end_steps >= step)
+            for result, history in equizip(results, histories):
+                result[step, ended] = history[step, positions[ended]]
+            positions[ended] = backpointers[step, positions[ended]]
+        return results
 
     @staticmethod
     def result_to_lists(result):
         outputs, masks, costs = [array.T for array in result]
-        outputs = [list(output[:mask.sum()])
+        outputs = [list(output[:int(mask.sum())])
                    for output, mask in equizip(outputs, masks)]
         costs = list(costs.T.sum(axis=0))
         return outputs, costs
+
+
+def sample_outputs(logprobs, rng, temperature=1., top_k=None, top_p=None):
+    """Sample an output for every row of negative log probabilities.
+
+    Parameters
+    ----------
+    logprobs : :class:`~numpy.ndarray`
+        A (batch size, number of possible outputs) array of negative log
+        probabilities.
+    rng : :class:`~numpy.random.RandomState`
+        The random number generator.
+    temperature : float, optional
+        The log probabilities are divided by the temperature before
+        sampling, so that the distribution is sharper below 1 and flatter
+        above. 1 by default.
+    top_k : int, optional
+        If given, only the `top_k` most probable outputs are sampled.
+    top_p : float, optional
+        If given, only the smallest set of most probable outputs whose
+        total probability is at least `top_p` is sampled (nucleus
+        sampling).
+
+    Returns
+    -------
+    A vector of the sampled outputs.
+
+    """
+    if temperature <= 0:
+        raise ValueError("temperature must be positive")
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be positive")
+    if top_p is not None and not 0 < top_p <= 1:
+        raise ValueError("top_p must be in (0, 1]")
+    logits = -logprobs / temperature
+    probs = numpy.exp(logits - logits.max(axis=1)[:, None])
+    num_outputs = probs.shape[1]
+    if top_k is not None and top_k < num_outputs:
+        kth = numpy.partition(probs, num_outputs - top_k, axis=1)[
+            :, num_outputs - top_k]
+        probs[probs < kth[:, None]] = 0
+    if top_p is not None:
+        rows = numpy.arange(probs.shape[0])[:, None]
+        order = numpy.argsort(-probs, axis=1)
+        sorted_probs = probs[rows, order]
+        cumulative = sorted_probs.cumsum(axis=1)
+        sorted_probs[cumulative - sorted_probs >=
+                     top_p * cumulative[:, -1:]] = 0
+        probs[rows, order] = sorted_probs
+    cumulative = probs.cumsum(axis=1)
+    thresholds = rng.uniform(size=(probs.shape[0], 1)) * cumulative[:, -1:]
+    outputs = (cumulative <= thresholds).sum(axis=1)
+    return numpy.minimum(outputs, num_outputs - 1)
+
+
+class Sampler(object):
+    """Draw many samples of the outputs of a single input.
+
+    Unlike :meth:`~.BaseSequenceGenerator.generate`, which samples inside
+    a scan over a batch of repeated inputs, the sampler computes the
+    contexts of the input once, repeats them for every sample, and makes
+    the steps with the compiled functions of :class:`BeamSearch`. The
+    finished samples are dropped from the batch, so that the steps only
+    compute the states of the unfinished ones.
+
+    Parameters
+    ----------
+    samples : :class:`~theano.Variable`
+        An output of a sampling computation graph built by
+        :meth:`~.BaseSequenceGenerator.generate`, as for
+        :class:`BeamSearch`.
+    temperature : float, optional
+        The temperature, see :func:`sample_outputs`.
+    top_k : int, optional
+        The number of most probable outputs sampled, see
+        :func:`sample_outputs`.
+    top_p : float, optional
+        The total probability of the outputs sampled, see
+        :func:`sample_outputs`.
+    seed : int, optional
+        The seed of the random number generator. If not given, the
+        ``default_seed`` configuration is used.
+
+    """
+    def __init__(self, samples, temperature=1., top_k=None, top_p=None,
+                 seed=None):
+        if seed is None:
+            seed = config.default_seed
+        self.search = BeamSearch(1, samples)
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.rng = numpy.random.RandomState(seed)
+
+    def sample(self, input_values, num_samples, eol_symbol, max_length,
+               batch_axis=1, as_arrays=False):
+        """Sample output sequences for an input.
+
+        Parameters
+        ----------
+        input_values : dict
+            A {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionary of the values of a single input, with a batch axis
+            of size 1.
+        num_samples : int
+            The number of sequences to sample.
+        eol_symbol : int
+            End of sequence symbol, a sequence is finished when it is
+            sampled.
+        max_length : int
+            Maximum sequence length.
+        batch_axis : int, optional
+            The batch axis of the inputs, 1 by default.
+        as_arrays : bool, optional
+            If ``True``, a (matrix of outputs, mask, vector of costs)
+            tuple is returned instead of lists.
+
+        Returns
+        -------
+        outputs : list of lists of ints
+            The sampled sequences, including the end of sequence symbol
+            if it was sampled.
+        costs : list of floats
+            The negative log-likelihoods of the sequences under the model,
+            whatever the temperature.
+
+        """
+        for value in input_values.values():
+            if value.shape[batch_axis] != 1:
+                raise ValueError("input_values must contain a single input")
+        search = self.search
+        if not search.compiled:
+            search.compile()
+        contexts, states = search._prepare(input_values, num_samples,
+                                           batch_axis)
+        batch_axes = search._context_batch_axes(contexts, num_samples)
+
+        all_outputs = numpy.zeros((max_length, num_samples),
+                                  dtype=states['outputs'].dtype)
+        all_masks = numpy.zeros((max_length, num_samples),
+                                dtype=theano.config.floatX)
+        costs = numpy.zeros(num_samples, dtype=theano.config.floatX)
+        finished = numpy.zeros(num_samples, dtype=bool)
+        active = numpy.arange(num_samples)
+        search.set_contexts(contexts)
+        logprobs = search.compute_logprobs(contexts, states)
+        steps = 0
+        for i in range(max_length):
+            outputs = sample_outputs(logprobs, self.rng, self.temperature,
+                                     self.top_k, self.top_p).astype(
+                                         all_outputs.dtype)
+            # Without batch axes the finished samples can not be dropped,
+            # they are still computed but their outputs are ignored
+            unfinished = ~finished[active]
+            outputs[~unfinished] = eol_symbol
+            all_outputs[i, active] = outputs
+            all_masks[i, active[unfinished]] = 1
+            costs[active[unfinished]] += logprobs[
+                numpy.arange(len(active)), outputs][unfinished]
+            finished[active] |= outputs == eol_symbol
+            steps = i + 1
+            if finished.all() or steps == max_length:
+                break
+
+            if batch_axes is not None:
+                keep = ~finished[active]
+                if not keep.all():
+                    active = active[keep]
+                    outputs = outputs[keep]
+                    states = OrderedDict((name, value[keep])
+                                         for name, value in states.items())
+                    search.set_contexts(OrderedDict(
+                        (name, value.take(active, axis=axis))
+                        for (name, value), axis
+                        in equizip(contexts.items(), batch_axes)))
+            states, logprobs = search.compute_step(states, outputs)
+
+        result = all_outputs[:steps], all_masks[:steps], costs
+        if as_arrays:
+            return result
+        outputs, masks, costs = result
+        return ([list(output[:int(mask.sum())])
+                 for output, mask in equizip(outputs.T, masks.T)],
+                list(costs))
+
+
+class ContextCache(object):
+    """A least recently used cache of the contexts of beam searches.
+
+    The entries are dictionaries of arrays, such as the contexts or the
+    initial states computed for some inputs. When the total size of the
+    arrays exceeds `max_bytes`, the least recently used entries are
+    discarded.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The maximum total size of the cached arrays in bytes.
+
+    Attributes
+    ----------
+    size : int
+        The current total size of the cached arrays in bytes.
+    hits : int
+        The number of lookups which found their entry.
+    misses : int
+        The number of lookups which did not.
+
+    Notes
+    -----
+    The cached arrays are shared with the callers, who must not change
+    them in place.
+
+    """
+    def __init__(self, max_bytes):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(arrays):
+        """Identify a list of arrays by their content.
+
+        Returns
+        -------
+        A digest of the shapes, the data types and the data of the
+        arrays.
+
+        """
+        digest = hashlib.sha1()
+        for array in arrays:
+            array = numpy.ascontiguousarray(array)
+            digest.update('{}{}'.format(array.dtype.str,
+                                        array.shape).encode('ascii'))
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Look an entry up, making it the most recently used.
+
+        Returns
+        -------
+        The cached dictionary of arrays, or ``None`` if there is none.
+
+        """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value, size = self.entries.pop(key)
+        self.entries[key] = value, size
+        return value
+
+    def put(self, key, value):
+        """Add an entry, discarding the least recently used ones.
+
+        An entry larger than `max_bytes` is not cached.
+
+        Parameters
+        ----------
+        key : hashable
+            The key of the entry.
+        value : dict
+            A {name: :class:`~numpy.ndarray`} dictionary.
+
+        """
+        size = sum(array.nbytes for array in value.values())
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = OrderedDict(value), size
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, discarded_size) = self.entries.popitem(last=False)
+            self.size -= discarded_size
+
+    def clear(self):
+        """Discard all the entries."""
+        self.entries.clear()
+        self.size = 0
+
+
+class GenerationSession(object):
+    """Generate sequences incrementally, one output at a time.
+
+    Unlike :meth:`~.BaseSequenceGenerator.generate`, which returns whole
+    sequences after a given number of steps, a session lets the caller
+    choose or sample every output and get it right away, e.g. to stream
+    the output of an interactive service. The states of the sequence
+    generator are kept between the steps, and a single compiled function
+    computes the next states and the distribution of the next outputs.
+
+    Parameters
+    ----------
+    samples : :class:`~theano.Variable`
+        An output of a sampling computation graph built by
+        :meth:`~.BaseSequenceGenerator.generate`, as for
+        :class:`BeamSearch`, whose compiled functions the session shares.
+    input_values : dict
+        A {:class:`~theano.Variable`: :class:`~numpy.ndarray`} dictionary
+        of input values, with shapes as if you ran sampling with batch
+        size `batch_size`.
+    batch_size : int
+        The number of sequences generated in parallel.
+    seed : int, optional
+        The seed of the random number generator used by :meth:`sample`.
+        If not given, the ``default_seed`` configuration is used.
+
+    Attributes
+    ----------
+    states : dict
+        A {name: :class:`~numpy.ndarray`} dictionary of the current
+        states, including the last outputs.
+    logprobs : :class:`~numpy.ndarray`
+        A (`batch_size`, number of possible outputs) array of the negative
+        log probabilities of the next outputs, as returned by
+        :meth:`BeamSearch.compute_logprobs`.
+    steps : int
+        The number of outputs fed so far.
+
+    Notes
+    -----
+    A session keeps its own contexts and states, so different sessions
+    can be used from different threads at the same time, but a single
+    session must not.
+
+    """
+    def __init__(self, samples, input_values, batch_size, seed=None):
+        if seed is None:
+            seed = config.default_seed
+        self.search = BeamSearch(batch_size, samples)
+        self.search.compile()
+        self.rng = numpy.random.RandomState(seed)
+
+        self.contexts = self.search.compute_contexts(input_values)
+        self.states = self.search.compute_initial_states(self.contexts,
+                                                         batch_size)
+        self.logprobs = self.search.compute_logprobs(self.contexts,
+                                                     self.states)
+        self.steps = 0
+
+    def sample(self, temperature=1., top_k=None, top_p=None):
+        """Sample the next outputs without feeding them.
+
+        The arguments are those of :func:`sample_outputs`.
+
+        Returns
+        -------
+        A vector of the sampled outputs.
+
+        """
+        return sample_outputs(self.logprobs, self.rng, temperature, top_k,
+                              top_p).astype(self.states['outputs'].dtype)
+
+    def feed(self, outputs):
+        """Feed the next outputs and compute the following states.
+
+        Parameters
+        ----------
+        outputs : :class:`~numpy.ndarray`
+            A vector with an output for every sequence.
+
+        """
+        outputs = numpy.asarray(outputs, dtype=self.states['outputs'].dtype)
+        self.search.set_contexts(self.contexts)
+        next_states, self.logprobs = self.search.compute_step(self.states,
+                                                              outputs)
+        self.states.update(next_states)
+        self.steps += 1
+
+    def step(self, outputs=None):
+        """Make one step of generation.
+
+        Parameters
+        ----------
+        outputs : :class:`~numpy.ndarray`, optional
+            The outputs to feed. If not given, they are sampled.
+
+        Returns
+        -------
+        The outputs fed.
+
+        """
+        if outputs is None:
+            outputs = self.sample()
+        self.feed(outputs)
+        return outputs
+
+    def generate(self, eol_symbol, max_length):
+        """Sample outputs until every sequence is finished.
+
+        Parameters
+        ----------
+        eol_symbol : int
+            End of sequence symbol. Once it is generated, a sequence only
+            generates this symbol.
+        max_length : int
+            The maximum number of steps.
+
+        Yields
+        ------
+        The outputs of every step, as soon as they are sampled.
+
+        Notes
+        -----
+        The outputs of the last step are not fed, as no more outputs are
+        sampled. Feed them to continue the generation.
+
+        """
+        finished = numpy.zeros(self.logprobs.shape[0], dtype=bool)
+        for i in range(max_length):
+            outputs = self.sample()
+            outputs[finished] = eol_symbol
+            finished |= outputs == eol_symbol
+            yield outputs
+            if finished.all() or i == max_length - 1:
+                break
+            self.feed(outputs)
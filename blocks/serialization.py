@@ -1,3 +1,27 @@
+"""Pickling of the main loop and other objects.
+
+Besides the helpers to pickle objects with informative error messages and
+without corrupting the destination in case of a failure, this module
+provides :class:`ArrayStore`, a content-addressed storage for the NumPy
+arrays contained in the pickled objects. Objects pickled with an array
+store have to be loaded with :func:`load`.
+
+The pickles can be compressed on the fly, see :func:`secure_pickle_dump`.
+They can also be saved together with additional sections, e.g. the
+training log, in an indexed file, from which every section can be loaded
+without unpickling the others, see :func:`load`.
+Besides the :mod:`gzip`, :mod:`bz2` and :mod:`lzma` compressions from the
+standard library, Zstandard and LZ4 are supported if the `zstandard` and
+`lz4` packages are installed.
+
+"""
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import logging
+import numbers
 import os
 from pickle import HIGHEST_PROTOCOL
 try:
@@ -5,13 +29,57 @@ try:
 except ImportError:
     DEFAULT_PROTOCOL = HIGHEST_PROTOCOL
 import shutil
+import struct
 import tempfile
+import time
+from collections import OrderedDict
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
+import numpy
 import six
 from six.moves import cPickle
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from blocks.utils import reraise_as
 
+logger = logging.getLogger(__name__)
+
+ARRAY_PERSISTENT_ID = 'blocks.serialization.ArrayStore'
+SECTION_PERSISTENT_ID = 'blocks.serialization.section'
+
+COMPRESSION_MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'lzma': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x04\x22\x4d\x18'}
+"""The magic bytes of the supported compressed formats."""
+
+FSYNC_POLICIES = ['file', 'directory']
+
+INDEXED_FORMAT_MAGIC = b'\x93BLKIDX\x01'
+"""The magic string that starts and ends an indexed pickle file.
+
+An indexed pickle file consists of the magic string, the pickled
+sections, a JSON index mapping section names to their offsets and
+lengths, a little-endian 64-bit offset of the index and the magic
+string again.
+
+"""
+
+MAIN_SECTION = 'main'
+"""The name of the section containing the object itself."""
+
 PICKLING_ERROR = """
 
 Blocks relies on the ability to pickle the entire main loop, which includes \
@@ -40,10 +108,22 @@ functions are available in the global namespace."""
 
 
 def pickle_dump(*args, **kwargs):
-    """A wrapper around pickle's dump that provides informative errors."""
+    """A wrapper around pickle's dump that provides informative errors.
+
+    In addition to the arguments of pickle's dump, accepts a
+    `persistent_id` keyword argument. If given, it is used as the
+    :meth:`persistent_id` method of the pickler.
+
+    """
     kwargs.setdefault('protocol', DEFAULT_PROTOCOL)
+    persistent_id = kwargs.pop('persistent_id', None)
     try:
-        cPickle.dump(*args, **kwargs)
+        if persistent_id is None:
+            cPickle.dump(*args, **kwargs)
+        else:
+            pickler = cPickle.Pickler(*args[1:], **kwargs)
+            pickler.persistent_id = persistent_id
+            pickler.dump(args[0])
     except Exception as e:
         if six.PY3 and '<lambda>' in e.args[0]:
             reraise_as("Pickling failed to pickle a lambda function." +
@@ -62,26 +142,448 @@ def pickle_dump(*args, **kwargs):
         reraise_as("Pickling failed." + PICKLING_ERROR)
 
 
-def secure_pickle_dump(object_, path):
+def open_compressed(file_, compression, mode):
+    """Wrap a binary file object into a compressing or decompressing one.
+
+    Parameters
+    ----------
+    file_ : file
+        The file object.
+    compression : str
+        One of the keys of :data:`COMPRESSION_MAGIC`.
+    mode : str
+        Either ``'rb'`` or ``'wb'``.
+
+    """
+    if compression not in COMPRESSION_MAGIC:
+        raise ValueError("unknown compression: {}".format(compression))
+    module = {'lzma': lzma, 'lz4': lz4, 'zstd': zstandard}.get(
+        compression, True)
+    if module is None:
+        raise ValueError("{} compression is not available, the required "
+                         "package is not installed".format(compression))
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file_, mode=mode)
+    if compression == 'bz2':
+        return bz2.BZ2File(file_, mode)
+    if compression == 'lzma':
+        return lzma.LZMAFile(file_, mode)
+    if compression == 'lz4':
+        return lz4.frame.LZ4FrameFile(file_, mode)
+    if mode == 'wb':
+        return zstandard.ZstdCompressor().stream_writer(file_, closefd=False)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(file_))
+
+
+def detect_compression(file_):
+    """Detect the compression of a file object from its magic bytes.
+
+    The position of the file object is restored.
+
+    Returns
+    -------
+    The name of the compression or ``None`` if the file is not
+    compressed.
+
+    """
+    position = file_.tell()
+    header = file_.read(max(len(magic) for magic
+                            in COMPRESSION_MAGIC.values()))
+    file_.seek(position)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_pickle(object_, file_, compression, persistent_id):
+    if compression is None:
+        pickle_dump(object_, file_, persistent_id=persistent_id)
+        return
+    compressed = open_compressed(file_, compression, 'wb')
+    try:
+        pickle_dump(object_, compressed, persistent_id=persistent_id)
+    finally:
+        compressed.close()
+
+
+def _is_atomic(object_):
+    return isinstance(object_, (type(None), bool, numbers.Number,
+                                six.string_types, six.binary_type))
+
+
+def _section_persistent_id(sections, persistent_id=None):
+    """Create a :meth:`persistent_id` method referring to sections.
+
+    The objects which are sections or values of sections are pickled as
+    references to them. Atomic objects, e.g. numbers, are always pickled,
+    since they can be identical by chance.
+
+    """
+    references = {}
+    for name, section in sections.items():
+        if isinstance(section, dict):
+            items = section.items()
+        elif isinstance(section, (tuple, list)):
+            items = enumerate(section)
+        else:
+            items = []
+        for key, value in items:
+            if not _is_atomic(value):
+                references[id(value)] = (name, key)
+        if not _is_atomic(section):
+            references[id(section)] = (name, None)
+
+    def section_persistent_id(object_):
+        reference = references.get(id(object_))
+        if reference is not None:
+            return (SECTION_PERSISTENT_ID,) + reference
+        if persistent_id is not None:
+            return persistent_id(object_)
+    return section_persistent_id
+
+
+def secure_pickle_dump(object_, path, array_store=None, compression=None,
+                       buffer_size=2 ** 20, fsync=None, sections=None):
     """Robust serialization - does not corrupt your files when failed.
 
+    The object is pickled to a temporary file, which is moved to `path`
+    when pickling succeeded. The size of the result and the write
+    throughput are logged.
+
     Parameters
     ----------
     object_ : object
         The object to be saved to the disk.
     path : str
         The destination path.
+    array_store : :class:`ArrayStore`, optional
+        If given, the arrays contained in the object are saved to this
+        store instead of being pickled, see :class:`ArrayStore`. The
+        store must be located in the same folder as `path`.
+    compression : str, optional
+        If given, the pickle is compressed while being written. One of
+        ``'gzip'``, ``'bz2'``, ``'lzma'``, ``'zstd'`` and ``'lz4'``.
+        Compressed pickles are decompressed by :func:`load`.
+    buffer_size : int, optional
+        The size of the write buffer in bytes, 1 megabyte by default.
+        Large buffers turn the many small writes done by pickling into
+        few large ones, which matters on network file systems.
+    fsync : str, optional
+        If ``'file'``, the pickle is synced to the disk before being
+        moved to `path`. If ``'directory'``, the folder containing
+        `path` is synced after the move as well, which makes the new
+        file survive a crash (POSIX only). No syncing is done by
+        default.
+    sections : dict, optional
+        If given, an indexed file is written, which contains the pickled
+        object as the :data:`MAIN_SECTION` and a pickled section for
+        every item of this dictionary. Every section can be loaded
+        separately, see :func:`load`. The object itself refers to the
+        sections, and to the values of the sections which are
+        dictionaries, tuples or lists, instead of pickling them again.
+        For example, the log of a main loop given as a section is stored
+        only once.
 
     """
+    if fsync is not None and fsync not in FSYNC_POLICIES:
+        raise ValueError("unknown fsync policy: {}".format(fsync))
+    if compression is not None and compression not in COMPRESSION_MAGIC:
+        raise ValueError("unknown compression: {}".format(compression))
+    persistent_id = None
+    if array_store is not None:
+        if (os.path.dirname(os.path.abspath(array_store.folder)) !=
+                os.path.dirname(os.path.abspath(path))):
+            raise ValueError("the array store must be in the same folder "
+                             "as the destination path")
+        references = set()
+        persistent_id = array_store.get_persistent_id(references)
+    start = time.time()
     try:
         # Use the same destination directory, as /tmp can be too
         # small.  This also make the move to copy if the destination
         # wasn't on the same partition.
-        with tempfile.NamedTemporaryFile(delete=False,
-                                         dir=os.path.dirname(path)) as temp:
-            pickle_dump(object_, temp)
-        shutil.move(temp.name, path)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with io.open(fd, 'wb', buffering=buffer_size) as destination:
+            if sections is None:
+                _write_pickle(object_, destination, compression,
+                              persistent_id)
+            else:
+                destination.write(INDEXED_FORMAT_MAGIC)
+                index = OrderedDict()
+                for name, value in ([(MAIN_SECTION, object_)] +
+                                    list(sections.items())):
+                    offset = destination.tell()
+                    if name == MAIN_SECTION:
+                        _write_pickle(value, destination, compression,
+                                      _section_persistent_id(
+                                          sections, persistent_id))
+                    else:
+                        _write_pickle(value, destination, compression,
+                                      persistent_id)
+                    index[name] = (offset, destination.tell() - offset)
+                index_offset = destination.tell()
+                destination.write(json.dumps(index).encode('utf-8'))
+                destination.write(struct.pack('<Q', index_offset))
+                destination.write(INDEXED_FORMAT_MAGIC)
+        if fsync is not None:
+            _fsync(temp)
+        shutil.move(temp, path)
+        if fsync == 'directory':
+            _fsync(os.path.dirname(os.path.abspath(path)))
     except:
-        if "temp" in locals():
-            os.remove(temp.name)
+        if "temp" in locals() and os.path.exists(temp):
+            os.remove(temp)
         raise
+    if array_store is not None:
+        array_store.set_references(os.path.basename(path), references)
+    size = os.path.getsize(path) / 2. ** 20
+    elapsed = time.time() - start
+    logger.info("Saved {:.1f} MB to {} in {:.2f} seconds ({:.1f} MB/s)"
+                .format(size, path, elapsed, size / max(elapsed, 1e-6)))
+
+
+def read_section_index(path):
+    """Read the index of an indexed pickle file.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+
+    Returns
+    -------
+    index : :class:`~collections.OrderedDict` or ``None``
+        A dictionary mapping section names to ``(offset, length)``
+        tuples, or ``None`` if the file is a plain pickle.
+
+    """
+    trailer_size = struct.calcsize('<Q') + len(INDEXED_FORMAT_MAGIC)
+    with open(path, 'rb') as source:
+        if source.read(len(INDEXED_FORMAT_MAGIC)) != INDEXED_FORMAT_MAGIC:
+            return None
+        source.seek(-trailer_size, os.SEEK_END)
+        trailer = source.read(trailer_size)
+        if not trailer.endswith(INDEXED_FORMAT_MAGIC):
+            raise ValueError("{} is a truncated indexed pickle".format(path))
+        index_offset, = struct.unpack(
+            '<Q', trailer[:-len(INDEXED_FORMAT_MAGIC)])
+        source.seek(0, os.SEEK_END)
+        end = source.tell() - trailer_size
+        source.seek(index_offset)
+        index = json.loads(source.read(end - index_offset).decode('utf-8'),
+                           object_pairs_hook=OrderedDict)
+    return OrderedDict((name, tuple(location))
+                       for name, location in index.items())
+
+
+def _unpickle(source, root, load_section=None):
+    def persistent_load(persistent_id):
+        kind = persistent_id[0]
+        if kind == SECTION_PERSISTENT_ID and load_section is not None:
+            return load_section(*persistent_id[1:])
+        if kind != ARRAY_PERSISTENT_ID:
+            raise cPickle.UnpicklingError(
+                "unsupported persistent id: {}".format(kind))
+        filename = persistent_id[1]
+        return numpy.load(os.path.join(root, *filename.split('/')))
+
+    compression = detect_compression(source)
+    if compression is not None:
+        source = open_compressed(source, compression, 'rb')
+    try:
+        unpickler = cPickle.Unpickler(source)
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+    finally:
+        source.close()
+
+
+def load(path, section=None):
+    """Load an object saved by :func:`secure_pickle_dump`.
+
+    Unlike plain unpickling, also decompresses compressed pickles and
+    loads the arrays that were saved to an :class:`ArrayStore`.
+
+    Parameters
+    ----------
+    path : str
+        The path to the pickled object.
+    section : str, optional
+        The name of the section to load from an indexed pickle file.
+        Only this section is read and unpickled. By default the object
+        itself (the :data:`MAIN_SECTION`) is loaded.
+
+    """
+    root = os.path.dirname(path)
+    index = read_section_index(path)
+    if index is None:
+        if section not in (None, MAIN_SECTION):
+            raise ValueError("{} is not an indexed pickle, can not load "
+                             "section {}".format(path, section))
+        with open(path, "rb") as source:
+            return _unpickle(source, root)
+    if section is None:
+        section = MAIN_SECTION
+    if section not in index:
+        raise ValueError("{} has no section {}".format(path, section))
+    loaded_sections = {}
+
+    def load_section(name, key):
+        if name not in loaded_sections:
+            loaded_sections[name] = load(path, name)
+        value = loaded_sections[name]
+        return value if key is None else value[key]
+
+    offset, length = index[section]
+    with open(path, "rb") as source:
+        source.seek(offset)
+        return _unpickle(io.BytesIO(source.read(length)), root,
+                         load_section if section == MAIN_SECTION else None)
+
+
+def array_checksum(value):
+    """Compute a checksum of a NumPy array.
+
+    The checksum covers the dtype and the shape of the array as well as
+    its contents, so that it can also be used as a content hash.
+
+    Parameters
+    ----------
+    value : :class:`~numpy.ndarray`
+        The array.
+
+    Returns
+    -------
+    The SHA-1 hex digest.
+
+    """
+    value = numpy.require(value, requirements='C')
+    checksum = hashlib.sha1()
+    checksum.update("{}{}".format(value.dtype.str, value.shape).encode())
+    checksum.update(value.data)
+    return checksum.hexdigest()
+
+
+class ArrayStore(object):
+    """A content-addressed storage of NumPy arrays.
+
+    When an object is pickled with an array store (see
+    :func:`secure_pickle_dump`), the arrays it contains that are larger
+    than `min_size` bytes are saved to the store folder as ``.npy``
+    files named after the hashes of their contents, and only references
+    to these files are pickled. An array that did not change between
+    several pickles, e.g. a frozen parameter in consecutive checkpoints,
+    is thus written to the disk only once.
+
+    The store keeps track of the files referenced by every pickle in
+    ``references.json``, so that the files which are not referenced
+    anymore can be deleted by :meth:`collect_garbage`.
+
+    Parameters
+    ----------
+    folder : str
+        The folder of the store. Created if it does not exist.
+    min_size : int, optional
+        The size in bytes starting from which arrays are saved to the
+        store. 4 kilobytes by default.
+
+    """
+    def __init__(self, folder, min_size=4096):
+        self.folder = folder
+        self.min_size = min_size
+
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+
+    @property
+    def path_to_references(self):
+        return os.path.join(self.folder, 'references.json')
+
+    def save(self, array):
+        """Save an array to the store unless it is already there.
+
+        Returns
+        -------
+        The name of the file containing the array.
+
+        """
+        filename = array_checksum(array) + '.npy'
+        path = os.path.join(self.folder, filename)
+        if not os.path.exists(path):
+            with tempfile.NamedTemporaryFile(delete=False,
+                                             dir=self.folder) as temp:
+                numpy.save(temp, array)
+            shutil.move(temp.name, path)
+        return filename
+
+    def get_persistent_id(self, references):
+        """Create a :meth:`persistent_id` method for a pickler.
+
+        Parameters
+        ----------
+        references : set
+            The names of the files referenced by the pickle are added
+            to this set.
+
+        """
+        def persistent_id(object_):
+            if (type(object_) is not numpy.ndarray or
+                    object_.dtype.hasobject or
+                    object_.nbytes < self.min_size):
+                return None
+            filename = self.save(object_)
+            references.add(filename)
+            return (ARRAY_PERSISTENT_ID,
+                    os.path.basename(self.folder) + '/' + filename)
+        return persistent_id
+
+    def get_references(self):
+        """Return a dictionary of the files referenced by every pickle."""
+        if not os.path.exists(self.path_to_references):
+            return {}
+        with open(self.path_to_references) as source:
+            return json.load(source)
+
+    def _write_references(self, references):
+        with tempfile.NamedTemporaryFile('w', delete=False,
+                                         dir=self.folder) as temp:
+            json.dump(references, temp, indent=1, sort_keys=True)
+        shutil.move(temp.name, self.path_to_references)
+
+    def set_references(self, owner, filenames):
+        """Set the files referenced by a pickle.
+
+        Parameters
+        ----------
+        owner : str
+            The name of the pickle, relative to the folder of the store.
+        filenames : iterable of str
+            The names of the referenced files.
+
+        """
+        references = self.get_references()
+        references[owner] = sorted(filenames)
+        self._write_references(references)
+
+    def remove_references(self, owner):
+        """Forget the files referenced by a deleted pickle."""
+        references = self.get_references()
+        if references.pop(owner, None) is not None:
+            self._write_references(references)
+
+    def collect_garbage(self):
+        """Delete the files not referenced by any pickle."""
+        referenced = set()
+        for filenames in self.get_references().values():
+            referenced.update(filenames)
+        for filename in os.listdir(self.folder):
+            if filename.endswith('.npy') and filename not in referenced:
+                os.remove(os.path.join(self.folder, filename))
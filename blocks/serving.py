@@ -0,0 +1,427 @@
+"""Serving beam search to concurrent clients and decoding in bulk.
+
+A :class:`DecodingServer` decodes the requests of many threads with a
+single :class:`.BeamSearch`. The requests that arrive within a short time
+window are decoded together in one call of
+:meth:`~.BeamSearch.search_batch`, which makes much better use of the CPU
+than decoding every request alone.
+
+A :class:`BucketedDecoder` decodes a whole corpus in batches of inputs of
+similar lengths, so that little computation is spent on padding.
+
+"""
+import json
+import logging
+import threading
+import timeit
+from collections import deque
+
+import numpy
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+
+class DecodingRequest(object):
+    """A request to a :class:`DecodingServer`.
+
+    Parameters
+    ----------
+    input_values : dict
+        A {:class:`~theano.Variable`: :class:`~numpy.ndarray`} dictionary
+        of the values of a single input, with a batch axis of size 1.
+
+    """
+    def __init__(self, input_values):
+        self.input_values = input_values
+        self.submitted = timeit.default_timer()
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """Whether the request was processed."""
+        return self._done.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def result(self, timeout=None):
+        """Wait for the result of the request.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time to wait in seconds. If not given, waits
+            until the request is processed.
+
+        Returns
+        -------
+        The (outputs, costs) pair returned by :meth:`.BeamSearch.search`.
+
+        Raises
+        ------
+        RuntimeError
+            When the timeout expires.
+
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("the request was not processed in time")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class DecodingServer(object):
+    r"""Decode the requests of concurrent clients in batches.
+
+    The clients submit requests from any thread with :meth:`submit` or
+    :meth:`decode`. A worker thread takes the requests from a queue,
+    waits up to `batch_window` seconds for more requests to arrive, and
+    decodes all the requests with inputs of the same shape in a single
+    :meth:`~.BeamSearch.search_batch` call.
+
+    Parameters
+    ----------
+    beam_search : :class:`.BeamSearch`
+        The beam search.
+    eol_symbol : int
+        End of sequence symbol.
+    max_length : int
+        Maximum sequence length.
+    max_batch_size : int, optional
+        The maximum number of requests decoded together, 32 by default.
+    batch_window : float, optional
+        The time in seconds to wait for more requests after the first one
+        of a batch arrives, 0.005 by default. This bounds the latency
+        added by the batching.
+    batch_axis : int, optional
+        The axis of the input arrays along which the requests are
+        stacked, see :meth:`~.BeamSearch.search_batch`.
+    batch_history : int, optional
+        The number of the last batches whose sizes are kept in
+        `batch_sizes`, 1000 by default.
+    \*\*kwargs
+        Further keyword arguments of :meth:`~.BeamSearch.search_batch`,
+        e.g. `early_stopping`.
+
+    Attributes
+    ----------
+    batch_sizes : :class:`~collections.deque`
+        The numbers of requests of the last decoded batches.
+
+    Notes
+    -----
+    The calls of the compiled Theano functions are serialized, so a
+    single worker thread decodes. The throughput comes from the
+    batching, with which the matrix operations of Theano are large
+    enough to use the CPU efficiently.
+
+    The server uses `beam_search` from the worker thread, so it must not
+    be used elsewhere while the server runs. Other beam searches for the
+    same samples can be used from other threads.
+
+    """
+    def __init__(self, beam_search, eol_symbol, max_length,
+                 max_batch_size=32, batch_window=0.005, batch_axis=1,
+                 batch_history=1000, **kwargs):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be positive")
+        self.beam_search = beam_search
+        self.eol_symbol = eol_symbol
+        self.max_length = max_length
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.batch_axis = batch_axis
+        self.search_kwargs = kwargs
+
+        self.requests = queue.Queue()
+        self.batch_sizes = deque(maxlen=batch_history)
+        self.worker = None
+        # Guards the worker and the end of the queue, so that no request
+        # is queued after the one which stops the worker
+        self._lock = threading.Lock()
+        self._accepting = False
+
+    def start(self):
+        """Start the worker thread."""
+        with self._lock:
+            if self.worker is not None:
+                raise ValueError("the server is already started")
+            self.beam_search.compile()
+            self.worker = threading.Thread(target=self._work,
+                                           name='DecodingServer')
+            self.worker.daemon = True
+            self.worker.start()
+            self._accepting = True
+
+    def stop(self):
+        """Process the pending requests and stop the worker thread.
+
+        The requests submitted from now on are refused.
+
+        """
+        with self._lock:
+            worker = self.worker
+            if worker is None:
+                return
+            if self._accepting:
+                self._accepting = False
+                self.requests.put(None)
+        worker.join()
+        with self._lock:
+            self.worker = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def submit(self, input_values):
+        """Submit a request.
+
+        Parameters
+        ----------
+        input_values : dict
+            A {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionary of the values of a single input.
+
+        Returns
+        -------
+        A :class:`DecodingRequest`, whose :meth:`~DecodingRequest.result`
+        waits for the outputs.
+
+        Raises
+        ------
+        ValueError
+            If the server is not started, or is stopping.
+
+        """
+        for value in input_values.values():
+            if value.shape[self.batch_axis] != 1:
+                raise ValueError("a request must contain a single input")
+        request = DecodingRequest(input_values)
+        with self._lock:
+            if not self._accepting:
+                raise ValueError("the server is not running")
+            self.requests.put(request)
+        return request
+
+    def decode(self, input_values, timeout=None):
+        """Submit a request and wait for its result."""
+        return self.submit(input_values).result(timeout)
+
+    def _collect(self, first):
+        """Collect the requests that arrive during the batch window."""
+        batch = [first]
+        deadline = timeit.default_timer() + self.batch_window
+        stop = False
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - timeit.default_timer()
+            try:
+                if timeout > 0:
+                    request = self.requests.get(timeout=timeout)
+                else:
+                    request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                stop = True
+                break
+            batch.append(request)
+        return batch, stop
+
+    def _work(self):
+        stop = False
+        while not stop:
+            first = self.requests.get()
+            if first is None:
+                break
+            batch, stop = self._collect(first)
+            groups = {}
+            for request in batch:
+                key = tuple(sorted((id(variable), value.shape, value.dtype.str)
+                                   for variable, value
+                                   in request.input_values.items()))
+                groups.setdefault(key, []).append(request)
+            for group in groups.values():
+                self._decode(group)
+
+    def _decode(self, group):
+        self.batch_sizes.append(len(group))
+        try:
+            input_values = dict(
+                (variable, numpy.concatenate(
+                    [request.input_values[variable] for request in group],
+                    axis=self.batch_axis))
+                for variable in group[0].input_values)
+            results = self.beam_search.search_batch(
+                input_values, self.eol_symbol, self.max_length,
+                batch_axis=self.batch_axis, **self.search_kwargs)
+        except Exception as e:
+            logger.error("decoding a batch of {} requests failed".format(
+                len(group)))
+            for request in group:
+                request.set_exception(e)
+            return
+        for request, result in zip(group, results):
+            request.set_result(result)
+        logger.debug("decoded a batch of {} requests, the oldest in "
+                     "{:.3f} s".format(len(group), timeit.default_timer() -
+                                       group[0].submitted))
+
+
+class BucketedDecoder(object):
+    r"""Decode many inputs in batches of inputs of similar lengths.
+
+    The inputs are sorted by length and split into buckets of at most
+    `batch_size` consecutive inputs. The inputs of a bucket are padded
+    with zeros to the length of the longest one and decoded in a single
+    :meth:`~.BeamSearch.search_batch` call.
+
+    Parameters
+    ----------
+    beam_search : :class:`.BeamSearch`
+        The beam search.
+    eol_symbol : int
+        End of sequence symbol.
+    max_length : int or callable
+        Maximum sequence length, or a function which returns it given the
+        length of the longest input of a bucket.
+    batch_size : int, optional
+        The maximum number of inputs of a bucket, 32 by default.
+    batch_axis : int, optional
+        The axis along which the inputs are stacked, see
+        :meth:`~.BeamSearch.search_batch`.
+    \*\*kwargs
+        Further keyword arguments of :meth:`~.BeamSearch.search_batch`.
+
+    Notes
+    -----
+    The padding changes the results of models which do not take a mask
+    of their inputs. The mask, whose padding is zeros too, should be
+    given like the other inputs.
+
+    """
+    def __init__(self, beam_search, eol_symbol, max_length, batch_size=32,
+                 batch_axis=1, **kwargs):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.beam_search = beam_search
+        self.eol_symbol = eol_symbol
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.batch_axis = batch_axis
+        self.search_kwargs = kwargs
+
+    @staticmethod
+    def input_length(input_values):
+        """The length of an input, the longest of its arrays."""
+        return max(value.shape[0] for value in input_values.values())
+
+    def buckets(self, inputs):
+        """Group the inputs into buckets.
+
+        Parameters
+        ----------
+        inputs : list of dicts
+            The {:class:`~theano.Variable`: :class:`~numpy.ndarray`}
+            dictionaries of the values of every input, without batch
+            axis, whose first axis is the length.
+
+        Returns
+        -------
+        A list of the lists of the indices of the inputs of every bucket,
+        from the shortest inputs to the longest ones.
+
+        """
+        lengths = [self.input_length(input_values)
+                   for input_values in inputs]
+        order = sorted(range(len(inputs)), key=lengths.__getitem__)
+        return [order[i:i + self.batch_size]
+                for i in range(0, len(order), self.batch_size)]
+
+    def _batch(self, bucket):
+        """Pad and stack the inputs of a bucket."""
+        length = max(self.input_length(input_values)
+                     for input_values in bucket)
+        batch = {}
+        for variable in bucket[0]:
+            padded = []
+            for input_values in bucket:
+                value = input_values[variable]
+                padded_value = numpy.zeros((length,) + value.shape[1:],
+                                           dtype=value.dtype)
+                padded_value[:value.shape[0]] = value
+                padded.append(padded_value)
+            batch[variable] = numpy.stack(padded, axis=self.batch_axis)
+        return batch, length
+
+    def decode_buckets(self, inputs):
+        """Decode the inputs bucket after bucket.
+
+        Parameters
+        ----------
+        inputs : list of dicts
+            The inputs, as for :meth:`buckets`.
+
+        Yields
+        ------
+        A (indices, results) pair for every bucket, with the indices of
+        its inputs and the (outputs, costs) pairs returned by
+        :meth:`~.BeamSearch.search`.
+
+        """
+        inputs = list(inputs)
+        for indices in self.buckets(inputs):
+            batch, length = self._batch([inputs[i] for i in indices])
+            max_length = self.max_length
+            if callable(max_length):
+                max_length = max_length(length)
+            results = self.beam_search.search_batch(
+                batch, self.eol_symbol, max_length,
+                batch_axis=self.batch_axis, **self.search_kwargs)
+            logger.debug("decoded a bucket of {} inputs of length {}"
+                         .format(len(indices), length))
+            yield indices, results
+
+    def decode(self, inputs, output=None):
+        """Decode the inputs.
+
+        Parameters
+        ----------
+        inputs : list of dicts
+            The inputs, as for :meth:`buckets`.
+        output : file, optional
+            If given, the results are written to this file as soon as
+            their bucket is decoded, one JSON object per line with the
+            ``index`` of the input, its ``outputs`` and their ``costs``.
+
+        Returns
+        -------
+        The list of the (outputs, costs) pairs of the inputs, in the
+        order of the inputs.
+
+        """
+        inputs = list(inputs)
+        results = [None] * len(inputs)
+        for indices, bucket_results in self.decode_buckets(inputs):
+            for index, (outputs, costs) in zip(indices, bucket_results):
+                results[index] = outputs, costs
+                if output is not None:
+                    output.write(json.dumps(
+                        {'index': index,
+                         'outputs': [[int(symbol) for symbol in sequence]
+                                     for sequence in outputs],
+                         'costs': [float(cost) for cost in costs]}))
+                    output.write('\n')
+            if output is not None:
+                output.flush()
+        return results
@@ -1,8 +1,116 @@
-from __future__ import print_function
+from __future__ import division, print_function
 
+import json
+import math
+import os
 import sys
+import threading
 import timeit
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
+
+
+class Histogram(object):
+    """A streaming histogram of durations.
+
+    Keeps the count, the sum and the maximum of the added values, and
+    counts them in a fixed number of logarithmically spaced buckets, so
+    that percentiles can be estimated in constant memory. The relative
+    error of the estimates is bounded by the width of the buckets.
+
+    Parameters
+    ----------
+    min_value : float, optional
+        The lower bound of the first bucket, one microsecond by default.
+        Smaller values are counted in an underflow bucket.
+    max_value : float, optional
+        The upper bound of the last bucket, 10000 seconds by default.
+        Larger values are counted in an overflow bucket.
+    buckets_per_decade : int, optional
+        The number of buckets per factor of 10, 20 by default, which
+        amounts to about 12% wide buckets.
+
+    """
+    def __init__(self, min_value=1e-6, max_value=1e4, buckets_per_decade=20):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.buckets_per_decade = buckets_per_decade
+        num_buckets = int(math.ceil(
+            math.log10(max_value / min_value) * buckets_per_decade))
+        self.counts = [0] * (num_buckets + 2)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        if value < self.min_value:
+            index = 0
+        elif value >= self.max_value:
+            index = len(self.counts) - 1
+        else:
+            index = min(int(math.log10(value / self.min_value) *
+                            self.buckets_per_decade) + 1,
+                        len(self.counts) - 2)
+        self.counts[index] += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.
+
+    def percentile(self, q):
+        """Estimate a percentile of the added values.
+
+        Parameters
+        ----------
+        q : float
+            The percentile, between 0 and 100.
+
+        Returns
+        -------
+        The geometric middle of the bucket containing the percentile,
+        but not more than the maximum value. The maximum value for
+        the overflow bucket.
+
+        """
+        if not 0 <= q <= 100:
+            raise ValueError("percentile must be between 0 and 100")
+        rank = q / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                break
+        else:
+            return 0.
+        if index == 0:
+            return min(self.min_value, self.max)
+        if index == len(self.counts) - 1:
+            return self.max
+        return min(self.min_value *
+                   10 ** ((index - 0.5) / self.buckets_per_decade),
+                   self.max)
+
+
+class ProfileSection(object):
+    """A section of a :class:`Profile`.
+
+    Sections form a tree, which is grown when a section is entered for
+    the first time, so that no keys have to be built when timing.
+
+    Parameters
+    ----------
+    key : tuple of str
+        The names of the enclosing sections and of this one.
+
+    """
+    def __init__(self, key):
+        self.key = key
+        self.total = 0
+        self.histogram = Histogram()
+        self.children = {}
 
 
 class Profile(object):
@@ -10,22 +118,128 @@ class Profile(object):
 
     Keeps track of timings performed with :class:`Timer`. It also keeps
     track of the way these timings were nested and makes use of this
-    information when reporting.
+    information when reporting. Besides the total time of every section,
+    a :class:`Histogram` of its durations is kept, from which the report
+    shows the mean duration, the tail latencies and the maximum.
+
+    To keep the overhead of profiling low, only every `sample_every`-th
+    iteration can be timed, see :meth:`begin_iteration`. The durations
+    of the sections timed in the sampled iterations are counted
+    `sample_every` times in the totals, which are thus estimates, while
+    the histograms only contain the sampled durations.
+
+    Parameters
+    ----------
+    sample_every : int, optional
+        Time only every `sample_every`-th iteration. By default every
+        iteration is timed.
+
+    Attributes
+    ----------
+    trace : :class:`TraceRecorder`
+        If set, the timeline of the sections is recorded to it. ``None``
+        by default.
+    weight : int
+        The number of times the durations of the sections entered now
+        are counted in the totals, 0 if they are not timed.
+
+    Notes
+    -----
+    The sections are nested in a single stack without any locking, so
+    a profile must only be used from one thread.
 
     """
-    def __init__(self):
-        self.total = defaultdict(int)
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.root = ProfileSection(())
+        self.current = []
+        # The sections in the order in which they were first entered
+        self.order = OrderedDict()
+        self.trace = None
+        self.weight = 1
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'root' in state:
+            return
+        # Profiles pickled before the sections formed a tree have a
+        # dictionary of totals, and possibly of histograms
+        total = self.__dict__.pop('total', {})
+        histograms = self.__dict__.pop('histograms', {})
+        keys = list(self.order)
+        self.sample_every = 1
+        self.root = ProfileSection(())
         self.current = []
         self.order = OrderedDict()
+        self.trace = getattr(self, 'trace', None)
+        self.weight = 1
+        for key in keys:
+            section = self.root
+            for name in key:
+                child = section.children.get(name)
+                if child is None:
+                    child = ProfileSection(section.key + (name,))
+                    section.children[name] = child
+                    self.order[child.key] = child
+                section = child
+            section.total = total.get(key, 0)
+            if key in histograms:
+                section.histogram = histograms[key]
+
+    @property
+    def total(self):
+        """A dictionary of the total times of the sections."""
+        total = defaultdict(int)
+        for key, section in self.order.items():
+            total[key] = section.total
+        return total
+
+    @property
+    def histograms(self):
+        """A dictionary of the duration histograms of the sections."""
+        return OrderedDict((key, section.histogram)
+                           for key, section in self.order.items())
+
+    def get_total(self, key):
+        """Return the total time of a section, 0 if it was not entered."""
+        section = self.root
+        for name in key:
+            section = section.children.get(name)
+            if section is None:
+                return 0
+        return section.total
 
     def enter(self, name):
-        self.current.append(name)
-        # We record the order in which sections were first called
-        self.order[tuple(self.current)] = None
+        parent = self.current[-1] if self.current else self.root
+        section = parent.children.get(name)
+        if section is None:
+            section = ProfileSection(parent.key + (name,))
+            parent.children[name] = section
+            self.order[section.key] = section
+        self.current.append(section)
+
+    def exit(self, t, weight=1):
+        section = self.current.pop()
+        section.total += weight * t
+        section.histogram.add(t)
+
+    def begin_iteration(self, iterations_done):
+        """Decide whether to time the sections of an iteration.
+
+        Sets :attr:`weight`, with which the :class:`Timer` objects
+        entered until :meth:`end_iteration` count their durations, to
+        `sample_every` for the sampled iterations and to 0, which
+        disables timing, for the others.
 
-    def exit(self, t):
-        self.total[tuple(self.current)] += t
-        self.current.pop()
+        """
+        if iterations_done % self.sample_every:
+            self.weight = 0
+        else:
+            self.weight = self.sample_every
+
+    def end_iteration(self):
+        """Time all sections again after an iteration."""
+        self.weight = 1
 
     def report(self, f=sys.stderr):
         """Print a report of timing information to standard output.
@@ -38,19 +252,26 @@ class Profile(object):
             ``sys.stderr``.
 
         """
-        total = sum(v for k, v in self.total.items() if len(k) == 1)
+        totals = self.total
+        total = sum(v for k, v in totals.items() if len(k) == 1)
 
         def print_report(keys, level=0):
             subtotal = 0
             for key in keys:
                 if len(key) > level + 1:
                     continue
-                subtotal += self.total[key]
+                subtotal += totals[key]
                 section = ' '.join(key[-1].split('_'))
                 section = section[0].upper() + section[1:]
-                print('{:30}{:15.2f}{:15.2%}'.format(
-                    level * '  ' + section, self.total[key],
-                    self.total[key] / total
+                histogram = self.order[key].histogram
+                print(('{:30}{:15.2f}{:15.2%}{:>10}' + 5 * '{:10.2f}').format(
+                    level * '  ' + section, totals[key],
+                    totals[key] / total, histogram.count,
+                    1000 * histogram.mean,
+                    1000 * histogram.percentile(50),
+                    1000 * histogram.percentile(95),
+                    1000 * histogram.percentile(99),
+                    1000 * histogram.max
                 ), file=f)
                 children = [k for k in keys
                             if k[level] == key[level] and
@@ -59,20 +280,85 @@ class Profile(object):
                 if children:
                     print('{:30}{:15.2f}{:15.2%}'.format(
                         (level + 1) * '  ' + 'Other',
-                        self.total[key] - child_total,
-                        (self.total[key] - child_total) / total
+                        totals[key] - child_total,
+                        (totals[key] - child_total) / total
                     ), file=f)
             return subtotal
 
-        print('{:30}{:>15}{:>15}'.format('Section', 'Time', '% of total'),
-              file=f)
-        print('-' * 60, file=f)
+        print(('{:30}{:>15}{:>15}' + 6 * '{:>10}').format(
+            'Section', 'Time', '% of total', 'Count', 'Mean, ms', 'P50, ms',
+            'P95, ms', 'P99, ms', 'Max, ms'), file=f)
+        print('-' * 120, file=f)
         if total:
             print_report(self.order.keys())
         else:
             print('No profile information collected.', file=f)
 
 
+class TraceRecorder(object):
+    """Records the timeline of profiled sections.
+
+    Every section timed with a :class:`Timer` is recorded together with
+    the thread it ran in, and the timeline can be written in the `Chrome
+    Trace Event format`_, which can be opened by timeline viewers such as
+    ``chrome://tracing`` and Perfetto. Every section is written as a
+    complete event, i.e. its begin and end in one event, so that the
+    events dropped from the bounded buffer never leave unmatched ones.
+
+    The sections of a :class:`Profile` must all be timed from a single
+    thread, usually the main one, as it keeps a single stack of the
+    current sections. Other threads can still add their sections to the
+    timeline by calling :meth:`record` directly, the events are tagged
+    with the thread that records them.
+
+    Parameters
+    ----------
+    max_events : int, optional
+        The maximum number of events kept in memory. When it is reached,
+        the oldest events are dropped. One million by default.
+
+    .. _Chrome Trace Event format:
+       https://docs.google.com/document/d/
+       1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+
+    """
+    def __init__(self, max_events=1000000):
+        self.events = deque(maxlen=max_events)
+        self.thread_names = {}
+
+    def record(self, name, start, end):
+        """Record a section.
+
+        Parameters
+        ----------
+        name : str
+            The name of the section.
+        start : float
+            The start time in seconds, as returned by
+            :func:`timeit.default_timer`.
+        end : float
+            The end time in seconds.
+
+        """
+        thread = threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+        self.events.append((name, start, end, thread.ident))
+
+    def write(self, path):
+        """Write the recorded timeline to a JSON file."""
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                   'args': {'name': thread_name}}
+                  for tid, thread_name in self.thread_names.items()]
+        events.extend({'name': name, 'cat': 'blocks', 'ph': 'X',
+                       'ts': 1e6 * start, 'dur': 1e6 * (end - start),
+                       'pid': pid, 'tid': tid}
+                      for name, start, end, tid in list(self.events))
+        with open(path, 'w') as destination:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      destination)
+
+
 class Timer(object):
     """A context manager to time the execution time of code within it.
 
@@ -93,7 +379,10 @@ class Timer(object):
 
     Notes
     -----
-    Timings are reported using :func:`timeit.default_timer`.
+    Timings are reported using :func:`timeit.default_timer`. If the
+    profile has a :class:`TraceRecorder`, the section is recorded to it as
+    well. Nothing is timed if the :attr:`~Profile.weight` of the profile
+    is 0 when the timer is entered, see :meth:`Profile.begin_iteration`.
 
     """
     def __init__(self, name, profile):
@@ -101,8 +390,15 @@ class Timer(object):
         self.profile = profile
 
     def __enter__(self):
-        self.profile.enter(self.name)
-        self.start = timeit.default_timer()
+        self.weight = self.profile.weight
+        if self.weight:
+            self.profile.enter(self.name)
+            self.start = timeit.default_timer()
 
     def __exit__(self, *args):
-        self.profile.exit(timeit.default_timer() - self.start)
+        if not self.weight:
+            return
+        end = timeit.default_timer()
+        self.profile.exit(end - self.start, self.weight)
+        if self.profile.trace is not None:
+            self.profile.trace.record(self.name, self.start, end)
@@ -0,0 +1,278 @@
+"""Profiling of Theano functions by brick application.
+
+When the ``profile_theano`` configuration is set, the functions compiled
+with :func:`theano_function` are profiled by Theano. A
+:class:`TheanoProfiles` collector reports the time spent in every brick
+application by these functions while it is active, whenever they were
+compiled. :meth:`.MainLoop.run` collects the profiles during the run,
+e.g. of the training algorithm and of the monitoring extensions, which
+are compiled when they are created.
+
+"""
+from __future__ import division, print_function
+
+import inspect
+import sys
+from collections import defaultdict, OrderedDict
+from weakref import WeakKeyDictionary
+
+import theano
+from theano.compile.profiling import ProfileStats
+
+from blocks.config import config
+from blocks.filter import get_application_call
+from blocks.graph import ComputationGraph
+from blocks.utils import change_recursion_limit
+
+# The profiles of the living profiled functions, by function
+_profiles = WeakKeyDictionary()
+
+# The active collectors, the profiles of the compiled functions are added
+# to all of them
+_collectors = []
+
+
+class TheanoProfile(object):
+    """A profile of a Theano function attributed to brick applications.
+
+    Wraps Theano's :class:`~theano.compile.profiling.ProfileStats`, which
+    times every apply node of the compiled function, and attributes the
+    time of every apply node to the brick application that created it.
+    As the optimizations of Theano do not preserve annotations, the
+    application is found by the names of the outputs of the node, or if
+    it fails, by the stack trace of their creation, which the
+    optimizations do preserve.
+
+    The applications are reported as ``Brick.application``, with the
+    class name of the brick, since the stack traces do not tell apart
+    the bricks of the same class.
+
+    Parameters
+    ----------
+    name : str
+        The name of the function.
+    variables : list of :class:`~tensor.TensorVariable`
+        The outputs of the function and the values of its updates, whose
+        graph is searched for the brick applications.
+
+    """
+    def __init__(self, name, variables):
+        self.name = name
+        self.stats = ProfileStats(atexit_print=False, message=name)
+        self.names = {}
+        self.sources = []
+        with change_recursion_limit(config.recursion_limit):
+            graph_variables = ComputationGraph(variables).variables
+        for variable in graph_variables:
+            application_call = get_application_call(variable)
+            if application_call is None:
+                continue
+            bound_application = application_call.application
+            label = '{}.{}'.format(
+                type(bound_application.brick).__name__,
+                bound_application.application.application_name)
+            if variable.name:
+                self.names.setdefault(variable.name, label)
+            if label in [source[-1] for source in self.sources]:
+                continue
+            function = bound_application.application.application_function
+            try:
+                lines, first = inspect.getsourcelines(function)
+            except (IOError, TypeError):
+                continue
+            self.sources.append((function.__code__.co_filename, first,
+                                 first + len(lines), label))
+
+    def _label_from_trace(self, variable):
+        trace = getattr(variable.tag, 'trace', [])
+        # Newer versions of Theano keep a list of stack traces
+        if trace and isinstance(trace[0], list):
+            trace = [frame for frames in trace for frame in frames]
+        for frame in reversed(trace):
+            for filename, first, last, label in self.sources:
+                if frame[0] == filename and first <= frame[1] < last:
+                    return label
+
+    def label(self, node):
+        """Find the application that created an apply node.
+
+        Returns
+        -------
+        The ``Brick.application`` label or ``None``.
+
+        """
+        for output in node.outputs:
+            application_call = get_application_call(output)
+            if application_call is not None:
+                return '{}.{}'.format(
+                    type(application_call.application.brick).__name__,
+                    application_call.application.application.application_name)
+            if output.name in self.names:
+                return self.names[output.name]
+        for output in node.outputs:
+            label = self._label_from_trace(output)
+            if label is not None:
+                return label
+
+    def attribute(self, baseline=None):
+        """Sum up the times of the apply nodes by application.
+
+        Parameters
+        ----------
+        baseline : dict, optional
+            The times of the apply nodes to subtract, as copied from
+            ``self.stats.apply_time`` earlier. By default nothing is
+            subtracted.
+
+        Returns
+        -------
+        times : :class:`~collections.OrderedDict`
+            A dictionary mapping ``Brick.application`` labels, or
+            ``None`` for the nodes that could not be attributed, to
+            seconds, in decreasing order of time.
+
+        """
+        if baseline is None:
+            baseline = {}
+        times = defaultdict(float)
+        for key, time in self.stats.apply_time.items():
+            # Newer versions of Theano use (function graph, node) keys
+            node = key[1] if isinstance(key, tuple) else key
+            times[self.label(node)] += time - baseline.get(key, 0.)
+        return OrderedDict(sorted(times.items(), key=lambda item: -item[1]))
+
+
+class TheanoProfiles(object):
+    """Collects the profiles of the Theano functions while active.
+
+    When activated, a collector takes the :class:`TheanoProfile` of every
+    living function compiled by :func:`theano_function` with the
+    ``profile_theano`` configuration set, and then those of the functions
+    compiled while it is active. Only the time spent while it is active
+    is reported. The profiles, which hold the graphs of the functions,
+    are released with the collector.
+
+    A collector is activated by :meth:`start` and deactivated by
+    :meth:`stop`, or used as a context manager.
+
+    Attributes
+    ----------
+    profiles : list of :class:`TheanoProfile`
+        The profiles collected.
+    baselines : dict
+        The times of the apply nodes of every profile when the collector
+        was activated, see :meth:`TheanoProfile.attribute`.
+
+    """
+    def __init__(self):
+        self.profiles = []
+        self.baselines = {}
+
+    def start(self):
+        for profile in _profiles.values():
+            if profile not in self.baselines:
+                self.profiles.append(profile)
+                self.baselines[profile] = dict(profile.stats.apply_time)
+        _collectors.append(self)
+        return self
+
+    def stop(self):
+        if self in _collectors:
+            _collectors.remove(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def report(self, f=sys.stderr):
+        """Print the time spent in every brick application.
+
+        See :func:`report_theano_profiles`.
+
+        """
+        report_theano_profiles(self.profiles, f, self.baselines)
+
+
+def theano_function(name, inputs, outputs=None, updates=None, **kwargs):
+    """Compile a Theano function, profiling it if configured to.
+
+    If the ``profile_theano`` configuration is set, the function is
+    compiled with a :class:`TheanoProfile`, which is collected by the
+    active :class:`TheanoProfiles` collectors and by those activated
+    later. Otherwise this is the same as :func:`theano.function`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the function used in the reports.
+
+    """
+    if not config.profile_theano:
+        return theano.function(inputs, outputs, updates=updates, **kwargs)
+    variables = []
+    if outputs is not None:
+        variables.extend(outputs if isinstance(outputs, (list, tuple))
+                         else [outputs])
+    if updates:
+        items = updates.items() if hasattr(updates, 'items') else updates
+        # The values of updates can be constants, e.g. of aggregators
+        variables.extend(value for _, value in items
+                         if isinstance(value, theano.Variable))
+    profile = TheanoProfile(name, variables)
+    for collector in _collectors:
+        collector.profiles.append(profile)
+        collector.baselines[profile] = {}
+    function = theano.function(inputs, outputs, updates=updates,
+                               profile=profile.stats, **kwargs)
+    _profiles[function] = profile
+    return function
+
+
+def report_theano_profiles(profiles, f=sys.stderr, baselines=None):
+    """Print the time spent in every brick application and function.
+
+    Sums up the times attributed by the profiles, by application and by
+    function name.
+
+    Parameters
+    ----------
+    profiles : list of :class:`TheanoProfile`
+        The profiles.
+    f : object, optional
+        An object with a ``write`` method that accepts string inputs.
+        Defaults to ``sys.stderr``.
+    baselines : dict, optional
+        The times of the apply nodes to subtract from every profile, see
+        :meth:`TheanoProfile.attribute`.
+
+    """
+    if baselines is None:
+        baselines = {}
+    times = defaultdict(float)
+    function_times = defaultdict(float)
+    for profile in profiles:
+        for label, time in profile.attribute(
+                baselines.get(profile)).items():
+            times[label] += time
+            function_times[profile.name] += time
+    total = sum(times.values())
+    print('{:45}{:>15}{:>15}'.format('Application', 'Time', '% of total'),
+          file=f)
+    print('-' * 75, file=f)
+    if not total:
+        print('No Theano profile information collected.', file=f)
+        return
+    for label, time in sorted(times.items(), key=lambda item: -item[1]):
+        print('{:45}{:15.2f}{:15.2%}'.format(
+            label if label is not None else 'Other', time, time / total),
+            file=f)
+    print(file=f)
+    print('{:45}{:>15}{:>15}'.format('Function', 'Time', '% of total'),
+          file=f)
+    print('-' * 75, file=f)
+    for name, time in sorted(function_times.items(),
+                             key=lambda item: -item[1]):
+        print('{:45}{:15.2f}{:15.2%}'.format(name, time, time / total),
+              file=f)
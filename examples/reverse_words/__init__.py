@@ -276,10 +276,10 @@ def main(mode, save_path, num_batches, data_path=None):
                 samples, = VariableFilter(
                     bricks=[reverser.generator], name="outputs")(
                         ComputationGraph(generated[1]))
-                # NOTE: this will recompile beam search functions
-                # every time user presses Enter. Do not create
-                # a new `BeamSearch` object every time if
-                # speed is important for you.
+                # The beam search functions are compiled when the
+                # user presses Enter for the first time, and then
+                # reused by all the `BeamSearch` objects for
+                # these `samples`.
                 beam_search = BeamSearch(input_.shape[1], samples)
                 outputs, costs = beam_search.search(
                     {chars: input_}, char2code['</S>'],
@@ -31,7 +31,8 @@ setup(
         'Programming Language :: Python :: 3.4',
     ],
     keywords='theano machine learning neural networks deep learning',
-    packages=find_packages(exclude=['examples', 'docs', 'tests']),
+    packages=find_packages(exclude=['examples', 'docs', 'tests',
+                                    'benchmarks']),
     scripts=['bin/blocks-continue', 'bin/blocks-dump', 'bin/blocks-plot'],
     setup_requires=['numpy'],
     install_requires=['numpy', 'six', 'pyyaml', 'pandas', 'toolz',
@@ -40,6 +41,7 @@ setup(
     extras_require={
         'test': ['nose', 'nose2'],
         'plot': ['bokeh'],
+        'compression': ['zstandard', 'lz4'],
         'docs': ['sphinx', 'sphinxcontrib-napoleon', 'sphinx-rtd-theme']
     },
     zip_safe=False)
@@ -1,4 +1,12 @@
-from blocks.extensions import SimpleExtension
+import numpy
+from fuel.datasets import IterableDataset
+from numpy.testing import assert_allclose, assert_raises
+
+from blocks.extensions import (FinishAfter, Predicate, ProfileLogging,
+                               SimpleExtension)
+from blocks.log import TrainingLog
+from blocks.main_loop import MainLoop
+from tests import MockAlgorithm
 
 
 def test_parse_args():
@@ -6,3 +14,70 @@ def test_parse_args():
             (('a',), ('b',)))
     assert (SimpleExtension.parse_args('before_epoch', ('a', 'b')) ==
             ((), ('a', 'b')))
+
+
+def test_predicate():
+    log = TrainingLog()
+    predicate = Predicate('every_n_batches', 3)
+    fired = []
+    for iterations_done in list(range(8)) + [2, 3, 9, 10]:
+        log.status['iterations_done'] = iterations_done
+        fired.append(predicate(log))
+    assert fired == [True, False, False, True, False, False, True, False,
+                     False, True, True, False]
+
+
+def test_dispatch_table():
+
+    class CountingExtension(SimpleExtension):
+        def __init__(self, **kwargs):
+            super(CountingExtension, self).__init__(**kwargs)
+            self.calls = []
+
+        def do(self, which_callback, *args):
+            self.calls.append((which_callback, args))
+
+    extension = CountingExtension(every_n_batches=2, after_epoch=True)
+    extension.add_condition('after_epoch', arguments=['user'])
+    assert_raises(TypeError, extension.add_condition, 'after_bach')
+    data_stream = IterableDataset(range(4)).get_example_stream()
+    main_loop = MainLoop(MockAlgorithm(), data_stream,
+                         extensions=[extension,
+                                     FinishAfter(after_n_epochs=1)])
+    main_loop.run()
+    assert [call[0] for call in extension.calls] == [
+        'after_batch', 'after_batch', 'after_epoch', 'after_epoch']
+    assert extension.calls[-1][1] == ('user',)
+
+    # The table is rebuilt for extensions pickled without it
+    extension = CountingExtension(every_n_batches=2)
+    del extension._dispatch_table
+    extension.add_condition('after_epoch', arguments=['user'])
+    main_loop = MainLoop(MockAlgorithm(), data_stream,
+                         extensions=[extension,
+                                     FinishAfter(after_n_epochs=1)])
+    main_loop.run()
+    assert [call[0] for call in extension.calls] == [
+        'after_batch', 'after_batch', 'after_epoch']
+
+
+def test_profile_logging():
+    data_stream = IterableDataset(
+        dict(data=[numpy.zeros(3)] * 6)).get_example_stream()
+    main_loop = MainLoop(
+        MockAlgorithm(), data_stream,
+        extensions=[FinishAfter(after_n_epochs=1),
+                    ProfileLogging(every_n_batches=2, after_epoch=False)])
+    main_loop.run()
+
+    assert 'profile_batches_per_second' not in main_loop.log[1]
+    for iteration in [2, 4, 6]:
+        row = main_loop.log[iteration]
+        assert_allclose(row['profile_examples_per_second'],
+                        3 * row['profile_batches_per_second'])
+        assert 0 < row['profile_data_wait_fraction'] < 1
+        assert row['profile_training/epoch/train'] > 0
+    assert_allclose(
+        sum(main_loop.log[iteration]['profile_training/epoch/train']
+            for iteration in [2, 4, 6]),
+        main_loop.profile.get_total(('training', 'epoch', 'train')))
@@ -1,4 +1,26 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy
+from numpy.testing import assert_equal
+from theano import tensor
+
+from blocks.bricks import Linear
+from blocks.extensions import FinishAfter, TrainingExtension
 from blocks.extensions.saveload import Checkpoint
+from blocks.initialization import Constant
+from blocks.model import Model
+from blocks.serialization import MAIN_SECTION, load, read_section_index
+from tests import MockMainLoop
+
+
+class WriteCostExtension(TrainingExtension):
+
+    def after_batch(self, batch):
+        self.main_loop.log.current_row['cost'] = abs(
+            self.main_loop.log.status['iterations_done'] - 3)
 
 
 def test_checkpoint_save_separately_paths():
@@ -16,3 +38,93 @@ def test_checkpoint_save_separately_paths():
     expected = {'foo': 'notmodelpath_foo',
                 'bar': 'notmodelpath_bar'}
     assert chkpt.save_separately_filenames('notmodelpath') == expected
+
+
+def test_checkpoint_rotation():
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'model.pkl')
+        checkpoint = Checkpoint(path, after_batch=True, keep_last=2,
+                                keep_best='cost', keep_every=4,
+                                save_separately=['log'])
+        main_loop = MockMainLoop(
+            extensions=[FinishAfter(after_n_epochs=1),
+                        WriteCostExtension(), checkpoint])
+        main_loop.run()
+
+        assert main_loop.log[3]['saved_to'] == (
+            os.path.join(folder, 'model_3.pkl'),)
+        # The last two, the best one (cost 0 after the 3rd iteration),
+        # every 4th one and the one made after training
+        assert sorted(os.listdir(folder)) == sorted(
+            name.format(suffix) for suffix in ['', '_log']
+            for name in ['model_3{}.pkl', 'model_4{}.pkl', 'model_8{}.pkl',
+                         'model_9{}.pkl', 'model_10{}.pkl'])
+        assert load(os.path.join(
+            folder, 'model_3.pkl')).status['iterations_done'] == 3
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_checkpoint_deduplicate():
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'model.pkl')
+        main_loop = MockMainLoop(
+            extensions=[FinishAfter(after_n_epochs=1),
+                        Checkpoint(path, after_batch=True, keep_last=2,
+                                   deduplicate=True)])
+        main_loop.frozen = numpy.arange(1024.)
+        main_loop.run()
+
+        arrays = os.path.join(folder, 'model_arrays')
+        assert sorted(os.listdir(folder)) == [
+            'model_10.pkl', 'model_9.pkl', 'model_arrays']
+        stored = [name for name in os.listdir(arrays)
+                  if name.endswith('.npy')]
+        assert len(stored) == 1
+        with open(os.path.join(arrays, 'references.json')) as source:
+            assert json.load(source) == {'model_10.pkl': stored,
+                                         'model_9.pkl': stored}
+        loaded = load(os.path.join(folder, 'model_9.pkl'))
+        assert_equal(loaded.frozen, main_loop.frozen)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_checkpoint_indexed():
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'model.pkl')
+        main_loop = MockMainLoop(
+            extensions=[FinishAfter(after_n_epochs=1),
+                        Checkpoint(path, indexed=True)])
+        main_loop.run()
+
+        assert list(read_section_index(path)) == [
+            MAIN_SECTION, 'log', 'iteration_state']
+        assert load(path, 'log').status['iterations_done'] == 10
+        assert load(path).status['iterations_done'] == 10
+
+        # The parameters are not stored twice
+        x = tensor.matrix('x')
+        linear = Linear(100, 100, weights_init=Constant(1.),
+                        biases_init=Constant(0.))
+        linear.initialize()
+        main_loop = MockMainLoop(
+            model=Model(linear.apply(x)),
+            extensions=[FinishAfter(after_n_epochs=1),
+                        Checkpoint(path, indexed=True)])
+        main_loop.run()
+        index = read_section_index(path)
+        assert list(index) == [MAIN_SECTION, 'log', 'iteration_state',
+                               'parameters']
+        assert index[MAIN_SECTION][1] < linear.W.get_value().nbytes
+        assert_equal(load(path, 'parameters')['/linear.W'],
+                     numpy.ones((100, 100)))
+        loaded = load(path)
+        assert_equal(loaded.model.get_param_values()['/linear.W'],
+                     numpy.ones((100, 100)))
+        assert loaded.iteration_state[0] is loaded.data_stream
+    finally:
+        shutil.rmtree(folder)
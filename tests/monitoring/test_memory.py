@@ -0,0 +1,62 @@
+import numpy
+import theano
+from fuel.datasets import IterableDataset
+from theano import tensor
+
+from blocks.algorithms import GradientDescent, Momentum
+from blocks.bricks import MLP, Tanh
+from blocks.extensions import FinishAfter
+from blocks.extensions.monitoring import (DataStreamMonitoring,
+                                          MemoryLogging,
+                                          TrainingDataMonitoring)
+from blocks.initialization import Constant
+from blocks.main_loop import MainLoop
+from blocks.model import Model
+from blocks.monitoring.memory import memory_footprint, pickled_size
+from blocks.utils import named_copy
+
+
+def test_memory_footprint():
+    floatX = theano.config.floatX
+    itemsize = numpy.dtype(floatX).itemsize
+    x = tensor.matrix('features')
+    mlp = MLP([Tanh(), Tanh()], [3, 4, 2], weights_init=Constant(1),
+              biases_init=Constant(0))
+    mlp.initialize()
+    cost = named_copy(mlp.apply(x).sum(), 'cost')
+    dataset = IterableDataset(
+        dict(features=[numpy.ones((5, 3), dtype=floatX)] * 3))
+
+    model = Model(cost)
+    main_loop = MainLoop(
+        model=model, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost,
+                                  params=list(model.get_params().values()),
+                                  step_rule=Momentum()),
+        extensions=[FinishAfter(after_n_epochs=1),
+                    TrainingDataMonitoring([cost], after_batch=True),
+                    DataStreamMonitoring([cost],
+                                         dataset.get_example_stream()),
+                    MemoryLogging()])
+    main_loop.run()
+
+    footprint = memory_footprint(main_loop)
+    assert footprint['parameters/mlp/linear_0'] == 16 * itemsize
+    assert footprint['parameters/mlp/linear_1'] == 10 * itemsize
+    assert footprint['step_rule'] == 26 * itemsize
+    assert footprint['aggregation_buffers/TrainingDataMonitoring'] > 0
+    assert footprint['aggregation_buffers/DataStreamMonitoring'] > 0
+    assert 'log' not in footprint
+
+    row = main_loop.log.current_row
+    assert row['memory_parameters/mlp/linear_0'] == 16 * itemsize
+    assert row['memory_total'] == sum(footprint.values())
+
+    # The pickled sizes are opt-in, and unavailable for objects which
+    # can not be pickled
+    footprint = memory_footprint(main_loop, pickled_sizes=True)
+    assert footprint['log'] == pickled_size(main_loop.log)
+    assert footprint['iteration_state'] > 0
+    main_loop.epoch_iterator = (i for i in range(3))
+    assert memory_footprint(main_loop, True)['iteration_state'] is None
+    assert pickled_size(lambda: None) is None
@@ -7,7 +7,7 @@ from tests import silence_printing, skip_if_not_available
 
 from blocks.log import TrainingLog
 from blocks.main_loop import MainLoop
-from blocks.serialization import pickle_dump
+from blocks.serialization import pickle_dump, secure_pickle_dump
 
 try:
     from pandas import DataFrame
@@ -51,6 +51,13 @@ def test_load_log():
         log2 = plot.load_log(f.name)
         assert log2[0]['channel0'] == 0
 
+    # test indexed checkpoints
+    with tempfile.NamedTemporaryFile() as f:
+        secure_pickle_dump(main_loop, f.name, sections={'log': log})
+
+        log2 = plot.load_log(f.name)
+        assert log2[0]['channel0'] == 0
+
 
 @silence_printing
 def test_print_column_summary():
@@ -0,0 +1,29 @@
+import copy
+import json
+import tempfile
+
+from benchmarks.compare import compare
+from benchmarks.main_loop import main
+
+
+def test_main_loop_benchmark():
+    with tempfile.NamedTemporaryFile(mode='r') as destination:
+        main(destination.name, batches=20, extensions=(0, 2), records=(3,),
+             profile=(True,), checkpoint_every=(10,), repeat=1)
+        results = json.load(destination)
+    assert results['benchmark'] == 'main_loop'
+    assert len(results['results']) == 1
+    result = results['results'][0]
+    assert result['parameters'] == {'extensions': 2, 'records': 3,
+                                    'profile': True, 'checkpoint_every': 10}
+    assert result['metrics']['iteration_time'] > 0
+
+    comparisons, regressions = compare(results, results)
+    assert len(comparisons) == 2
+    assert not regressions
+    slower = copy.deepcopy(results)
+    slower['results'][0]['metrics']['iteration_time'] *= 2
+    slower['results'][0]['metrics']['iterations_per_second'] /= 2
+    comparisons, regressions = compare(results, slower)
+    assert [regression[1] for regression in regressions] == [
+        'iteration_time', 'iterations_per_second']
@@ -0,0 +1,25 @@
+import json
+import tempfile
+
+from numpy.testing import assert_raises
+
+from benchmarks.bricks import main
+
+
+def test_bricks_benchmark():
+    with tempfile.NamedTemporaryFile(mode='r') as destination:
+        main(destination.name, models=['mlp', 'lstm'], sizes=['small'],
+             batch_size=2, length=3, calls=1, repeat=1)
+        results = json.load(destination)
+    assert results['benchmark'] == 'bricks'
+    assert [result['parameters']['model']
+            for result in results['results']] == ['mlp', 'lstm']
+    for result in results['results']:
+        assert result['parameters']['dim'] == 32
+        assert sorted(result['metrics']) == [
+            'bprop_compile_time', 'bprop_examples_per_second', 'bprop_time',
+            'build_time', 'fprop_compile_time', 'fprop_examples_per_second',
+            'fprop_time']
+        assert all(value > 0 for value in result['metrics'].values())
+
+    assert_raises(ValueError, main, models=['unknown'])
@@ -1,9 +1,18 @@
+import os
 import tempfile
+from collections import OrderedDict
 
 import numpy
+from numpy.testing import assert_raises
 from picklable_itertools.extras import equizip
 
-from blocks.dump import load_parameter_values, save_parameter_values
+from blocks.dump import (load_parameter_values, save_parameter_values,
+                         save_aligned_parameter_values,
+                         is_aligned_parameter_file, ALIGNMENT,
+                         save_sharded_parameter_values,
+                         load_sharded_parameter_values,
+                         read_parameter_manifest, match_parameter_names,
+                         read_aligned_parameter_header, MainLoopDumpManager)
 
 
 def test_save_load_parameter_values():
@@ -16,3 +25,98 @@ def test_save_load_parameter_values():
     for old, new in equizip(param_values, loaded_values):
         assert old[0] == new[0]
         assert numpy.all(old[1] == new[1])
+
+
+def test_save_load_aligned_parameter_values():
+    param_values = [("/a/b", numpy.arange(6.).reshape((2, 3)).T),
+                    ("/a/c", numpy.ones(4, dtype='int32')),
+                    ("/a/d", numpy.array(3.)),
+                    ("e", numpy.zeros((0, 2)))]
+    filename = os.path.join(tempfile.mkdtemp(), 'params.bin')
+    save_aligned_parameter_values(OrderedDict(param_values), filename)
+    assert is_aligned_parameter_file(filename)
+    for mmap_mode in [None, 'r', 'c']:
+        loaded_values = load_parameter_values(filename, mmap_mode=mmap_mode)
+        assert list(loaded_values.keys()) == [name for name, _
+                                              in param_values]
+        for name, value in param_values:
+            assert loaded_values[name].dtype == value.dtype
+            assert loaded_values[name].shape == value.shape
+            assert numpy.all(loaded_values[name] == value)
+            if mmap_mode and value.size:
+                assert loaded_values[name].ctypes.data % ALIGNMENT == 0
+
+
+def test_save_load_sharded_parameter_values():
+    rng = numpy.random.RandomState(1)
+    param_values = OrderedDict(
+        [("/mlp/linear_0.W", rng.uniform(size=(10, 5))),
+         ("/mlp/linear_0.b", rng.uniform(size=(5,))),
+         ("/mlp/linear_1.W", rng.uniform(size=(5, 3))),
+         ("/mlp/linear_10.W", rng.uniform(size=(3, 3))),
+         ("/lookup.W", rng.uniform(size=(20, 4))),
+         ("free", numpy.array(1.))])
+    folder = os.path.join(tempfile.mkdtemp(), 'params')
+    save_sharded_parameter_values(param_values, folder, 3)
+    manifest = read_parameter_manifest(folder)
+    assert list(manifest.keys()) == list(param_values.keys())
+    assert len(set(entry['shard'] for entry in manifest.values())) == 3
+
+    loaded_values = load_sharded_parameter_values(folder, verify=True)
+    assert list(loaded_values.keys()) == list(param_values.keys())
+    for name, value in param_values.items():
+        assert numpy.all(loaded_values[name] == value)
+
+    loaded_values = load_sharded_parameter_values(
+        folder, paths=["/mlp/linear_1", "/lookup.W"], mmap_mode='r')
+    assert list(loaded_values.keys()) == ["/mlp/linear_1.W", "/lookup.W"]
+
+    shard = os.path.join(folder, manifest["free"]["shard"])
+    offset, = [offset for name, _, _, offset
+               in read_aligned_parameter_header(shard) if name == "free"]
+    with open(shard, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'\x01')
+    assert_raises(ValueError, load_sharded_parameter_values, folder,
+                  paths="free", verify=True)
+
+    # Saving again replaces the whole folder
+    save_sharded_parameter_values(param_values, folder, 1)
+    assert sorted(os.listdir(folder)) == ['manifest.json', 'shard_0.bin']
+    assert os.listdir(os.path.dirname(folder)) == ['params']
+    loaded_values = load_sharded_parameter_values(folder, verify=True)
+    assert list(loaded_values.keys()) == list(param_values.keys())
+
+
+def test_match_parameter_names():
+    names = ["/a/b.W", "/a/bc.W", "/a/b/c.W", "/d.W", "e"]
+    assert match_parameter_names(names, "/a/b") == ["/a/b.W", "/a/b/c.W"]
+    assert match_parameter_names(names, ["/d.W", "e"]) == ["/d.W", "e"]
+    assert match_parameter_names(names, "/a") == names[:3]
+
+
+def test_main_loop_dump_manager_shards():
+    class FakeModel(object):
+        def get_param_values(self):
+            return OrderedDict([("/a/b.W", numpy.ones((2, 2))),
+                                ("/c.W", numpy.zeros(3))])
+
+    class FakeMainLoop(object):
+        model = FakeModel()
+
+    folder = tempfile.mkdtemp()
+    manager = MainLoopDumpManager(folder)
+    manager.dump_parameters(FakeMainLoop())
+    assert list(manager.load_parameters(paths="/a").keys()) == ["/a/b.W"]
+
+    manager = MainLoopDumpManager(folder, num_shards=2)
+    manager.dump_parameters(FakeMainLoop())
+    assert not os.path.exists(manager.path_to_parameters)
+    loaded_values = manager.load_parameters()
+    assert list(loaded_values.keys()) == ["/a/b.W", "/c.W"]
+    assert numpy.all(loaded_values["/a/b.W"] == 1)
+    # The shards are memory-mapped unless asked otherwise
+    assert isinstance(loaded_values["/a/b.W"].base, numpy.memmap)
+    manager.mmap_mode = None
+    assert not isinstance(manager.load_parameters()["/a/b.W"].base,
+                          numpy.memmap)
@@ -1,10 +1,46 @@
+import json
+import tempfile
+import timeit
+
+import numpy
+import theano
 from fuel.datasets import IterableDataset
+from six import StringIO
 from six.moves import cPickle
+from theano import tensor
 
-from blocks.main_loop import MainLoop
+from blocks import main_loop as main_loop_module
+from blocks.bricks import Linear, Tanh
+from blocks.config import config
+from blocks.initialization import Constant
+from blocks.main_loop import EXTENSION_BUDGET_WARMUP, MainLoop
 from blocks.extensions import TrainingExtension, FinishAfter
-from blocks.utils import unpack
-from tests import MockAlgorithm
+from blocks.extensions.monitoring import DataStreamMonitoring
+from blocks.utils import named_copy, unpack
+from blocks.utils.theano_profile import TheanoProfiles
+from tests import MockAlgorithm, MockMainLoop
+
+
+class FakeClock(object):
+    """A replacement of :func:`timeit.default_timer` moved by hand."""
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class SlowExtension(TrainingExtension):
+    """Advances a fake clock after every batch and counts the calls."""
+    def __init__(self, critical, clock, **kwargs):
+        super(SlowExtension, self).__init__(**kwargs)
+        self.critical = critical
+        self.clock = clock
+        self.calls = 0
+
+    def after_batch(self, _):
+        self.calls += 1
+        self.clock.now += 1.
 
 
 class WriteBatchExtension(TrainingExtension):
@@ -75,3 +111,94 @@ def test_training_resumption():
 
     do_test(False)
     do_test(True)
+
+
+def test_profile_trace():
+    with tempfile.NamedTemporaryFile() as destination:
+        config.profile_trace = destination.name
+        try:
+            main_loop = MockMainLoop(
+                extensions=[FinishAfter(after_n_epochs=1)])
+            main_loop.run()
+        finally:
+            del config.config['profile_trace']['value']
+        with open(destination.name) as source:
+            events = json.load(source)['traceEvents']
+    durations = [event for event in events if event['ph'] == 'X']
+    assert len([event for event in durations
+                if event['name'] == 'train']) == 10
+    assert durations[-1]['name'] == 'after_training'
+    assert all(event['tid'] == durations[0]['tid'] for event in durations)
+
+
+def test_profile_theano():
+    collected = []
+
+    class RecordedProfiles(TheanoProfiles):
+        def report(self, f=None):
+            collected.append(self)
+
+    x = tensor.matrix('features')
+    linear = Linear(3, 4, weights_init=Constant(1), biases_init=Constant(0))
+    linear.initialize()
+    y = named_copy(Tanh().apply(linear.apply(x)).sum(), 'y')
+    dataset = IterableDataset(
+        dict(features=[numpy.ones((2, 3), dtype=theano.config.floatX)]))
+    config.profile_theano = True
+    main_loop_module.TheanoProfiles = RecordedProfiles
+    try:
+        # The monitoring is compiled before the run
+        monitoring = DataStreamMonitoring([y], dataset.get_example_stream(),
+                                          after_epoch=True)
+        main_loop = MockMainLoop(
+            extensions=[monitoring, FinishAfter(after_n_epochs=1)])
+        main_loop.run()
+    finally:
+        main_loop_module.TheanoProfiles = TheanoProfiles
+        del config.config['profile_theano']['value']
+    profiles, = collected
+    report = StringIO()
+    TheanoProfiles.report(profiles, report)
+    assert 'DatasetEvaluator.accumulate' in report.getvalue()
+    assert 'Linear.apply' in report.getvalue()
+
+
+def test_profile_every():
+    config.profile_every = 4
+    try:
+        main_loop = MockMainLoop(extensions=[FinishAfter(after_n_epochs=1)])
+        main_loop.run()
+    finally:
+        del config.config['profile_every']['value']
+    histograms = main_loop.profile.histograms
+    assert histograms[('training', 'epoch', 'train')].count == 3
+    assert histograms[('training', 'epoch', 'after_batch')].count == 3
+    assert histograms[('training', 'epoch')].count == 1
+    assert histograms[('training', 'after_epoch')].count == 1
+
+
+def test_throttle_extensions():
+    # All the time is spent in the extensions, which take half of it
+    # each, so that both are over the budget as soon as it is checked
+    clock = FakeClock()
+    default_timer = timeit.default_timer
+    timeit.default_timer = clock
+    config.extension_budget = 0.1
+    config.throttle_extensions = True
+    try:
+        critical = SlowExtension(True, clock, name='critical')
+        non_critical = SlowExtension(False, clock, name='non_critical')
+        main_loop = MainLoop(
+            MockAlgorithm(), IterableDataset(range(40)).get_example_stream(),
+            extensions=[critical, non_critical,
+                        FinishAfter(after_n_epochs=1)])
+        main_loop.run()
+    finally:
+        timeit.default_timer = default_timer
+        del config.config['extension_budget']['value']
+        del config.config['throttle_extensions']['value']
+    assert critical.calls == 40
+    # The budget is first checked after the batch of the warm-up
+    # iteration, whose callback is skipped
+    assert non_critical.calls == EXTENSION_BUDGET_WARMUP - 1
+    assert main_loop._extensions_warned == set([0, 1])
@@ -1,7 +1,10 @@
+import threading
+
 import numpy
 import theano
 from theano import tensor
 from numpy.testing import assert_allclose
+from picklable_itertools.extras import equizip
 
 from blocks.bricks import Tanh, Initializable
 from blocks.bricks.attention import SequenceContentAttention
@@ -13,7 +16,8 @@ from blocks.bricks.sequence_generators import (
 from blocks.graph import ComputationGraph
 from blocks.initialization import IsotropicGaussian
 from blocks.filter import VariableFilter
-from blocks.search import BeamSearch
+from blocks.search import (BeamSearch, ContextCache, GenerationSession,
+                           Sampler, sample_outputs)
 
 
 class SimpleGenerator(Initializable):
@@ -62,6 +66,31 @@ class SimpleGenerator(Initializable):
             attended_mask=tensor.ones(chars.shape))
 
 
+def simple_generator_samples(alphabet_size=20):
+    """Build an initialized :class:`SimpleGenerator` and its samples.
+
+    Returns
+    -------
+    simple_generator : :class:`SimpleGenerator`
+        The generator, with randomly initialized parameters.
+    inputs : :class:`~tensor.TensorVariable`
+        The input characters, a matrix of integers.
+    samples : :class:`~tensor.TensorVariable`
+        The outputs of the generator sampled for `inputs`.
+
+    """
+    simple_generator = SimpleGenerator(10, alphabet_size, seed=1234)
+    simple_generator.weights_init = IsotropicGaussian(0.5)
+    simple_generator.biases_init = IsotropicGaussian(0.5)
+    simple_generator.initialize()
+
+    inputs = tensor.lmatrix('inputs')
+    samples, = VariableFilter(bricks=[simple_generator.generator],
+                              name="outputs")(
+        ComputationGraph(simple_generator.generate(inputs)))
+    return simple_generator, inputs, samples
+
+
 def test_beam_search_smallest():
     a = numpy.array([[3, 6, 4], [1, 2, 7]])
     ind, mins = BeamSearch._smallest(a, 2)
@@ -69,6 +98,15 @@ def test_beam_search_smallest():
     assert numpy.all(mins == [1, 2])
 
 
+def test_beam_search_backtrack():
+    backpointers = numpy.array([[0, 0], [0, 0], [1, 0]])
+    outputs = numpy.array([[5, 5], [1, 2], [3, 4]])
+    costs = numpy.array([[0., 0.], [1., 2.], [3., 4.]])
+    outputs, costs = BeamSearch._backtrack(backpointers, outputs, costs)
+    assert numpy.all(outputs == [[5, 5], [2, 1], [3, 4]])
+    assert numpy.all(costs == [[0., 0.], [2., 1.], [3., 4.]])
+
+
 def test_beam_search():
     """Test beam search using the model similar to the reverse_words demo.
 
@@ -113,4 +151,326 @@ def test_beam_search():
     results2, costs2 = search.search({inputs: input_vals},
                                      0, 3 * length)
     for i in range(len(results2)):
-        assert results2[i] == list(results.T[i, :mask.T[i].sum()])
+        assert results2[i] == list(results.T[i, :int(mask.T[i].sum())])
+
+
+def test_beam_search_step():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 4
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    search = BeamSearch(beam_size, samples)
+    search.compile()
+
+    # A step computes the next states and log probabilities at once
+    input_vals = rng.randint(alphabet_size, size=(length, 1))
+    contexts = search.compute_contexts(
+        {inputs: numpy.repeat(input_vals, beam_size, axis=1)})
+    states = search.compute_initial_states(contexts)
+    outputs = numpy.arange(beam_size)
+    search.set_contexts(contexts)
+    next_states, logprobs = search.compute_step(states, outputs)
+    expected_states = search.compute_next_states(contexts, states, outputs)
+    for name in search.state_names:
+        assert_allclose(next_states[name], expected_states[name])
+    assert_allclose(logprobs,
+                    search.compute_logprobs(contexts, expected_states))
+
+
+def test_beam_search_batch():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 4
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    search = BeamSearch(beam_size, samples)
+
+    input_vals = rng.randint(alphabet_size, size=(length, 3))
+    batch_results = search.search_batch({inputs: input_vals}, 0,
+                                        3 * length)
+    assert len(batch_results) == 3
+    for i, (outputs, costs) in enumerate(batch_results):
+        expected_outputs, expected_costs = search.search(
+            {inputs: numpy.repeat(input_vals[:, i:i + 1], beam_size,
+                                  axis=1)}, 0, 3 * length)
+        assert outputs == expected_outputs
+        assert_allclose(costs, expected_costs, rtol=1e-5)
+
+    outputs, mask, costs = search.search_batch(
+        {inputs: input_vals}, 0, 3 * length, as_arrays=True)
+    assert outputs.shape[1:] == (3, beam_size)
+    assert mask.shape == outputs.shape == costs.shape
+
+    # The compiled functions are shared with the other beam sizes
+    small_search = BeamSearch(2, samples)
+    small_search.compile()
+    assert small_search.step_computer is search.step_computer
+    outputs, mask, costs = small_search.search_batch(
+        {inputs: input_vals}, 0, 3 * length, as_arrays=True)
+    assert outputs.shape[1:] == (3, 2)
+
+
+def test_beam_search_threads():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 4
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    input_vals = [{inputs: rng.randint(alphabet_size, size=(length, 3))}
+                  for _ in range(2)]
+    searches = [BeamSearch(beam_size, samples) for _ in range(2)]
+    expected = [search.search_batch(value, 0, 3 * length)
+                for search, value in equizip(searches, input_vals)]
+
+    # The searches for the same samples share the compiled functions, but
+    # each of them steps with its own contexts
+    contexts = []
+    for search, value in equizip(searches, input_vals):
+        contexts.append(search.compute_contexts(value))
+        search.set_contexts(contexts[-1])
+    states = searches[0].compute_initial_states(contexts[0], 3)
+    outputs = numpy.arange(3)
+    logprobs = searches[0].compute_step(states, outputs)[1]
+    assert_allclose(logprobs, searches[0].compute_logprobs(
+        contexts[0], searches[0].compute_next_states(contexts[0], states,
+                                                     outputs)))
+
+    results = [[] for _ in searches]
+
+    def search_many(i):
+        for _ in range(3):
+            results[i].append(searches[i].search_batch(input_vals[i], 0,
+                                                       3 * length))
+    threads = [threading.Thread(target=search_many, args=(i,))
+               for i in range(len(searches))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for search_results, expected_results in equizip(results, expected):
+        assert len(search_results) == 3
+        for batch_results in search_results:
+            for (outputs, costs), (expected_outputs, expected_costs) in (
+                    equizip(batch_results, expected_results)):
+                assert outputs == expected_outputs
+                assert_allclose(costs, expected_costs, rtol=1e-5)
+
+
+def test_beam_search_pruning():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 4
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    search = BeamSearch(beam_size, samples)
+    input_vals = {inputs: rng.randint(alphabet_size, size=(length, 3))}
+    # The random model emits this symbol early in all the beams
+    eol_symbol = 6
+
+    # The finished hypotheses are not computed, which does not change
+    # the results
+    results = search.search_batch(input_vals, eol_symbol, 3 * length,
+                                  as_arrays=True)
+    unpruned_search = BeamSearch(beam_size, samples)
+    unpruned_search._context_batch_axes = lambda contexts, number: None
+    unpruned_results = unpruned_search.search_batch(
+        input_vals, eol_symbol, 3 * length, as_arrays=True)
+    for array, unpruned_array in equizip(results, unpruned_results):
+        assert_allclose(array, unpruned_array)
+
+    # Early stopping finds the same finished hypotheses
+    batch_results = search.search_batch(input_vals, eol_symbol,
+                                        3 * length)
+    early_results = search.search_batch(input_vals, eol_symbol,
+                                        3 * length, early_stopping=True)
+    for (outputs, costs), (early_outputs, early_costs) in equizip(
+            batch_results, early_results):
+        assert len(early_outputs) == beam_size
+        assert all(output[-1] == eol_symbol for output in early_outputs)
+        assert early_outputs == outputs
+        assert_allclose(early_costs, costs, rtol=1e-5)
+
+    # Length normalization sorts by the average cost
+    for outputs, costs in search.search_batch(
+            input_vals, eol_symbol, 3 * length, length_normalization=1.):
+        averages = [cost / len(output)
+                    for output, cost in equizip(outputs, costs)]
+        assert averages == sorted(averages)
+
+
+def test_beam_search_stop_early():
+    search = BeamSearch.__new__(BeamSearch)
+    search.beam_size = 2
+    # The second beam has two finished hypotheses, cheaper than its
+    # active one. The first beam has only one, which is cheaper than its
+    # active one, so the latter must go on until another one finishes.
+    mask = numpy.array([0, 1, 1, 0], dtype=theano.config.floatX)
+    costs = numpy.array([1., 2., 3., 4.])
+    search._stop_early(mask, costs, numpy.array([1., 2., 2.5]),
+                       numpy.array([0, 1, 1]), 2, 10, 0.)
+    assert list(mask) == [0, 1, 0, 0]
+    search._stop_early(mask, costs, numpy.array([1., 2., 2.5, 2.5]),
+                       numpy.array([0, 1, 1, 0]), 2, 10, 0.)
+    assert list(mask) == [0, 1, 0, 0]
+    search._stop_early(mask, costs, numpy.array([1., 2., 2.5, 2.]),
+                       numpy.array([0, 1, 1, 0]), 2, 10, 0.)
+    assert list(mask) == [0, 0, 0, 0]
+
+    # The hypotheses which fell out of the beam are followed from the
+    # step where they finished
+    backpointers = numpy.array([[0, 0], [0, 0], [1, 0]])
+    outputs = numpy.array([[5, 5], [1, 0], [3, 4]])
+    ends = (numpy.array([1, 2]), numpy.array([1, 1]))
+    outputs, = BeamSearch._backtrack(backpointers, outputs, ends=ends)
+    assert numpy.all(outputs == [[5, 5], [0, 1], [0, 4]])
+
+
+def test_context_cache():
+    cache = ContextCache(100)
+    key = ContextCache.key([numpy.arange(3)])
+    assert key == ContextCache.key([numpy.arange(3)])
+    assert key != ContextCache.key([numpy.arange(3, dtype='int32')])
+    assert key != ContextCache.key([numpy.arange(3)[::-1]])
+    cache.put('a', {'x': numpy.zeros(5)})
+    cache.put('b', {'x': numpy.zeros(5)})
+    assert cache.get('a') is not None
+    cache.put('c', {'x': numpy.zeros(5)})
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.size == 80
+    cache.put('d', {'x': numpy.zeros(20)})
+    assert 'd' not in cache and len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_beam_search_context_cache():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    beam_size = 4
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    search = BeamSearch(beam_size, samples, context_cache_size=2 ** 20)
+    search.compile()
+    calls = []
+    context_computer = search.context_computer
+
+    def count_calls(*args):
+        calls.append(args)
+        return context_computer(*args)
+    search.context_computer = count_calls
+
+    # Repeated searches for the same inputs do not compute the contexts
+    # again, whatever the beam size and the maximum length
+    input_vals = {inputs: rng.randint(alphabet_size, size=(length, 3))}
+    results = search.search_batch(input_vals, 0, 3 * length)
+    assert search.search_batch(input_vals, 0, 3 * length) == results
+    search.search_batch(input_vals, 0, length)
+    search.beam_size = 2
+    search.search_batch(input_vals, 0, 3 * length)
+    assert len(calls) == 1
+    uncached_search = BeamSearch(beam_size, samples)
+    for (outputs, costs), (expected_outputs, expected_costs) in equizip(
+            results, uncached_search.search_batch(input_vals, 0,
+                                                  3 * length)):
+        assert outputs == expected_outputs
+        assert_allclose(costs, expected_costs)
+
+    # Other inputs are cached separately
+    search.search_batch(
+        {inputs: rng.randint(alphabet_size, size=(length, 3))}, 0, length)
+    assert len(calls) == 2
+    search.search_batch(input_vals, 0, length)
+    assert len(calls) == 2
+
+
+def test_generation_session():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    length = 6
+
+    simple_generator, inputs, samples = simple_generator_samples(
+        alphabet_size)
+    input_vals = rng.randint(alphabet_size, size=(length, 2))
+
+    # The costs of fed outputs are those of the model
+    session = GenerationSession(samples, {inputs: input_vals}, 2)
+    targets = rng.randint(alphabet_size, size=(4, 2))
+    costs = numpy.zeros(2)
+    for outputs in targets:
+        costs += session.logprobs[numpy.arange(2), outputs]
+        session.feed(outputs)
+    assert session.steps == 4
+    true_costs = simple_generator.cost(
+        input_vals, numpy.ones((length, 2), dtype=theano.config.floatX),
+        targets, numpy.ones((4, 2), dtype=theano.config.floatX)).eval()
+    assert_allclose(costs, true_costs.sum(axis=0), rtol=1e-5)
+
+    # Sampling is reproducible and stops at the end of sequence symbol,
+    # which the model emits, without computing another step
+    generated = []
+    steps = []
+    for _ in range(2):
+        session = GenerationSession(samples, {inputs: input_vals}, 2,
+                                    seed=1)
+        compute_step = session.search.compute_step
+
+        def count_steps(*args):
+            steps.append(args)
+            return compute_step(*args)
+        session.search.compute_step = count_steps
+        generated.append(list(session.generate(6, 3 * length)))
+    assert_allclose(numpy.array(generated[0]), numpy.array(generated[1]))
+    assert len(generated[0]) < 3 * length
+    assert numpy.all(generated[0][-1] == 6)
+    for outputs in generated[0][:-1]:
+        assert not numpy.all(outputs == 6)
+    assert len(steps) == 2 * (len(generated[0]) - 1)
+    assert session.steps == len(generated[0]) - 1
+
+
+def test_sample_outputs():
+    rng = numpy.random.RandomState(1234)
+    probs = numpy.array([[0.5, 0.3, 0.15, 0.05]] * 1000)
+    logprobs = -numpy.log(probs)
+    counts = numpy.bincount(sample_outputs(logprobs, rng), minlength=4)
+    assert_allclose(counts / 1000., probs[0], atol=0.05)
+    assert set(sample_outputs(logprobs, rng, top_k=2)) == {0, 1}
+    assert set(sample_outputs(logprobs, rng, top_p=0.7)) == {0, 1}
+    assert set(sample_outputs(logprobs, rng, top_p=0.1)) == {0}
+    counts = numpy.bincount(
+        sample_outputs(logprobs, rng, temperature=0.1), minlength=4)
+    assert counts[0] > 950
+
+
+def test_sampler():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    length = 6
+
+    simple_generator, inputs, samples = simple_generator_samples(
+        alphabet_size)
+    input_vals = {inputs: rng.randint(alphabet_size, size=(length, 1))}
+
+    # Sampling only the most probable output is greedy search
+    greedy_outputs, greedy_costs = BeamSearch(1, samples).search(
+        input_vals, 0, 3 * length)
+    outputs, costs = Sampler(samples, top_k=1).sample(input_vals, 3, 0,
+                                                      3 * length)
+    assert outputs == greedy_outputs * 3
+    assert_allclose(costs, greedy_costs * 3, rtol=1e-5)
+
+    # The costs of the samples are those of the model
+    outputs, mask, costs = Sampler(samples, seed=1).sample(
+        input_vals, 5, 0, 3 * length, as_arrays=True)
+    assert outputs.shape[1] == 5
+    assert outputs.shape[0] <= 3 * length
+    true_costs = simple_generator.cost(
+        numpy.repeat(input_vals[inputs], 5, axis=1),
+        numpy.ones((length, 5), dtype=theano.config.floatX),
+        outputs, mask).eval()
+    assert_allclose(costs, true_costs.sum(axis=0), rtol=1e-5)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+from numpy.testing import assert_equal, assert_raises
+
+from blocks.serialization import (ArrayStore, MAIN_SECTION,
+                                  detect_compression, load,
+                                  read_section_index, secure_pickle_dump)
+from tests import skip_if_not_available
+
+
+def check_compression(compression):
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'object.pkl')
+        object_ = {'array': numpy.arange(1000.), 'text': 'abc' * 1000}
+        secure_pickle_dump(object_, path, compression=compression,
+                           buffer_size=512, fsync='directory')
+        with open(path, 'rb') as source:
+            assert detect_compression(source) == compression
+        if compression is not None:
+            assert os.path.getsize(path) < 8000
+        loaded = load(path)
+        assert_equal(loaded['array'], object_['array'])
+        assert loaded['text'] == object_['text']
+        assert os.listdir(folder) == ['object.pkl']
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_secure_pickle_dump_compression():
+    for compression in [None, 'gzip', 'bz2']:
+        check_compression(compression)
+
+
+def test_secure_pickle_dump_lzma():
+    skip_if_not_available(modules=['lzma'])
+    check_compression('lzma')
+
+
+def test_secure_pickle_dump_zstd():
+    skip_if_not_available(modules=['zstandard'])
+    check_compression('zstd')
+
+
+def test_secure_pickle_dump_lz4():
+    skip_if_not_available(modules=['lz4.frame'])
+    check_compression('lz4')
+
+
+def test_array_store():
+    folder = tempfile.mkdtemp()
+    try:
+        store = ArrayStore(os.path.join(folder, 'arrays'))
+        object_ = [numpy.ones(1024), numpy.ones(1024), numpy.zeros(10)]
+        for name in ['first.pkl', 'second.pkl']:
+            secure_pickle_dump(object_, os.path.join(folder, name),
+                               array_store=store, compression='gzip')
+        stored = [name for name in os.listdir(store.folder)
+                  if name.endswith('.npy')]
+        assert len(stored) == 1
+        assert store.get_references() == {'first.pkl': stored,
+                                          'second.pkl': stored}
+        with open(os.path.join(folder, 'first.pkl'), 'rb') as source:
+            assert detect_compression(source) == 'gzip'
+        loaded = load(os.path.join(folder, 'second.pkl'))
+        for value, expected in zip(loaded, object_):
+            assert_equal(value, expected)
+
+        store.remove_references('first.pkl')
+        store.collect_garbage()
+        assert len(os.listdir(store.folder)) == 2
+        store.remove_references('second.pkl')
+        store.collect_garbage()
+        assert os.listdir(store.folder) == ['references.json']
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_secure_pickle_dump_failure():
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'object.pkl')
+        assert_raises(Exception, secure_pickle_dump, lambda x: x, path,
+                      compression='gzip')
+        assert os.listdir(folder) == []
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_indexed_pickle():
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'object.pkl')
+        secure_pickle_dump({'a': 1}, path, compression='gzip',
+                           sections={'b': 2, 'c': numpy.arange(10)})
+        index = read_section_index(path)
+        assert list(index) == [MAIN_SECTION, 'b', 'c']
+        assert load(path) == {'a': 1}
+        assert load(path, 'b') == 2
+        assert_equal(load(path, 'c'), numpy.arange(10))
+        assert_raises(ValueError, load, path, 'd')
+
+        # The object refers to the sections instead of storing them again
+        log = {'records': list(range(1000))}
+        array = numpy.arange(1000.)
+        secure_pickle_dump({'log': log, 'array': array, 'a': 1}, path,
+                           sections={'log': log,
+                                     'parameters': {'W': array, 'b': 1}})
+        index = read_section_index(path)
+        assert index[MAIN_SECTION][1] < 1000
+        loaded = load(path)
+        assert loaded['log'] == log
+        assert_equal(loaded['array'], array)
+        assert_equal(load(path, 'parameters')['W'], array)
+
+        secure_pickle_dump({'a': 1}, path)
+        assert read_section_index(path) is None
+        assert load(path, MAIN_SECTION) == {'a': 1}
+        assert_raises(ValueError, load, path, 'b')
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,124 @@
+import json
+import threading
+
+import numpy
+from numpy.testing import assert_allclose, assert_raises
+from six import StringIO
+
+from blocks.search import BeamSearch
+from blocks.serving import BucketedDecoder, DecodingServer
+from tests.test_search import simple_generator_samples
+
+
+def test_decoding_server():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    beam_search = BeamSearch(3, samples)
+    input_vals = [rng.randint(alphabet_size, size=(length, 1))
+                  for _ in range(6)]
+    # A request of a different length is decoded in a batch of its own
+    input_vals.append(rng.randint(alphabet_size, size=(length + 1, 1)))
+    expected = [beam_search.search_batch({inputs: value}, 0, 3 * length)[0]
+                for value in input_vals]
+
+    results = [None] * len(input_vals)
+    with DecodingServer(beam_search, 0, 3 * length,
+                        batch_window=0.1) as server:
+        def client(i):
+            results[i] = server.decode({inputs: input_vals[i]}, timeout=60)
+        threads = [threading.Thread(target=client, args=(i,))
+                   for i in range(len(input_vals))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for (outputs, costs), (expected_outputs, expected_costs) in zip(
+            results, expected):
+        assert outputs == expected_outputs
+        assert_allclose(costs, expected_costs, rtol=1e-5)
+    assert sum(server.batch_sizes) == len(input_vals)
+    assert len(server.batch_sizes) < len(input_vals)
+
+
+def test_decoding_server_stop():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+    length = 6
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    server = DecodingServer(BeamSearch(3, samples), 0, 3 * length,
+                            batch_window=0., batch_history=2)
+    assert_raises(ValueError, server.submit,
+                  {inputs: rng.randint(alphabet_size, size=(length, 1))})
+
+    # Only the sizes of the last batches are kept
+    server.start()
+    for _ in range(3):
+        server.decode(
+            {inputs: rng.randint(alphabet_size, size=(length, 1))},
+            timeout=60)
+    assert list(server.batch_sizes) == [1, 1]
+
+    # The requests submitted while the server stops are either decoded
+    # or refused
+    requests = []
+    refused = []
+
+    def client():
+        for _ in range(5):
+            try:
+                requests.append(server.submit(
+                    {inputs: rng.randint(alphabet_size, size=(length, 1))}))
+            except ValueError:
+                refused.append(True)
+    thread = threading.Thread(target=client)
+    thread.start()
+    server.stop()
+    thread.join()
+    assert len(requests) + len(refused) == 5
+    for request in requests:
+        assert request.done()
+        assert len(request.result(timeout=0)[0]) == 3
+    assert_raises(ValueError, server.submit,
+                  {inputs: rng.randint(alphabet_size, size=(length, 1))})
+
+
+def test_bucketed_decoder():
+    rng = numpy.random.RandomState(1234)
+    alphabet_size = 20
+
+    _, inputs, samples = simple_generator_samples(alphabet_size)
+    beam_search = BeamSearch(3, samples)
+    lengths = [6, 3, 7, 3, 6, 4, 5]
+    input_vals = [{inputs: rng.randint(1, alphabet_size, size=(length,))}
+                  for length in lengths]
+    decoder = BucketedDecoder(beam_search, 0, lambda length: 3 * length,
+                              batch_size=2)
+
+    buckets = decoder.buckets(input_vals)
+    assert [[lengths[i] for i in bucket] for bucket in buckets] == [
+        [3, 3], [4, 5], [6, 6], [7]]
+
+    output = StringIO()
+    results = decoder.decode(input_vals, output)
+    for bucket in buckets:
+        length = max(lengths[i] for i in bucket)
+        for i in bucket:
+            padded = numpy.zeros((length, 1), dtype='int64')
+            padded[:lengths[i], 0] = input_vals[i][inputs]
+            expected_outputs, expected_costs = beam_search.search_batch(
+                {inputs: padded}, 0, 3 * length)[0]
+            assert results[i][0] == expected_outputs
+            assert_allclose(results[i][1], expected_costs, rtol=1e-5)
+
+    # The results are streamed in the order of the buckets
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line['index'] for line in lines] == sum(buckets, [])
+    for line in lines:
+        assert line['outputs'] == [
+            [int(symbol) for symbol in sequence]
+            for sequence in results[line['index']][0]]
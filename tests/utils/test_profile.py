@@ -0,0 +1,111 @@
+import json
+import tempfile
+import threading
+from collections import defaultdict, OrderedDict
+
+from numpy.testing import assert_allclose
+from six import StringIO
+
+from blocks.utils.profile import Histogram, Profile, Timer, TraceRecorder
+
+
+def test_histogram():
+    histogram = Histogram()
+    values = [0.001 * i for i in range(1, 101)]
+    for value in values:
+        histogram.add(value)
+    assert histogram.count == 100
+    assert_allclose(histogram.mean, 0.0505)
+    assert histogram.max == 0.1
+    for q in [50, 95, 99]:
+        assert_allclose(histogram.percentile(q), q / 1000., rtol=0.07)
+    assert histogram.percentile(100) == 0.1
+    assert_allclose(histogram.percentile(0), 0.001, rtol=0.07)
+
+
+def test_histogram_out_of_range():
+    histogram = Histogram(min_value=1e-3, max_value=1.)
+    histogram.add(1e-5)
+    histogram.add(100.)
+    assert histogram.percentile(1) == 1e-3
+    assert histogram.percentile(100) == 100.
+    assert Histogram().percentile(50) == 0.
+
+
+def test_profile_report():
+    profile = Profile()
+    profile.enter('training')
+    for t in [0.01, 0.02, 0.5]:
+        profile.enter('epoch')
+        profile.exit(t)
+    profile.exit(1.)
+    assert profile.histograms[('training', 'epoch')].count == 3
+    assert profile.histograms[('training', 'epoch')].max == 0.5
+
+    report = StringIO()
+    profile.report(report)
+    lines = report.getvalue().splitlines()
+    assert lines[0].split()[-2:] == ['Max,', 'ms']
+    assert lines[3].split()[:4] == ['Epoch', '0.53', '53.00%', '3']
+    assert lines[3].split()[-1] == '500.00'
+
+
+def test_trace_recorder():
+    trace = TraceRecorder(max_events=2)
+    profile = Profile()
+    profile.trace = trace
+    for name in ['a', 'b', 'c']:
+        with Timer(name, profile):
+            pass
+    assert [event[0] for event in trace.events] == ['b', 'c']
+
+    thread = threading.Thread(target=trace.record, args=('d', 1., 1.5),
+                              name='worker')
+    thread.start()
+    thread.join()
+    with tempfile.NamedTemporaryFile() as destination:
+        trace.write(destination.name)
+        with open(destination.name) as source:
+            events = json.load(source)['traceEvents']
+    names = {event['args']['name']: event['tid'] for event in events
+             if event['ph'] == 'M'}
+    assert names['worker'] == thread.ident
+    assert events[-1]['name'] == 'd'
+    assert events[-1]['ts'] == 1e6
+    assert events[-1]['dur'] == 5e5
+    assert events[-1]['tid'] == thread.ident
+
+
+def test_profile_sampling():
+    profile = Profile(sample_every=3)
+    with Timer('epoch', profile):
+        for iteration in range(7):
+            profile.begin_iteration(iteration)
+            with Timer('train', profile):
+                pass
+            profile.end_iteration()
+    assert profile.histograms[('epoch',)].count == 1
+    assert profile.histograms[('epoch', 'train')].count == 3
+    train = profile.order[('epoch', 'train')]
+    assert_allclose(profile.get_total(('epoch', 'train')),
+                    3 * train.histogram.sum)
+    assert profile.get_total(('epoch', 'read_data')) == 0
+    assert list(profile.total) == [('epoch',), ('epoch', 'train')]
+
+
+def test_profile_old_state():
+    # The state of a profile pickled before the sections formed a tree
+    profile = Profile.__new__(Profile)
+    profile.__setstate__({
+        'total': defaultdict(int, {('training',): 2.,
+                                   ('training', 'epoch'): 1.}),
+        'current': [],
+        'order': OrderedDict([(('training',), None),
+                              (('training', 'epoch'), None)])})
+    assert profile.get_total(('training', 'epoch')) == 1.
+    assert list(profile.total) == [('training',), ('training', 'epoch')]
+    with Timer('training', profile):
+        with Timer('epoch', profile):
+            pass
+    assert profile.histograms[('training', 'epoch')].count == 1
+    profile.report(StringIO())
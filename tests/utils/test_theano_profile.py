@@ -0,0 +1,47 @@
+import numpy
+from numpy.testing import assert_allclose
+from six import StringIO
+import theano
+from theano import tensor
+
+from blocks.bricks import Linear, Tanh
+from blocks.config import config
+from blocks.initialization import Constant
+from blocks.utils.theano_profile import TheanoProfiles, theano_function
+
+
+def test_theano_profile():
+    x = tensor.matrix('x')
+    linear = Linear(3, 4, weights_init=Constant(1), biases_init=Constant(0))
+    linear.initialize()
+    y = Tanh().apply(linear.apply(x)).sum()
+    config.profile_theano = True
+    try:
+        # The functions compiled before a collector is started are
+        # collected too, but only the time spent while it is active is
+        # reported
+        function = theano_function('test', [x], y)
+        function(numpy.ones((2, 3), dtype=theano.config.floatX))
+        with TheanoProfiles() as profiles:
+            other_function = theano_function('other', [x], y)
+    finally:
+        del config.config['profile_theano']['value']
+    profile, = [profile for profile in profiles.profiles
+                if profile.stats is function.profile]
+    assert profile.name == 'test'
+    assert 'other' in [profile.name for profile in profiles.profiles]
+    baseline = profiles.baselines[profile]
+    assert not any(profile.attribute(baseline).values())
+    function(numpy.ones((2, 3), dtype=theano.config.floatX))
+    other_function(numpy.ones((2, 3), dtype=theano.config.floatX))
+    assert (sum(profile.attribute(baseline).values()) <
+            sum(profile.attribute().values()))
+
+    times = profile.attribute()
+    assert set(times) <= set(['Linear.apply', 'Tanh.apply', None])
+    assert 'Linear.apply' in times
+    assert_allclose(sum(times.values()),
+                    sum(profile.stats.apply_time.values()))
+    report = StringIO()
+    profiles.report(report)
+    assert 'Linear.apply' in report.getvalue()